@@ -0,0 +1,205 @@
+from PySide6.QtCore import QObject, QTimer, Slot
+import json
+import logging
+import os
+import queue
+import threading
+import time
+import numpy as np
+import HeaderCache
+import Product
+
+SCHEMA = "capture.json"
+
+def record_dtype(dtype):
+    '''
+        one record per frame: host receive time (seconds since epoch) and the struct
+    '''
+    return np.dtype([('t', '<f8'), ('data', dtype)])
+
+class StreamFile(object):
+    '''
+        A preallocated, growable memory-mapped file of records.
+    '''
+    INITIAL_CAPACITY = 1 << 16
+
+    def __init__(self, path, dtype):
+        self.path = path
+        self.dtype = dtype
+        self.count = 0
+        self.capacity = 0
+        self.memmap = None
+        with open(path, 'wb'):
+            pass
+        self.grow(self.INITIAL_CAPACITY)
+
+    def grow(self, capacity):
+        if self.memmap is not None:
+            self.memmap.flush()
+            self.memmap = None
+        with open(self.path, 'r+b') as f:
+            f.truncate(capacity * self.dtype.itemsize)
+        self.capacity = capacity
+        self.memmap = np.memmap(self.path, self.dtype, 'r+', shape = (capacity,))
+
+    def append(self, t, array):
+        n = array.shape[0]
+        if self.count + n > self.capacity:
+            self.grow(max(2 * self.capacity, self.count + n))
+        records = self.memmap[self.count:self.count + n]
+        records['t'] = t
+        records['data'] = array
+        self.count += n
+
+    def close(self):
+        if self.memmap is not None:
+            self.memmap.flush()
+            self.memmap = None
+        with open(self.path, 'r+b') as f: # drop the preallocated tail
+            f.truncate(self.count * self.dtype.itemsize)
+
+class CaptureWriter(object):
+    '''
+        Writes one StreamFile per struct in a directory, along with a
+        capture.json schema holding each stream's dtype and record count.
+    '''
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(path, exist_ok = True)
+        self.streams = {}
+        self.started = time.time()
+
+    def write(self, t, name, array):
+        stream = self.streams.get(name)
+        if stream is None:
+            stream = self.streams[name] = StreamFile(os.path.join(self.path, f"{name}.bin"), record_dtype(array.dtype))
+            self.write_schema()
+        stream.append(t, array)
+
+    def write_schema(self):
+        schema = {"version": 2, "started": self.started, "streams": {}}
+        for (name, stream) in self.streams.items():
+            schema["streams"][name] = {"file": os.path.basename(stream.path),
+                                       "dtype": HeaderCache.dtype_to_json(stream.dtype),
+                                       "count": stream.count}
+        tmp = os.path.join(self.path, SCHEMA + ".tmp")
+        with open(tmp, 'w') as f:
+            json.dump(schema, f, indent = 1)
+        os.replace(tmp, os.path.join(self.path, SCHEMA))
+
+    def close(self):
+        for stream in self.streams.values():
+            stream.close()
+        self.write_schema()
+
+def load_capture(path):
+    '''
+        returns {struct name: np.memmap of records}, records have a 't' (host
+        receive time) and a 'data' (struct) field. Nothing is copied.
+    '''
+    with open(os.path.join(path, SCHEMA)) as f:
+        schema = json.load(f)
+    streams = {}
+    for (name, stream) in schema["streams"].items():
+        if "dtype" in stream:
+            dtype = HeaderCache.dtype_from_json(stream["dtype"])
+        else: # version 1
+            dtype = np.lib.format.descr_to_dtype(stream["descr"])
+        count = stream["count"]
+        if count > 0:
+            streams[name] = np.memmap(os.path.join(path, stream["file"]), dtype, 'r', shape = (count,))
+        else:
+            streams[name] = np.empty(0, dtype)
+    return streams
+
+class SimpleFOCRecorder(QObject):
+    '''
+        Records every batch emitted by a SerialPortListener.
+        dataReceived() is meant to be called from the listener thread
+        (Qt.DirectConnection): it only timestamps and enqueues. A writer
+        thread drains the bounded queue into a CaptureWriter; batches that
+        don't fit in the queue are dropped and counted.
+    '''
+    SCHEMA_PERIOD = 1.0 # seconds between schema updates while recording
+
+    def __init__(self, parent = None):
+        super(SimpleFOCRecorder, self).__init__(parent)
+        self._path = "capture"
+        self._recording = False
+        self._maxQueue = 1024
+        self._framesWritten = 0
+        self._framesDropped = 0
+        self._queue = None
+        self._thread = None
+        self._written = 0 # updated by the writer thread, published by _timer
+        self._dropped = 0
+        self._timer = QTimer(self)
+        self._timer.setInterval(500)
+        self._timer.timeout.connect(self.publish)
+
+    Product.RWProperty(vars(), str, "path")
+    Product.RWProperty(vars(), int, "maxQueue") # batches
+
+    def cb_recording(self, old_value):
+        if self._recording:
+            self.start()
+        else:
+            self.stop()
+
+    Product.RWProperty(vars(), bool, "recording", cb_recording)
+
+    Product.ROProperty(vars(), int, "framesWritten")
+    Product.ROProperty(vars(), int, "framesDropped")
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._written = self._dropped = 0
+        self._queue = queue.Queue(self._maxQueue)
+        self._thread = threading.Thread(target = self.run, args = (CaptureWriter(self._path), self._queue), daemon = True)
+        self._thread.start()
+        self._timer.start()
+
+    def stop(self):
+        if self._thread is None:
+            return
+        if self._thread.is_alive():
+            self._queue.put(None) # blocks until the writer made room, the sentinel must not be dropped
+        self._thread.join()
+        self._thread = None
+        self._queue = None
+        self._timer.stop()
+        self.publish()
+
+    @Slot(str, object)
+    def dataReceived(self, name, array):
+        q = self._queue
+        if q is None:
+            return
+        try:
+            q.put_nowait((time.time(), name, array))
+        except queue.Full:
+            self._dropped += array.shape[0]
+
+    def run(self, writer, q):
+        last_schema = time.monotonic()
+        try:
+            while True:
+                item = q.get()
+                if item is None:
+                    break
+                t, name, array = item
+                writer.write(t, name, array)
+                self._written += array.shape[0]
+                if time.monotonic() - last_schema > self.SCHEMA_PERIOD:
+                    writer.write_schema()
+                    last_schema = time.monotonic()
+        except Exception as e:
+            logging.error(e, exc_info=True)
+        finally:
+            writer.close()
+
+    @Slot()
+    def publish(self):
+        self.set_framesWritten(self, self._written)
+        self.set_framesDropped(self, self._dropped)
@@ -0,0 +1,107 @@
+'''
+    Host to MCU command channel: the host subscribes to and unsubscribes
+    from struct streams, sets their downsample factor and requests bursts,
+    so the link only carries the streams being looked at.
+
+    Commands use the binary data framing (see FrameDecoder), the command
+    code taking the place of the stream ID:
+
+        | 0xA5 0x5A | command | 6 | stream ID | argument | CRC16 |
+          2 bytes     1 byte   1    uint16 LE   uint32 LE  uint16 LE
+
+    The CRC is CRC-16/CCITT-FALSE over command, length and payload, as for
+    data frames. Stream IDs are the binary framing's (FrameDecoder.stream_ids:
+    structs numbered in declaration order from 1, or the streamIds
+    overrides), whatever framing the MCU sends data with.
+
+    - SUBSCRIBE (0x01): send the stream, argument ignored
+    - UNSUBSCRIBE (0x02): stop sending the stream, argument ignored
+    - DOWNSAMPLE (0x03): send one frame out of 'argument' (0 or 1: all)
+    - BURST (0x04): send the next 'argument' frames of the stream, even if
+      unsubscribed or downsampled, then go back to the previous setting
+
+    Every stream is subscribed with a factor of 1 after reset. The MCU
+    doesn't answer: the host sends its whole state again when it connects,
+    and frames with a bad CRC are dropped, the MCU resyncing on the next
+    sync word. StreamControl and CommandDecoder are the MCU side, as a
+    reference for firmware and for SimulatedMcu.py.
+'''
+import struct
+import numpy as np
+import FrameDecoder
+
+SUBSCRIBE, UNSUBSCRIBE, DOWNSAMPLE, BURST = 0x01, 0x02, 0x03, 0x04
+COMMANDS = {"subscribe": SUBSCRIBE, "unsubscribe": UNSUBSCRIBE, "downsample": DOWNSAMPLE, "burst": BURST}
+PAYLOAD = struct.Struct("<HI") # stream ID, argument
+FRAME_LENGTH = len(FrameDecoder.SYNC) + 2 + PAYLOAD.size + 2
+
+def encode(command, stream_id, argument = 0):
+    body = bytes([command, PAYLOAD.size]) + PAYLOAD.pack(stream_id, argument)
+    return FrameDecoder.SYNC + body + FrameDecoder.crc16(body).to_bytes(2, 'little')
+
+class CommandDecoder(object):
+    '''
+        MCU side: feed() accepts any chunk of bytes and returns the
+        (command, stream ID, argument) of the complete frames it contains.
+    '''
+    def __init__(self):
+        self._pending = bytearray()
+        self.bad_frames = 0
+
+    def feed(self, data):
+        buf = self._pending
+        buf += data
+        commands = []
+        pos = 0
+        while True:
+            pos = buf.find(FrameDecoder.SYNC, pos)
+            if pos < 0:
+                pos = max(len(buf) - len(FrameDecoder.SYNC) + 1, 0) # a sync word may be split
+                break
+            if len(buf) - pos < FRAME_LENGTH:
+                break
+            body = bytes(buf[pos + 2:pos + FRAME_LENGTH - 2])
+            crc = int.from_bytes(buf[pos + FRAME_LENGTH - 2:pos + FRAME_LENGTH], 'little')
+            if body[1] != PAYLOAD.size or crc != FrameDecoder.crc16(body):
+                self.bad_frames += 1
+                pos += 1
+                continue
+            commands.append((body[0],) + PAYLOAD.unpack(body[2:]))
+            pos += FRAME_LENGTH
+        del buf[:pos]
+        return commands
+
+class StreamControl(object):
+    '''
+        MCU side state of one stream
+    '''
+    def __init__(self):
+        self.subscribed = True
+        self.factor = 1
+        self.phase = 0 # frames since the last one sent, modulo factor
+        self.burst = 0 # frames left to send whatever the setting
+
+    def apply(self, command, argument):
+        if command == SUBSCRIBE:
+            self.subscribed = True
+        elif command == UNSUBSCRIBE:
+            self.subscribed = False
+        elif command == DOWNSAMPLE:
+            self.factor = max(argument, 1)
+            self.phase = 0
+        elif command == BURST:
+            self.burst = argument
+
+    def select(self, count):
+        '''
+            which of the next 'count' frames produced are sent, as a boolean mask
+        '''
+        if self.subscribed:
+            keep = (self.phase + np.arange(count)) % self.factor == 0
+        else:
+            keep = np.zeros(count, bool)
+        self.phase = (self.phase + count) % self.factor
+        burst = min(self.burst, count)
+        keep[:burst] = True
+        self.burst -= burst
+        return keep
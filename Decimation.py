@@ -0,0 +1,66 @@
+import numpy as np
+
+def minmax(x, y, points):
+    '''
+        keeps the minimum and the maximum of 'y' in each of 'points'/2 buckets,
+        in time order, so peaks survive whatever the decimation factor
+    '''
+    n = y.shape[0]
+    buckets = max(points // 2, 1)
+    if n <= 2 * buckets:
+        return x, y
+    size = -(-n // buckets) # ceil
+    full = n // size
+    blocks = y[:full * size].reshape(full, size)
+    offsets = np.arange(full) * size
+    lo = blocks.argmin(axis = 1) + offsets
+    hi = blocks.argmax(axis = 1) + offsets
+    if full * size < n: # last, partial bucket
+        tail = y[full * size:]
+        lo = np.append(lo, full * size + tail.argmin())
+        hi = np.append(hi, full * size + tail.argmax())
+    indices = np.sort(np.stack([lo, hi], axis = 1), axis = 1).reshape(-1)
+    return x[indices], y[indices]
+
+def lttb(x, y, points):
+    '''
+        Largest-Triangle-Three-Buckets (Steinarsson 2013): keeps, in each bucket,
+        the point forming the largest triangle with the previously kept point
+        and the average of the next bucket. Smoother than minmax() for the
+        same number of points, but a peak may be dropped if it shares its
+        bucket with a larger one.
+    '''
+    n = y.shape[0]
+    if points < 3 or n <= points:
+        return x, y
+    xf = x.astype(np.float64)
+    yf = y.astype(np.float64)
+    edges = np.linspace(1, n - 1, points - 1).astype(np.int64) # 'points' - 2 buckets between first and last
+    sums_x = np.add.reduceat(xf[1:n - 1], edges[:-1] - 1)
+    sums_y = np.add.reduceat(yf[1:n - 1], edges[:-1] - 1)
+    counts = np.diff(edges)
+    means_x = np.append(sums_x / counts, xf[-1]) # average of each bucket, and the last point
+    means_y = np.append(sums_y / counts, yf[-1])
+
+    indices = np.empty(points, np.int64)
+    indices[0] = 0
+    indices[-1] = n - 1
+    a = 0
+    for b in range(points - 2):
+        start, stop = edges[b], edges[b + 1]
+        area = np.abs((xf[a] - means_x[b + 1]) * (yf[start:stop] - yf[a])
+                    - (xf[a] - xf[start:stop]) * (means_y[b + 1] - yf[a]))
+        a = start + int(area.argmax())
+        indices[b + 1] = a
+    return x[indices], y[indices]
+
+def none(x, y, points):
+    return x, y
+
+METHODS = {"minmax": minmax, "lttb": lttb, "none": none}
+
+def decimate(x, y, points, method = "minmax"):
+    '''
+        reduces (x, y) to about 'points' points using one of METHODS
+    '''
+    return METHODS[method](x, y, points)
@@ -0,0 +1,409 @@
+import logging
+import numpy as np
+import Layout
+import Product
+from RingBuffer import RingBuffer
+from SimpleFOCScope import SimpleFOCScope
+
+try:
+    from scipy import signal as scipy_signal # optional, much faster IIR filters
+except ImportError:
+    scipy_signal = None
+
+class Stage(Product.Product):
+    '''
+        Base class of streaming DSP products.
+        The input is the first product of 'dependsOn': a SimpleFOCScope
+        ('dataSource' and 'field' select the samples) or another Stage
+        (its output). _update() only reads the samples appended to the
+        input since the last update and hands them to process(), whose
+        result is appended to 'output', a RingBuffer with a single 'name'
+        field. If 'target' is set, the result is also sent to that
+        SimpleFOCScope as data source 'name', to be displayed.
+        Set 'autoUpdate' so the stage follows its input.
+    '''
+    def __init__(self, parent = None):
+        super(Stage, self).__init__(parent)
+        self._name = type(self).__name__.lower()
+        self._dataSource = ""
+        self._field = ""
+        self._depth = 100000
+        self._target = None
+        self._processed = 0 # samples read from the input
+        self._consumed = None # input's total at the last update
+        self.output = None
+
+    def cb_reset(self, old_value):
+        self.reset()
+
+    Product.InputProperty(vars(), str, "name", cb_reset) # output field and target data source
+    Product.InputProperty(vars(), str, "dataSource", cb_reset) # when the input is a SimpleFOCScope
+    Product.InputProperty(vars(), str, "field", cb_reset) # the first field if empty
+    Product.RWProperty(vars(), int, "depth") # output samples kept
+    Product.RWProperty(vars(), SimpleFOCScope, "target")
+    Product.ROProperty(vars(), int, "processed")
+
+    def reset(self):
+        '''
+            forgets the state kept between batches, the retained input is processed again
+        '''
+        self._consumed = None
+
+    def input_buffer(self):
+        if not self._dependsOn:
+            return None
+        source = self._dependsOn[0]
+        if isinstance(source, Stage):
+            return source.output
+        return source.buffers.get(self._dataSource)
+
+    def values(self, samples):
+        return np.asarray(Layout.channel(samples, self._field or None), np.float64)
+
+    def _update(self):
+        buffer = self.input_buffer()
+        if buffer is None:
+            return False
+        if self._consumed is not None and buffer.total - self._consumed > len(buffer):
+            logging.warning(f"{self._name}: {buffer.total - self._consumed - len(buffer)} samples were overwritten before being processed")
+            self.reset()
+        new = len(buffer) if self._consumed is None else buffer.total - self._consumed
+        self._consumed = buffer.total
+        if new <= 0:
+            return False
+        values = self.values(buffer.last(new))
+        self.set_processed(self, self._processed + values.shape[0])
+        result = self.process(values)
+        if result is None or result.shape[0] == 0:
+            return False
+        frames = np.empty(result.shape[0], np.dtype([(self._name, np.float64)]))
+        frames[self._name] = result
+        self.append_output(frames)
+        return True
+
+    def append_output(self, frames):
+        '''
+            appends 'frames' to 'output' and sends them to 'target'
+        '''
+        if self.output is None or self.output.dtype != frames.dtype:
+            self.output = RingBuffer(frames.dtype, self._depth)
+        elif self.output.depth != self._depth:
+            self.output.resize(self._depth)
+        self.output.append(frames)
+        if self._target is not None:
+            self._target.dataReceived(self._name, frames)
+
+    def process(self, values):
+        '''
+            returns the output samples for the new input 'values' (float64)
+        '''
+        raise NotImplementedError
+
+INTERPOLATIONS = ["linear", "previous"]
+
+class Align(Stage):
+    '''
+        Resamples fields of several data sources of a SimpleFOCScope (its
+        'times', see SimpleFOCScope.timestamps()) onto a common time base,
+        so channels of structs received at different rates can be overlaid
+        and combined. 'channels' lists "dataSource.field"; the time base is
+        a uniform grid of 'rate' samples/s or, if 'rate' is 0, the times of
+        the first channel's samples. 'interpolation' is "linear" or
+        "previous" (the last value at or before each time, as a backward
+        merge-asof). Each update only resamples the times after the last
+        output and up to the newest time every channel reached, so nothing
+        is extrapolated. The output has a 't' field (seconds) and a field
+        per channel, "dataSource_field". Its 't' is the target's timestamp
+        field, so it is plotted on the same time axis.
+    '''
+    def __init__(self, parent = None):
+        super(Align, self).__init__(parent)
+        self._name = "aligned"
+        self._channels = []
+        self._rate = 0.0
+        self._interpolation = "linear"
+        self.until = None # time of the last output sample
+
+    cb_reset = Stage.cb_reset
+    Product.InputProperty(vars(), list, "channels", cb_reset) # "dataSource.field"
+    Product.InputProperty(vars(), float, "rate", cb_reset) # samples/s, 0: the first channel's times
+    Product.InputProperty(vars(), str, "interpolation", cb_reset) # one of INTERPOLATIONS
+
+    def reset(self):
+        super(Align, self).reset()
+        self.until = None
+
+    def inputs(self):
+        '''
+            [(output field, times, buffer, field)] of every channel, None
+            until they all have samples
+        '''
+        scope = self._dependsOn[0] if self._dependsOn else None
+        inputs = []
+        for channel in self._channels:
+            dataSource, _, field = channel.partition(".")
+            buffer = scope.buffers.get(dataSource) if scope is not None else None
+            if buffer is None or len(buffer) == 0:
+                return None
+            name = f"{dataSource}_{field}" if field else dataSource
+            inputs.append((name, scope.times[dataSource].last(len(buffer)), buffer, field or None))
+        return inputs
+
+    def _update(self):
+        if self._interpolation not in INTERPOLATIONS:
+            raise RuntimeError(f"Unknown interpolation '{self._interpolation}', expected one of {INTERPOLATIONS}")
+        inputs = self.inputs()
+        if not inputs:
+            return False
+        oldest = max(times[0] for (_, times, _, _) in inputs)
+        newest = min(times[-1] for (_, times, _, _) in inputs)
+        if self.until is None or self.until < oldest: # start (again) at the oldest common time, included
+            since, side = oldest, 'left'
+        else:
+            since, side = self.until, 'right'
+        if self._rate > 0:
+            start = np.ceil(since * self._rate) if side == 'left' else np.floor(since * self._rate) + 1
+            base = np.arange(start, np.floor(newest * self._rate) + 1) / self._rate
+        else:
+            times = inputs[0][1]
+            base = times[np.searchsorted(times, since, side):np.searchsorted(times, newest, 'right')]
+        if base.shape[0] == 0:
+            return False
+        self.until = base[-1]
+        self.set_processed(self, self._processed + base.shape[0])
+
+        frames = np.empty(base.shape[0], np.dtype([('t', np.float64)] + [(name, np.float64) for (name, _, _, _) in inputs]))
+        frames['t'] = base
+        for (name, times, buffer, field) in inputs:
+            first = max(np.searchsorted(times, base[0], 'right') - 1, 0) # only the samples from the one before the base
+            values = np.asarray(Layout.channel(buffer.last(times.shape[0] - first), field), np.float64)
+            times = times[first:]
+            if self._interpolation == "linear":
+                frames[name] = np.interp(base, times, values)
+            else:
+                frames[name] = values[np.searchsorted(times, base, 'right') - 1]
+        if self._target is not None and self._target.timestampFields.get(self._name) != 't':
+            self._target.timestampFields = {**self._target.timestampFields, self._name: 't'}
+        self.append_output(frames)
+        return True
+
+class Filter(Stage):
+    '''
+        IIR (a != [1]) or FIR filter, b and a as in scipy.signal.lfilter.
+        The filter state is kept between batches. FIR filters are computed
+        with numpy, IIR filters with scipy if it is installed, sample by
+        sample otherwise.
+    '''
+    def __init__(self, parent = None):
+        super(Filter, self).__init__(parent)
+        self._b = [1.0]
+        self._a = [1.0]
+        self.zi = None
+
+    cb_reset = Stage.cb_reset
+    Product.InputProperty(vars(), list, "b", cb_reset)
+    Product.InputProperty(vars(), list, "a", cb_reset)
+
+    def reset(self):
+        super(Filter, self).reset()
+        self.zi = None
+
+    def process(self, values):
+        b = np.asarray(self._b, np.float64) / self._a[0]
+        a = np.asarray(self._a, np.float64) / self._a[0]
+        if a.shape[0] == 1: # FIR, the state is the last len(b) - 1 inputs
+            if self.zi is None:
+                self.zi = np.zeros(b.shape[0] - 1)
+            x = np.concatenate((self.zi, values))
+            self.zi = x[x.shape[0] - (b.shape[0] - 1):]
+            return np.convolve(x, b, 'valid')
+
+        n = max(a.shape[0], b.shape[0])
+        a = np.pad(a, (0, n - a.shape[0]))
+        b = np.pad(b, (0, n - b.shape[0]))
+        if self.zi is None:
+            self.zi = np.zeros(n - 1)
+        if scipy_signal is not None:
+            y, self.zi = scipy_signal.lfilter(b, a, values, zi = self.zi)
+            return y
+        # direct form II transposed, as lfilter
+        y = np.empty_like(values)
+        z = self.zi
+        for (i, x) in enumerate(values.tolist()):
+            out = b[0] * x + z[0]
+            z[:-1] = z[1:] + b[1:-1] * x - a[1:-1] * out
+            z[-1] = b[-1] * x - a[-1] * out
+            y[i] = out
+        return y
+
+class MovingAverage(Stage):
+    '''
+        Mean of the last 'window' samples, only the new samples are summed.
+    '''
+    def __init__(self, parent = None):
+        super(MovingAverage, self).__init__(parent)
+        self._window = 16
+        self.history = np.empty(0)
+
+    cb_reset = Stage.cb_reset
+    Product.InputProperty(vars(), int, "window", cb_reset)
+
+    def reset(self):
+        super(MovingAverage, self).reset()
+        self.history = np.empty(0)
+
+    def transform(self, values):
+        return values
+
+    def process(self, values):
+        w = max(self._window, 1)
+        x = np.concatenate((self.history, self.transform(values)))
+        self.history = x[max(x.shape[0] - (w - 1), 0):]
+        if x.shape[0] < w:
+            return None
+        c = np.concatenate(([0.0], np.cumsum(x)))
+        return (c[w:] - c[:-w]) / w
+
+class MovingRms(MovingAverage):
+    '''
+        Root mean square of the last 'window' samples.
+    '''
+    def transform(self, values):
+        return values * values
+
+    def process(self, values):
+        mean = super(MovingRms, self).process(values)
+        return None if mean is None else np.sqrt(np.maximum(mean, 0.0))
+
+class Decimate(Stage):
+    '''
+        Mean of each block of 'factor' samples (a boxcar anti-aliasing
+        filter), the incomplete block is kept for the next batch.
+    '''
+    def __init__(self, parent = None):
+        super(Decimate, self).__init__(parent)
+        self._factor = 10
+        self.remainder = np.empty(0)
+
+    cb_reset = Stage.cb_reset
+    Product.InputProperty(vars(), int, "factor", cb_reset)
+
+    def reset(self):
+        super(Decimate, self).reset()
+        self.remainder = np.empty(0)
+
+    def process(self, values):
+        factor = max(self._factor, 1)
+        x = np.concatenate((self.remainder, values))
+        n = x.shape[0] // factor * factor
+        self.remainder = x[n:]
+        return x[:n].reshape(-1, factor).mean(axis = 1)
+
+class Derivative(Stage):
+    '''
+        (x[i] - x[i-1]) * rate, e.g. velocity (rad/s) from angle (rad) with
+        'rate' the sample rate. If 'period' is set (e.g. 2 pi for a wrapped
+        angle), differences are wrapped into [-period/2, period/2).
+    '''
+    def __init__(self, parent = None):
+        super(Derivative, self).__init__(parent)
+        self._rate = 1.0
+        self._period = 0.0
+        self.previous = None
+
+    cb_reset = Stage.cb_reset
+    Product.InputProperty(vars(), float, "rate") # samples/s
+    Product.InputProperty(vars(), float, "period", cb_reset)
+
+    def reset(self):
+        super(Derivative, self).reset()
+        self.previous = None
+
+    def process(self, values):
+        x = values if self.previous is None else np.concatenate(([self.previous], values))
+        self.previous = values[-1]
+        d = np.diff(x)
+        if self._period > 0:
+            d = (d + self._period / 2) % self._period - self._period / 2
+        return d * self._rate
+
+WINDOWS = {
+    "rect": np.ones,
+    "hann": np.hanning,
+    "hamming": np.hamming,
+    "blackman": np.blackman,
+}
+
+class Spectrum(Stage):
+    '''
+        Power spectral density (one-sided, units^2/Hz) of overlapping
+        'size'-sample frames, averaged exponentially ('averaging' is the
+        weight of the newest frame, 1: no averaging). All the frames
+        completed by a batch go through a single rfft; the samples of the
+        incomplete frame are kept for the next batch. The result is 'psd'
+        and 'freqs', published to QML as 'spectrum' and 'frequencies'.
+    '''
+    def __init__(self, parent = None):
+        super(Spectrum, self).__init__(parent)
+        self._size = 1024
+        self._overlap = 0.5
+        self._window = "hann"
+        self._rate = 1000.0
+        self._averaging = 0.2
+        self._spectrum = []
+        self._frequencies = []
+        self._peakFrequency = 0.0
+        self._frames = 0
+        self.pending = np.empty(0)
+        self.psd = None
+        self.freqs = None
+
+    cb_reset = Stage.cb_reset
+    Product.InputProperty(vars(), int, "size", cb_reset) # samples per frame
+    Product.InputProperty(vars(), float, "overlap", cb_reset) # fraction of a frame, [0, 1)
+    Product.InputProperty(vars(), str, "window", cb_reset) # one of WINDOWS
+    Product.InputProperty(vars(), float, "rate", cb_reset) # samples/s
+    Product.InputProperty(vars(), float, "averaging")
+
+    Product.ROProperty(vars(), list, "spectrum")
+    Product.ROProperty(vars(), list, "frequencies") # Hz
+    Product.ROProperty(vars(), float, "peakFrequency") # Hz, DC excluded
+    Product.ROProperty(vars(), int, "frames") # frames transformed
+
+    def reset(self):
+        super(Spectrum, self).reset()
+        self.pending = np.empty(0)
+        self.psd = None
+
+    def _update(self):
+        frames = self._frames
+        super(Spectrum, self)._update() # False: process() has no output samples
+        return self._frames != frames # 'spectrum' changed
+
+    def process(self, values):
+        size = max(self._size, 2)
+        hop = max(int(round(size * (1.0 - self._overlap))), 1)
+        x = np.concatenate((self.pending, values))
+        count = (x.shape[0] - size) // hop + 1 if x.shape[0] >= size else 0
+        self.pending = x[count * hop:]
+        if count == 0:
+            return None
+
+        window = WINDOWS[self._window](size)
+        frames = np.lib.stride_tricks.sliding_window_view(x, size)[::hop][:count]
+        power = np.abs(np.fft.rfft(frames * window, axis = 1)) ** 2 / (self._rate * np.sum(window * window))
+        power[:, 1:(size + 1) // 2] *= 2 # one-sided: fold the negative frequencies (not DC nor Nyquist)
+
+        if self.psd is None:
+            self.psd, power = power[0], power[1:]
+        # exponential average of the frames in order: frame k of n weighs alpha (1 - alpha)^(n - 1 - k)
+        alpha = min(max(self._averaging, 0.0), 1.0)
+        weights = alpha * (1.0 - alpha) ** np.arange(power.shape[0] - 1, -1, -1)
+        self.psd = (1.0 - alpha) ** power.shape[0] * self.psd + weights @ power
+        self.freqs = np.fft.rfftfreq(size, 1.0 / self._rate)
+        self.set_frames(self, self._frames + count)
+        self.set_spectrum(self, self.psd.tolist())
+        if len(self._frequencies) != self.freqs.shape[0]:
+            self.set_frequencies(self, self.freqs.tolist())
+        self.set_peakFrequency(self, float(self.freqs[1 + np.argmax(self.psd[1:])]) if size > 2 else 0.0)
+        return None
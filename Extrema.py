@@ -0,0 +1,79 @@
+import numpy as np
+import Layout
+from RingBuffer import RingBuffer
+
+class BlockExtrema(object):
+    '''
+        Per-block min/max summaries of a RingBuffer.
+        Blocks are 'block' samples long and aligned on absolute sample indices
+        (RingBuffer.total). Summaries are kept per channel (Layout.channels). The range of any window is the combination of the
+        summaries of the whole blocks it covers and of at most two partial
+        blocks read from the samples, i.e. O(window / block + block) instead
+        of O(window).
+    '''
+    def __init__(self, samples, block = 256):
+        self.samples = samples
+        self.block = block
+        self.blocks = 0 # number of blocks summarized so far
+        self.mins = None
+        self.maxs = None
+
+    def _depth(self):
+        return -(-self.samples.depth // self.block) + 1
+
+    def update(self):
+        '''
+            summarizes the blocks completed since the last call, to be called
+            after samples are appended
+        '''
+        if self.mins is None:
+            self.mins = RingBuffer(Layout.flat_dtype(self.samples.dtype), self._depth())
+            self.maxs = RingBuffer(Layout.flat_dtype(self.samples.dtype), self._depth())
+        elif self.mins.depth != self._depth():
+            self.mins.resize(self._depth())
+            self.maxs.resize(self._depth())
+
+        total = self.samples.total
+        first = max(self.blocks, -(-(total - len(self.samples)) // self.block)) # older blocks were overwritten
+        last = total // self.block
+        if last <= first:
+            self.blocks = max(self.blocks, last)
+            return
+        data = self.samples.last(total - first * self.block)[:(last - first) * self.block]
+        data = data.reshape(last - first, self.block)
+        mins = np.empty(last - first, self.mins.dtype)
+        maxs = np.empty(last - first, self.maxs.dtype)
+        for name in self.mins.dtype.names:
+            values = Layout.channel(data, name)
+            mins[name] = values.min(axis = 1)
+            maxs[name] = values.max(axis = 1)
+        if first > self.blocks: # blocks skipped, the summaries wouldn't be contiguous
+            self.mins.clear()
+            self.maxs.clear()
+        self.mins.append(mins)
+        self.maxs.append(maxs)
+        self.blocks = last
+
+    def range(self, label, n):
+        '''
+            (min, max) of channel 'label' over the 'n' most recent samples
+        '''
+        label = Layout.resolve(self.samples.dtype, label)
+        total = self.samples.total
+        n = min(n, len(self.samples))
+        if n == 0:
+            return None
+        start = total - n
+        last = self.blocks
+        first = max(-(-start // self.block), last - (len(self.mins) if self.mins is not None else 0))
+        if last - first < 2: # not worth it
+            window = Layout.channel(self.samples.last(n), label)
+            return window.min(), window.max()
+
+        head = Layout.channel(self.samples.last(n), label)[:first * self.block - start]
+        tail = Layout.channel(self.samples.last(total - last * self.block), label)
+        lo = self.mins.last(last - first)[label]
+        hi = self.maxs.last(last - first)[label]
+        parts_lo = [lo.min()] + [p.min() for p in (head, tail) if p.size > 0]
+        parts_hi = [hi.max()] + [p.max() for p in (head, tail) if p.size > 0]
+        return min(parts_lo), max(parts_hi)
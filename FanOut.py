@@ -0,0 +1,322 @@
+'''
+    Publishes the frames decoded by SerialPortListeners to any number of
+    local processes (notebooks, logging daemons, a second display) over a
+    TCP or Unix socket, since only one process can open the serial port.
+    See FanOutClient for the protocol and a client.
+'''
+import collections
+import json
+import logging
+import os
+import selectors
+import socket
+import stat
+import threading
+import numpy as np
+from PySide6.QtCore import QCoreApplication, QObject, QTimer, Slot
+import FanOutClient
+import HeaderCache
+import Product
+
+def advance(buffers, n):
+    '''
+        what is left of 'buffers' once their first 'n' bytes are sent
+    '''
+    while buffers and n >= len(buffers[0]):
+        n -= len(buffers[0])
+        buffers = buffers[1:]
+    if buffers and n:
+        buffers = [buffers[0][n:]] + buffers[1:]
+    return buffers
+
+class Connection(object):
+    '''
+        'queue' holds the (frames, bytes, buffers) of the messages not sent
+        yet, frames being None for schemas, and is only used under the
+        server's lock. 'sending' is what is left of the message being sent,
+        only used by the server thread.
+    '''
+    def __init__(self, sock):
+        self.socket = sock
+        self.queue = collections.deque()
+        self.queued = 0 # bytes
+        self.sending = None
+        self.frames = 0 # of the message being sent
+        self.dropped = 0
+        self.events = selectors.EVENT_READ
+
+class SimpleFOCFanOut(QObject):
+    '''
+        dataReceived() is meant to be called from the listener threads
+        (Qt.DirectConnection): it only queues memoryviews of the decoded
+        arrays for each client, nothing is copied or serialized. A server
+        thread accepts clients and sends the queued messages with
+        non-blocking sendmsg() calls, as fast as each client reads them.
+        Beyond 'maxQueue' bytes queued for a client, its oldest frames are
+        dropped and counted: a client that doesn't keep up loses frames but
+        never slows ingest, the GUI or the other clients down.
+    '''
+    def __init__(self, parent = None):
+        super(SimpleFOCFanOut, self).__init__(parent)
+        self._address = ""
+        self._serving = False
+        self._maxQueue = 8 << 20
+        self._clients = 0
+        self._framesSent = 0
+        self._framesDropped = 0
+        self._error = ""
+        self.schemas = {} # name -> (dtype, schema message payload)
+        self._lock = threading.Lock()
+        self._connections = {} # socket -> Connection
+        self._thread = None
+        self._wakeup = None # (read, write) ends of a pipe
+        self._signalled = False # a byte is in the pipe
+        self._stop = False
+        self._sent = 0 # updated by the server thread, published by _timer
+        self._dropped = 0
+        self._timer = QTimer(self)
+        self._timer.setInterval(500)
+        self._timer.timeout.connect(self.publish)
+        app = QCoreApplication.instance()
+        if app is not None:
+            app.aboutToQuit.connect(self.stop)
+
+    def cb_address(self, old_value):
+        if self._thread is not None:
+            self.stop()
+            self.start()
+
+    Product.RWProperty(vars(), str, "address", cb_address) # "host:port" (TCP, localhost if no host) or a Unix socket path
+    Product.RWProperty(vars(), int, "maxQueue") # bytes queued per client
+
+    def cb_serving(self, old_value):
+        if self._serving:
+            self.start()
+        else:
+            self.stop()
+
+    Product.RWProperty(vars(), bool, "serving", cb_serving)
+
+    Product.ROProperty(vars(), int, "clients")
+    Product.ROProperty(vars(), int, "framesSent")
+    Product.ROProperty(vars(), int, "framesDropped")
+    Product.ROProperty(vars(), str, "error")
+
+    def start(self):
+        if self._thread is not None:
+            return
+        server = None
+        try:
+            if not self._address:
+                raise RuntimeError("No address to serve on")
+            server, target = FanOutClient.make_socket(self._address)
+            if server.family == socket.AF_UNIX:
+                if os.path.exists(target) and stat.S_ISSOCK(os.stat(target).st_mode): # left by a previous run
+                    os.remove(target)
+            else:
+                server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            server.bind(target)
+            server.listen()
+            server.setblocking(False)
+        except Exception as e:
+            if server is not None:
+                server.close()
+            logging.error(e, exc_info=True)
+            self.set_error(self, str(e))
+            return
+        self.set_error(self, "")
+        self._sent = self._dropped = 0
+        self._stop = False
+        self._wakeup = os.pipe()
+        os.set_blocking(self._wakeup[1], False)
+        self._thread = threading.Thread(target = self.run, args = (server, target), daemon = True)
+        self._thread.start()
+        self._timer.start()
+
+    @Slot()
+    def stop(self):
+        if self._thread is None:
+            return
+        self._stop = True
+        self.wake()
+        self._thread.join()
+        self._thread = None
+        for fd in self._wakeup:
+            os.close(fd)
+        self._wakeup = None
+        self._signalled = False
+        self._timer.stop()
+        self.publish()
+
+    def wake(self):
+        if not self._signalled:
+            self._signalled = True
+            try:
+                os.write(self._wakeup[1], b'\0')
+            except BlockingIOError:
+                pass
+
+    @Slot(str, object, float, float)
+    def dataReceived(self, name, array, t_read = 0.0, t_decode = 0.0):
+        if self._thread is None or not self._connections:
+            return
+        name_bytes = name.encode()
+        payload = memoryview(np.ascontiguousarray(array).reshape(-1).view(np.uint8)) # the decoders' arrays aren't reused, shared by all the clients
+        frames = array.shape[0]
+        with self._lock:
+            schema = self.schema(name, array.dtype)
+            for connection in self._connections.values():
+                if schema is not None:
+                    self.enqueue(connection, None, schema)
+                if not self.make_room(connection, len(payload), frames):
+                    continue
+                header = FanOutClient.HEADER.pack(FanOutClient.FRAMES, len(name_bytes), len(payload), connection.dropped, t_read, t_decode)
+                self.enqueue(connection, frames, [memoryview(header), memoryview(name_bytes), payload])
+        self.wake()
+
+    def schema(self, name, dtype):
+        '''
+            the schema message of a stream seen for the first time or whose
+            dtype changed (headers parsed again), None otherwise
+        '''
+        known = self.schemas.get(name)
+        if known is not None and known[0] == dtype:
+            return None
+        self.schemas[name] = (dtype, json.dumps(HeaderCache.dtype_to_json(dtype)).encode())
+        return self.schema_message(name)
+
+    def schema_message(self, name):
+        name_bytes = name.encode()
+        payload = self.schemas[name][1]
+        header = FanOutClient.HEADER.pack(FanOutClient.SCHEMA, len(name_bytes), len(payload), 0, 0.0, 0.0)
+        return [memoryview(header), memoryview(name_bytes), memoryview(payload)]
+
+    def enqueue(self, connection, frames, buffers):
+        size = sum(len(b) for b in buffers)
+        connection.queue.append((frames, size, buffers))
+        connection.queued += size
+
+    def make_room(self, connection, size, frames):
+        '''
+            drops the oldest frames queued for 'connection' until 'size'
+            more bytes fit, schemas are kept. Returns False, dropping the
+            new frames instead, if they don't fit alone.
+        '''
+        if connection.queued + size <= self._maxQueue:
+            return True
+        kept = collections.deque()
+        for item in connection.queue:
+            if item[0] is not None and connection.queued + size > self._maxQueue:
+                connection.queued -= item[1]
+                connection.dropped += item[0]
+                self._dropped += item[0]
+            else:
+                kept.append(item)
+        connection.queue = kept
+        if connection.queued + size > self._maxQueue:
+            connection.dropped += frames
+            self._dropped += frames
+            return False
+        return True
+
+    def run(self, server, target):
+        selector = selectors.DefaultSelector()
+        selector.register(server, selectors.EVENT_READ)
+        selector.register(self._wakeup[0], selectors.EVENT_READ)
+        try:
+            while not self._stop:
+                for (key, events) in selector.select():
+                    if key.fileobj is server:
+                        self.accept(server, selector)
+                    elif key.fileobj == self._wakeup[0]:
+                        self._signalled = False # before reading, so messages queued meanwhile wake again
+                        os.read(self._wakeup[0], 4096)
+                    else:
+                        alive = not events & selectors.EVENT_READ or self.receive(key.data)
+                        if alive and events & selectors.EVENT_WRITE:
+                            alive = self.send(key.data)
+                        if not alive:
+                            self.disconnect(key.data, selector)
+                with self._lock:
+                    connections = list(self._connections.values())
+                    pending = [c.sending is not None or len(c.queue) > 0 for c in connections]
+                for (connection, writing) in zip(connections, pending):
+                    events = selectors.EVENT_READ | (selectors.EVENT_WRITE if writing else 0)
+                    if events != connection.events:
+                        connection.events = events
+                        selector.modify(connection.socket, events, connection)
+        except Exception as e:
+            logging.error(e, exc_info=True)
+        finally:
+            for connection in list(self._connections.values()):
+                self.disconnect(connection, selector)
+            selector.close()
+            server.close()
+            if server.family == socket.AF_UNIX:
+                try:
+                    os.remove(target)
+                except OSError:
+                    pass
+
+    def accept(self, server, selector):
+        try:
+            sock, _ = server.accept()
+        except BlockingIOError:
+            return
+        sock.setblocking(False)
+        if sock.family != socket.AF_UNIX:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        connection = Connection(sock)
+        selector.register(sock, connection.events, connection)
+        with self._lock:
+            for name in self.schemas:
+                self.enqueue(connection, None, self.schema_message(name))
+            self._connections[sock] = connection
+
+    def receive(self, connection):
+        '''
+            clients don't send anything, returns False once they disconnect
+        '''
+        try:
+            return len(connection.socket.recv(4096)) > 0
+        except BlockingIOError:
+            return True
+        except OSError:
+            return False
+
+    def send(self, connection):
+        '''
+            sends queued messages until the socket's buffer is full, returns
+            False if the client is gone
+        '''
+        while True:
+            if connection.sending is None:
+                with self._lock:
+                    if not connection.queue:
+                        return True
+                    frames, size, buffers = connection.queue.popleft()
+                    connection.queued -= size
+                connection.sending, connection.frames = buffers, frames
+            try:
+                n = connection.socket.sendmsg(connection.sending)
+            except BlockingIOError:
+                return True
+            except OSError:
+                return False
+            connection.sending = advance(connection.sending, n)
+            if connection.sending:
+                return True
+            connection.sending = None
+            self._sent += connection.frames or 0
+
+    def disconnect(self, connection, selector):
+        with self._lock:
+            self._connections.pop(connection.socket, None)
+        selector.unregister(connection.socket)
+        connection.socket.close()
+
+    @Slot()
+    def publish(self):
+        self.set_clients(self, len(self._connections))
+        self.set_framesSent(self, self._sent)
+        self.set_framesDropped(self, self._dropped)
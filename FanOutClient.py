@@ -0,0 +1,112 @@
+# This Python file uses the following encoding: utf-8
+'''
+    Client of the fan-out server (see FanOut): receives the frames decoded
+    by a running scope as numpy structured arrays. Only needs numpy, to be
+    usable from notebooks and other tools.
+
+    Every message is a HEADER, the stream (struct) name and a payload:
+
+        | kind | 0 | name length | payload length | dropped | t_read | t_decode |
+          uint8     uint16        uint32           uint64    float64  float64
+
+    all little endian. 'dropped' is the number of frames the server dropped
+    for this client so far because it didn't keep up, t_read and t_decode
+    the time.monotonic() of the scope at read and decode.
+    - SCHEMA: the payload is the dtype of the stream, as JSON
+      (HeaderCache.dtype_to_json). Sent for every stream when the client
+      connects and whenever a stream appears or its dtype changes, never
+      dropped, always before the stream's frames.
+    - FRAMES: the payload is the raw frames.
+
+    usage: python FanOutClient.py <host:port | unix socket path> [--duration 0]
+'''
+import argparse
+import json
+import socket
+import struct
+import sys
+import time
+import numpy as np
+import HeaderCache
+
+SCHEMA, FRAMES = 1, 2
+HEADER = struct.Struct("<BxHIQdd") # kind, name length, payload length, dropped, t_read, t_decode
+
+def make_socket(address):
+    '''
+        a socket for 'address', "host:port" (TCP) or a path (Unix socket),
+        and the address to bind or connect it to
+    '''
+    host, _, port = address.rpartition(':')
+    if port.isdigit():
+        return socket.socket(socket.AF_INET, socket.SOCK_STREAM), (host or "localhost", int(port))
+    return socket.socket(socket.AF_UNIX, socket.SOCK_STREAM), address
+
+class FanOutClient(object):
+    '''
+        receive() blocks until the next batch of frames and returns
+        (name, frames, t_read, t_decode). 'dtypes' holds the schemas
+        received so far, 'dropped' the frames the server dropped for us.
+    '''
+    def __init__(self, address, timeout = None):
+        self.socket, target = make_socket(address)
+        self.socket.settimeout(timeout)
+        self.socket.connect(target)
+        self.dtypes = {}
+        self.dropped = 0
+        self._header = bytearray(HEADER.size)
+
+    def read(self, size):
+        buffer = bytearray(size)
+        view = memoryview(buffer)
+        position = 0
+        while position < size:
+            n = self.socket.recv_into(view[position:])
+            if n == 0:
+                raise ConnectionError("the server closed the connection")
+            position += n
+        return buffer
+
+    def receive(self):
+        while True:
+            kind, name_length, length, self.dropped, t_read, t_decode = HEADER.unpack(self.read(HEADER.size))
+            name = self.read(name_length).decode()
+            payload = self.read(length)
+            if kind == SCHEMA:
+                self.dtypes[name] = HeaderCache.dtype_from_json(json.loads(payload))
+            elif kind == FRAMES:
+                return name, np.frombuffer(payload, self.dtypes[name]), t_read, t_decode # no copy, owns the bytes
+
+    def __iter__(self):
+        while True:
+            yield self.receive()
+
+    def close(self):
+        self.socket.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("address", help = "the scope's fanOut address")
+    parser.add_argument("--duration", type = float, default = 0.0, help = "seconds, 0: until interrupted")
+    args = parser.parse_args()
+
+    counts = {}
+    start = last = time.monotonic()
+    try:
+        with FanOutClient(args.address) as client:
+            for (name, frames, t_read, t_decode) in client:
+                counts[name] = counts.get(name, 0) + frames.shape[0]
+                if time.monotonic() - last >= 1.0:
+                    last = time.monotonic()
+                    print(", ".join(f"{name}: {count} frames" for (name, count) in counts.items()) + f", dropped: {client.dropped}", flush = True)
+                if args.duration > 0 and time.monotonic() - start >= args.duration:
+                    break
+    except KeyboardInterrupt:
+        pass
+    sys.exit(0)
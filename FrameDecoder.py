@@ -0,0 +1,368 @@
+import binascii
+import logging
+import numpy as np
+
+SYNC = b'\xa5\x5a'
+CRC_INIT = 0xFFFF
+
+def run_length(raw, pos, header_length, frame_length):
+    '''
+        number of consecutive complete frames starting at 'pos' in 'raw' that
+        have the same 'header_length' first bytes, checked vectorised on a
+        growing number of frames so interleaved streams don't pay for a full
+        scan on each frame
+    '''
+    available = (raw.shape[0] - pos) // frame_length
+    header = raw[pos:pos + header_length]
+    run = 1
+    probe = 8
+    while run < available:
+        count = min(probe, available) - run
+        frames = raw[pos + run * frame_length:pos + (run + count) * frame_length].reshape(count, frame_length)
+        same = (frames[:, :header_length] == header).all(axis = 1)
+        if not same.all():
+            return run + int(same.argmin())
+        run += count
+        probe *= 4
+    return run
+
+def payload_bytes(array):
+    array = np.ascontiguousarray(array).reshape(-1)
+    return array.view(np.uint8).reshape(array.shape[0], array.dtype.itemsize)
+
+def crc16(data):
+    '''
+        CRC-16/CCITT-FALSE (poly 0x1021, init 0xFFFF), as computed by the MCU
+    '''
+    return binascii.crc_hqx(data, CRC_INIT)
+
+def _crc16_table():
+    table = np.arange(256, dtype = np.uint32) << 8
+    for _ in range(8):
+        table = np.where(table & 0x8000, (table << 1) ^ 0x1021, table << 1) & 0xFFFF
+    return table.astype(np.uint16)
+
+CRC_TABLE = _crc16_table()
+
+def crc16_rows(rows):
+    '''
+        crc16() of each row of a 2D uint8 array.
+        The table-driven version costs a few numpy operations per column, it is
+        only used when there are many more rows than columns.
+    '''
+    count, width = rows.shape
+    if count < 8 * width:
+        data = rows.tobytes()
+        return np.fromiter((crc16(data[i:i + width]) for i in range(0, count * width, width)), np.uint16, count)
+    crc = np.full(count, CRC_INIT, np.uint16)
+    for j in range(width):
+        crc = (crc << 8) ^ CRC_TABLE[(crc >> 8) ^ rows[:, j]]
+    return crc
+
+def ascii_frames(name, array):
+    '''
+        encodes 'array' as ASCII frames, as the MCU would send them
+    '''
+    header = np.frombuffer(f"{name}\n".encode("ascii"), np.uint8)
+    payload = payload_bytes(array)
+    frames = np.empty((payload.shape[0], header.shape[0] + payload.shape[1]), np.uint8)
+    frames[:, :header.shape[0]] = header
+    frames[:, header.shape[0]:] = payload
+    return frames.tobytes()
+
+MAX_PAYLOAD = 0x7FFF # the length, 2 bytes with the high bit set
+MAX_STREAM_ID = 0x7FFF # 2 bytes, high bit set
+
+def varint(value):
+    '''
+        1 byte if 'value' < 0x80, else 2 bytes, big endian, high bit set:
+        the encoding of stream IDs and lengths
+    '''
+    if value < 0x80:
+        return bytes([value])
+    return bytes([0x80 | (value >> 8), value & 0xFF])
+
+def binary_header(stream_id, length):
+    return SYNC + varint(stream_id) + varint(length)
+
+def binary_frames(stream_id, array, batch = 1):
+    '''
+        encodes 'array' as binary frames, as the MCU would send them, up to
+        'batch' consecutive structs per frame
+    '''
+    payload = payload_bytes(array)
+    count, itemsize = payload.shape
+    batch = max(min(batch, MAX_PAYLOAD // max(itemsize, 1)), 1)
+    full = count // batch * batch
+    chunks = [payload[:full].reshape(-1, batch * itemsize), payload[full:].reshape(1, -1)] if full < count else [payload.reshape(-1, batch * itemsize)]
+    encoded = []
+    for rows in chunks:
+        header = np.frombuffer(binary_header(stream_id, rows.shape[1]), np.uint8)
+        frames = np.empty((rows.shape[0], header.shape[0] + rows.shape[1] + 2), np.uint8)
+        frames[:, :header.shape[0]] = header
+        frames[:, header.shape[0]:-2] = rows
+        crcs = crc16_rows(frames[:, len(SYNC):-2])
+        frames[:, -2] = crcs & 0xFF
+        frames[:, -1] = crcs >> 8
+        encoded.append(frames.tobytes())
+    return b''.join(encoded)
+_warned = set() # (struct name, reason) already logged by stream_ids()
+
+def stream_ids(dtypes, overrides = None):
+    '''
+        maps binary stream IDs to (struct name, dtype).
+        IDs are assigned in declaration order, starting at 1 and skipping
+        empty (forward declared) structs, unless given in 'overrides'
+        ({struct name: ID}). Structs larger than MAX_PAYLOAD and overrides
+        above MAX_STREAM_ID can't be framed, they are skipped with a warning.
+    '''
+    def fits(name, dtype, stream_id = None):
+        reason = None
+        if dtype.itemsize > MAX_PAYLOAD:
+            reason = f"{dtype.itemsize} bytes, the binary framing carries at most {MAX_PAYLOAD}"
+        elif stream_id is not None and not 0 <= stream_id <= MAX_STREAM_ID:
+            reason = f"stream ID {stream_id} is not in [0, {MAX_STREAM_ID}]"
+        if reason is not None and (name, reason) not in _warned:
+            _warned.add((name, reason))
+            logging.warning(f"Struct {name} skipped by the binary framing: {reason}")
+        return reason is None
+
+    overrides = overrides or {}
+    streams = {int(i): (name, dtypes[name]) for (name, i) in overrides.items() if name in dtypes and fits(name, dtypes[name], int(i))}
+    next_id = 1
+    for (name, dtype) in dtypes.items():
+        if name in overrides or dtype.itemsize == 0 or not fits(name, dtype):
+            continue
+        while next_id in streams:
+            next_id += 1
+        if not fits(name, dtype, next_id):
+            break
+        streams[next_id] = (name, dtype)
+    return streams
+
+class AsciiFrameDecoder(object):
+    '''
+        Decodes the ASCII framing sent by the MCU: a header line holding the
+        struct name (e.g. 'Demo\\n') followed by the raw struct bytes.
+        feed() accepts any chunk of bytes, decodes every complete frame it
+        contains and keeps the trailing partial frame for the next call.
+    '''
+    MAX_HEADER_LENGTH = 256 # longer lines can't be a header, they are garbage
+    MAX_WARNINGS = 16 # distinct unknown headers logged, the others are only counted in bad_frames
+
+    def __init__(self, dtypes):
+        self.dtypes = dtypes
+        self._pending = bytearray()
+        self._headers = {} # raw header line -> (name, dtype), known structs only
+        self._unknown = set() # unknown headers already logged
+        self.frames = 0
+        self.bad_frames = 0
+        self.dropped_bytes = 0
+
+    def match(self, line):
+        '''
+            (name, dtype) of the struct of header 'line', None if unknown.
+            Misses aren't cached, garbage would fill the cache.
+        '''
+        entry = self._headers.get(line)
+        if entry is not None:
+            return entry
+        name = line.rstrip().decode("ascii", "replace")
+        if name not in self.dtypes:
+            if name and name not in self._unknown and len(self._unknown) < self.MAX_WARNINGS:
+                self._unknown.add(name)
+                last = len(self._unknown) == self.MAX_WARNINGS
+                logging.warning(f"Header '{name}' not reckognized" + (", further unknown headers are only counted in bad_frames" if last else ""))
+            return None
+        entry = self._headers[line] = (name, self.dtypes[name])
+        return entry
+
+    def feed(self, data):
+        '''
+            returns a {struct name: structured array} dict with one array per
+            struct type found in the (previously pending) bytes
+        '''
+        buf = self._pending
+        buf += data
+        n = len(buf)
+        pos = 0
+        payloads = {}
+        frames = None
+        raw = np.frombuffer(buf, np.uint8)
+        while True:
+            eol = buf.find(b'\n', pos)
+            if eol < 0:
+                if n - pos > self.MAX_HEADER_LENGTH:
+                    self.dropped_bytes += n - pos
+                    pos = n
+                break
+            entry = self.match(bytes(buf[pos:eol]))
+            if entry is None:
+                self.bad_frames += 1
+                self.dropped_bytes += eol + 1 - pos
+                pos = eol + 1
+                continue
+            name, dtype = entry
+            header_length = eol + 1 - pos
+            frame_length = header_length + dtype.itemsize
+            if pos + frame_length > n:
+                break # incomplete frame, wait for more bytes
+            run = run_length(raw, pos, header_length, frame_length)
+            frames = raw[pos:pos + run * frame_length].reshape(run, frame_length)
+            if name in payloads:
+                payloads[name].append(frames[:, header_length:])
+            else:
+                payloads[name] = [frames[:, header_length:]]
+            pos += run * frame_length
+
+        batch = {name: self._join(name, parts) for (name, parts) in payloads.items()}
+        del payloads, raw, frames # drop the views, the buffer can't be resized while they are alive
+        del buf[:pos]
+        return batch
+
+    def _join(self, name, parts):
+        payload = np.concatenate(parts) # copies out of the pending buffer
+        self.frames += payload.shape[0]
+        return payload.view(self.dtypes[name]).reshape(-1)
+
+    def reset(self):
+        self._pending.clear()
+
+
+class BinaryFrameDecoder(object):
+    '''
+        Decodes the binary framing:
+            sync word 0xA5 0x5A
+            stream ID, 1 byte if < 0x80, else 2 bytes (big endian, high bit set)
+            payload length, encoded as the stream ID
+            payload, the raw bytes of one or more consecutive structs
+            CRC-16/CCITT-FALSE of ID, length and payload, little endian
+        Bytes that don't belong to a valid frame are skipped by searching for the
+        next sync word, so a corrupted frame costs at most itself. 'frames'
+        counts structs, 'bad_frames' frames.
+    '''
+    def __init__(self, dtypes, overrides = None):
+        self.dtypes = dtypes
+        self.streams = stream_ids(dtypes, overrides)
+        self._pending = bytearray()
+        self._unknown = set()
+        self.frames = 0
+        self.bad_frames = 0
+        self.dropped_bytes = 0
+
+    def feed(self, data):
+        '''
+            returns a {struct name: structured array} dict with one array per
+            stream found in the (previously pending) bytes
+        '''
+        buf = self._pending
+        buf += data
+        n = len(buf)
+        pos = 0
+        payloads = {}
+        frames = part = None
+        raw = np.frombuffer(buf, np.uint8)
+        while True:
+            start = buf.find(SYNC, pos)
+            if start < 0:
+                keep = n - 1 if n > pos and buf[-1] == SYNC[0] else n # may be the first half of a sync word
+                self.dropped_bytes += keep - pos
+                pos = keep
+                break
+            self.dropped_bytes += start - pos
+            pos = start
+
+            header_length = len(SYNC) + 2
+            if pos + header_length > n:
+                break
+            stream_id = buf[pos + len(SYNC)]
+            if stream_id & 0x80:
+                header_length += 1
+                if pos + header_length > n:
+                    break
+                stream_id = ((stream_id & 0x7F) << 8) | buf[pos + len(SYNC) + 1]
+            length = buf[pos + header_length - 1]
+            if length & 0x80:
+                header_length += 1
+                if pos + header_length > n:
+                    break
+                length = ((length & 0x7F) << 8) | buf[pos + header_length - 1]
+            entry = self.streams.get(stream_id)
+            if entry is not None and (length == 0 or length % entry[1].itemsize):
+                self.bad_frames += 1 # not a whole number of structs: corrupted, don't wait for it
+                self.dropped_bytes += 1
+                pos += 1
+                continue
+            frame_length = header_length + length + 2
+            if pos + frame_length > n:
+                break # incomplete frame, wait for more bytes
+
+            if not self.check(raw[pos:pos + frame_length]):
+                self.bad_frames += 1
+                self.dropped_bytes += 1
+                pos += 1 # corrupted, resync on the next sync word
+                continue
+
+            if entry is None:
+                if stream_id not in self._unknown:
+                    self._unknown.add(stream_id)
+                    logging.warning(f"Stream {stream_id} ({length} bytes) not reckognized")
+                self.bad_frames += 1
+                self.dropped_bytes += frame_length
+                pos += frame_length
+                continue
+
+            name = entry[0]
+            structs = length // entry[1].itemsize
+            run = run_length(raw, pos, header_length, frame_length)
+            frames = raw[pos:pos + run * frame_length].reshape(run, frame_length)
+            if run > 1:
+                received = frames[:, -2].astype(np.uint16) | (frames[:, -1].astype(np.uint16) << 8)
+                good = crc16_rows(frames[:, len(SYNC):-2]) == received
+                if not good.all():
+                    self.bad_frames += int(run - good.sum())
+                    frames = frames[good]
+            part = frames[:, header_length:-2].reshape(frames.shape[0], structs, entry[1].itemsize) # still a view
+            if name in payloads:
+                payloads[name].append(part)
+            else:
+                payloads[name] = [part]
+            pos += run * frame_length
+
+        batch = {name: self._join(name, parts) for (name, parts) in payloads.items()}
+        del payloads, raw, frames, part # drop the views, the buffer can't be resized while they are alive
+        del buf[:pos]
+        return batch
+
+    def check(self, frame):
+        return crc16(frame[len(SYNC):-2]) == int(frame[-2]) | (int(frame[-1]) << 8)
+
+    def _join(self, name, parts):
+        '''
+            copies the (frames, structs, itemsize) 'parts' out of the pending
+            buffer, one struct per row
+        '''
+        count = sum(part.shape[0] * part.shape[1] for part in parts)
+        payload = np.empty((count, self.dtypes[name].itemsize), np.uint8)
+        pos = 0
+        for part in parts:
+            payload[pos:pos + part.shape[0] * part.shape[1]].reshape(part.shape)[...] = part
+            pos += part.shape[0] * part.shape[1]
+        self.frames += count
+        return payload.view(self.dtypes[name]).reshape(-1)
+
+    def reset(self):
+        self._pending.clear()
+
+DECODERS = {"ascii": AsciiFrameDecoder, "binary": BinaryFrameDecoder}
+
+def make_encoder(framing, dtypes, overrides = None, batch = 1):
+    '''
+        returns an encode(name, array) -> bytes function producing the frames
+        the matching decoder expects, for synthetic or replayed sources.
+        Binary frames carry up to 'batch' structs each.
+    '''
+    if framing == "binary":
+        ids = {name: i for (i, (name, _)) in stream_ids(dtypes, overrides).items()}
+        return lambda name, array: binary_frames(ids[name], array, batch) if name in ids else b'' # skipped, can't be framed
+    return ascii_frames
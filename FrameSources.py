@@ -0,0 +1,248 @@
+import os
+import select
+import socket
+import time
+import tty
+import numpy as np
+import serial
+import CaptureRecorder
+
+class FrameSource(object):
+    '''
+        Where SerialPortListener gets its bytes from.
+        readinto() copies whatever is available into 'view' and returns the
+        number of bytes copied. It may block, but for a short time (TIMEOUT)
+        so the listener can be stopped. It returns 0 when nothing arrived.
+        write() sends bytes to the MCU (see Commands), it may be called
+        from another thread than readinto().
+    '''
+    TIMEOUT = 0.1
+
+    def open(self):
+        pass
+
+    def readinto(self, view):
+        raise NotImplementedError
+
+    def write(self, data):
+        '''
+            returns the number of bytes sent, 0 if the source can't be written to
+        '''
+        return 0
+
+    def fileno(self):
+        '''
+            a file descriptor to wait on with select, None if the source can't be waited on
+        '''
+        return None
+
+    def close(self):
+        pass
+
+class SerialSource(FrameSource):
+    def __init__(self, port, bauds):
+        self.port = port
+        self.bauds = bauds
+        self.serial_port = None
+
+    def open(self):
+        self.serial_port = serial.Serial(self.port, self.bauds, serial.EIGHTBITS, serial.PARITY_NONE, serial.STOPBITS_ONE, timeout = self.TIMEOUT)
+        if not self.serial_port.isOpen():
+            raise serial.SerialException(f"Could not open {self.port}")
+
+    def readinto(self, view):
+        # block for at least one byte, then take everything already received
+        size = min(max(self.serial_port.in_waiting, 1), len(view))
+        return self.serial_port.readinto(view[:size]) or 0
+
+    def write(self, data):
+        return self.serial_port.write(data) or 0
+
+    def fileno(self):
+        return self.serial_port.fileno()
+
+    def close(self):
+        if self.serial_port is not None:
+            self.serial_port.close()
+
+class PtySource(FrameSource):
+    '''
+        A pseudo-terminal in raw mode: anything written to 'name' (e.g. by a
+        simulated MCU) is decoded as if it came from a serial port.
+    '''
+    def __init__(self):
+        self.master = None
+        self.slave = None
+        self.name = None
+
+    def open(self):
+        self.master, self.slave = os.openpty()
+        tty.setraw(self.slave) # no newline translation or echo, payloads are binary
+        self.name = os.ttyname(self.slave)
+
+    def readinto(self, view):
+        readable, _, _ = select.select([self.master], [], [], self.TIMEOUT)
+        if not readable:
+            return 0
+        return os.readv(self.master, [view])
+
+    def write(self, data):
+        return os.write(self.master, data)
+
+    def fileno(self):
+        return self.master
+
+    def close(self):
+        for fd in (self.master, self.slave):
+            if fd is not None:
+                os.close(fd)
+        self.master = self.slave = None
+
+class TcpSource(FrameSource):
+    '''
+        A TCP client, 'address' is "host:port"
+    '''
+    def __init__(self, address):
+        host, _, port = address.rpartition(':')
+        self.address = (host or "localhost", int(port))
+        self.socket = None
+
+    def open(self):
+        self.socket = socket.create_connection(self.address)
+        self.socket.settimeout(self.TIMEOUT)
+
+    def readinto(self, view):
+        try:
+            n = self.socket.recv_into(view)
+        except socket.timeout:
+            return 0
+        if n == 0:
+            raise ConnectionError(f"{self.address} closed the connection")
+        return n
+
+    def write(self, data):
+        self.socket.sendall(data)
+        return len(data)
+
+    def fileno(self):
+        return self.socket.fileno()
+
+    def close(self):
+        if self.socket is not None:
+            self.socket.close()
+
+class EncodingSource(FrameSource):
+    '''
+        Base class for sources that produce structured arrays rather than bytes.
+        Arrays are encoded with 'encode' (see FrameDecoder.make_encoder) so
+        they go through the same decoder as real frames.
+    '''
+    def __init__(self, encode):
+        self.encode = encode
+        self._pending = memoryview(b'')
+
+    def produce(self, max_bytes):
+        '''
+            returns the next bytes to send, b'' if there is nothing to send yet
+        '''
+        raise NotImplementedError
+
+    def readinto(self, view):
+        if not self._pending:
+            self._pending = memoryview(self.produce(len(view)))
+        n = min(len(view), len(self._pending))
+        view[:n] = self._pending[:n]
+        self._pending = self._pending[n:]
+        return n
+
+class DemoSource(EncodingSource):
+    '''
+        A 1 kHz sine/cosine 'Demo' stream, used when no hardware is attached.
+    '''
+    def __init__(self, encode, dtype, rate = 1000.0):
+        super(DemoSource, self).__init__(encode)
+        self.dtype = dtype
+        self.rate = rate
+        self.sent = 0
+        self.start = None
+
+    def produce(self, max_bytes):
+        if self.start is None:
+            self.start = time.monotonic()
+        time.sleep(1 / self.rate)
+        due = int((time.monotonic() - self.start) * self.rate) - self.sent
+        if due <= 0:
+            return b''
+        t = (self.sent + np.arange(due)) / self.rate + time.time() - (time.monotonic() - self.start)
+        array = np.empty(due, self.dtype)
+        array['sin'] = np.sin(t)
+        array['cos'] = np.cos(t)
+        self.sent += due
+        return self.encode("Demo", array)
+
+class ReplaySource(EncodingSource):
+    '''
+        Replays a capture written by CaptureRecorder, in receive time order,
+        at 'speed' times real time (0: as fast as possible).
+    '''
+    def __init__(self, encode, path, speed = 1.0):
+        super(ReplaySource, self).__init__(encode)
+        self.path = path
+        self.speed = speed
+        self.finished = False
+
+    def open(self):
+        self.streams = CaptureRecorder.load_capture(self.path)
+        self.names = list(self.streams.keys())
+        t = np.concatenate([self.streams[name]['t'] for name in self.names])
+        stream = np.concatenate([np.full(self.streams[name].shape[0], i, np.int32) for (i, name) in enumerate(self.names)])
+        index = np.concatenate([np.arange(self.streams[name].shape[0]) for name in self.names])
+        order = np.argsort(t, kind = 'stable')
+        self.t, self.stream, self.index = t[order], stream[order], index[order]
+        self.position = 0
+        self.frame_size = max([self.streams[name].dtype['data'].itemsize for name in self.names] + [1])
+        self.start = None
+
+    def produce(self, max_bytes):
+        if self.position >= self.t.shape[0]:
+            self.finished = True
+            time.sleep(self.TIMEOUT)
+            return b''
+        if self.start is None:
+            self.start = time.monotonic()
+        end = min(self.t.shape[0], self.position + max(max_bytes // self.frame_size, 1))
+        if self.speed > 0:
+            due = self.t[0] + (time.monotonic() - self.start) * self.speed
+            end = min(end, int(np.searchsorted(self.t, due, 'right')))
+            if end <= self.position:
+                time.sleep(min((self.t[self.position] - due) / self.speed, self.TIMEOUT))
+                return b''
+
+        stream = self.stream[self.position:end]
+        index = self.index[self.position:end]
+        bounds = np.concatenate(([0], np.flatnonzero(np.diff(stream)) + 1, [stream.shape[0]])) # runs of the same stream
+        chunks = []
+        for (a, b) in zip(bounds[:-1], bounds[1:]):
+            name = self.names[stream[a]]
+            chunks.append(self.encode(name, self.streams[name]['data'][index[a:b]]))
+        self.position = end
+        return b''.join(chunks)
+
+SOURCE_TYPES = ["serial", "replay", "pty", "tcp", "demo"]
+
+def make_source(source_type, port, bauds = 115200, encode = None, demo_dtype = None, speed = 1.0):
+    '''
+        'port' is the serial device, the capture directory, or "host:port",
+        depending on 'source_type'
+    '''
+    if source_type == "serial":
+        return SerialSource(port, bauds)
+    if source_type == "replay":
+        return ReplaySource(encode, port, speed)
+    if source_type == "pty":
+        return PtySource()
+    if source_type == "tcp":
+        return TcpSource(port)
+    if source_type == "demo":
+        return DemoSource(encode, demo_dtype)
+    raise RuntimeError(f"Unknown source type '{source_type}', expected one of {SOURCE_TYPES}")
@@ -0,0 +1,102 @@
+from PySide6.QtCore import QObject, Signal
+import collections
+
+DROP_POLICIES = ["oldest", "newest"]
+
+class BatchHandoff(QObject):
+    '''
+        Single producer, single consumer queue of decoded batches, from a
+        listener thread to the GUI thread.
+        The producer push()es batches and emits 'ready' only when the queue
+        went from drained to pending, so the GUI thread gets at most one
+        queued event per drain() however many batches arrive in between.
+        No lock: deque append() and popleft() are atomic, and each counter
+        is only written by one side.
+        When more than 'capacity' frames are pending, whole batches are
+        dropped according to 'policy': "oldest" discards the oldest pending
+        batches (the display stays current), "newest" discards the incoming
+        batch (what is shown stays contiguous). With "oldest", a batch
+        larger than 'capacity' alone only keeps its newest 'capacity' frames.
+        Dropped frames are counted.
+    '''
+    ready = Signal()
+
+    def __init__(self, capacity = 1 << 20, policy = "oldest", parent = None):
+        super(BatchHandoff, self).__init__(parent)
+        self.capacity = capacity # frames
+        self.policy = policy
+        self.consumers = 0 # nothing is queued while no one drains
+        self._queue = collections.deque()
+        self._signalled = False
+        self.pushed = 0 # frames, written by the producer
+        self.dropped = 0 # frames, written by the producer
+        self.drained = 0 # frames, written by the consumer
+
+    def __len__(self):
+        return len(self._queue)
+
+    @property
+    def pending(self):
+        '''
+            frames pushed but not drained or dropped yet
+        '''
+        return self.pushed - self.dropped - self.drained
+
+    def push(self, name, frames, t_read, t_decode):
+        '''
+            producer side
+        '''
+        if self.consumers == 0:
+            return
+        n = frames.shape[0]
+        if self.pending + n > self.capacity:
+            if self.policy == "newest":
+                self.dropped += n
+                self.pushed += n
+                return
+            if n > self.capacity: # its oldest frames go too
+                kept = max(self.capacity, 0)
+                self.dropped += n - kept
+                self.pushed += n - kept
+                frames = frames[n - kept:]
+                n = kept
+                if n == 0:
+                    return
+            while self._queue and self.pending + n > self.capacity:
+                try:
+                    self.dropped += self._queue.popleft()[1].shape[0]
+                except IndexError: # drained meanwhile
+                    break
+        self.pushed += n
+        self._queue.append((name, frames, t_read, t_decode))
+        if not self._signalled:
+            self._signalled = True
+            self.ready.emit()
+
+    def drain(self):
+        '''
+            consumer side: returns every pending (name, frames, t_read, t_decode)
+        '''
+        self._signalled = False # before draining, so a batch pushed meanwhile signals again
+        batches = []
+        try:
+            while True:
+                batches.append(self._queue.popleft())
+        except IndexError:
+            pass
+        self.drained += sum(batch[1].shape[0] for batch in batches)
+        return batches
+
+    def overwritten(self, name, count):
+        '''
+            consumer side: the drained batches belong to the consumer,
+            nothing can overwrite them (see SharedIngest.SharedRingReader)
+        '''
+        return 0
+
+    def release(self):
+        '''
+            consumer side: the drained batches were stored. Nothing to do,
+            they belong to the consumer (see SharedIngest.SharedRingReader)
+        '''
+        pass
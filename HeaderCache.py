@@ -0,0 +1,80 @@
+import hashlib
+import json
+import logging
+import os
+import numpy as np
+
+VERSION = 2 # bump when the way dtypes are derived from headers changes
+
+def cache_directory():
+    base = os.environ.get("XDG_CACHE_HOME", os.path.join(os.path.expanduser("~"), ".cache"))
+    return os.path.join(base, "simplefocscope", "headers")
+
+def find_header(header, include_paths):
+    if os.path.exists(header):
+        return header
+    for directory in include_paths:
+        path = os.path.join(directory, header)
+        if os.path.exists(path):
+            return path
+    return header
+
+def cache_key(headers, include_paths = (), abi = ""):
+    '''
+        hash of the headers' contents, the include paths, the target ABI and
+        the versions of everything the dtypes depend on
+    '''
+    h = hashlib.sha256()
+    h.update(f"{VERSION} {np.__version__} {abi}".encode())
+    for directory in include_paths:
+        h.update(b"I" + os.path.abspath(directory).encode())
+    for header in headers:
+        h.update(b"H" + header.encode())
+        try:
+            with open(find_header(header, include_paths), 'rb') as f:
+                h.update(f.read())
+        except OSError:
+            h.update(b"missing")
+    return h.hexdigest()
+
+def load(key):
+    '''
+        returns the cached {struct name: dtype} (in declaration order) or None
+    '''
+    try:
+        with open(os.path.join(cache_directory(), f"{key}.json")) as f:
+            entries = json.load(f)
+        return {name: dtype_from_json(dtype) for (name, dtype) in entries}
+    except (OSError, ValueError, TypeError, KeyError):
+        return None
+
+def store(key, dtypes):
+    directory = cache_directory()
+    try:
+        os.makedirs(directory, exist_ok = True)
+        path = os.path.join(directory, f"{key}.json")
+        with open(path + ".tmp", 'w') as f:
+            json.dump([[name, dtype_to_json(dtype)] for (name, dtype) in dtypes.items()], f)
+        os.replace(path + ".tmp", path)
+    except OSError as e:
+        logging.warning(f"Could not cache parsed headers: {e}")
+
+def dtype_to_json(dtype):
+    '''
+        unlike dtype.descr, keeps overlapping fields (unions)
+    '''
+    if dtype.names is not None:
+        return {"names": list(dtype.names), "formats": [dtype_to_json(dtype.fields[name][0]) for name in dtype.names],
+                "offsets": [dtype.fields[name][1] for name in dtype.names], "itemsize": dtype.itemsize}
+    if dtype.subdtype is not None:
+        base, shape = dtype.subdtype
+        return {"base": dtype_to_json(base), "shape": list(shape)}
+    return dtype.str
+
+def dtype_from_json(value):
+    if isinstance(value, str):
+        return np.dtype(value)
+    if "shape" in value:
+        return np.dtype((dtype_from_json(value["base"]), tuple(value["shape"])))
+    return np.dtype({"names": value["names"], "formats": [dtype_from_json(f) for f in value["formats"]],
+                     "offsets": value["offsets"], "itemsize": value["itemsize"]})
@@ -0,0 +1,136 @@
+import bisect
+import collections
+import os
+import threading
+import numpy as np
+import CaptureRecorder
+
+class SpilledHistory(object):
+    '''
+        The samples of a data source evicted from its RingBuffer (the hot
+        tier), with their times, appended to a file of
+        CaptureRecorder.record_dtype records.
+        The file is written with plain writes and read back lazily, 'block'
+        samples at a time, through memory maps dropped once the block is
+        copied into an LRU cache of at most 'cache_bytes': neither the file
+        nor the maps stay resident, memory use doesn't grow with the session.
+        Indices are absolute (RingBuffer.total), the history holds [first, end).
+        It may be read from any thread (e.g. an export) while it is appended to.
+    '''
+    def __init__(self, path, dtype, block = 16384, cache_bytes = 16 << 20):
+        self.path = path
+        self.dtype = CaptureRecorder.record_dtype(dtype)
+        self.block = block
+        self.cache_bytes = cache_bytes
+        self.first = 0
+        self.end = None # None until something is spilled
+        self.block_times = [] # time of the first sample of each block, to find times without reading them
+        self._file = open(path, 'wb')
+        self._cache = collections.OrderedDict() # block number -> records, complete blocks only
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return 0 if self.end is None else self.end - self.first
+
+    def reset(self, first):
+        with self._lock:
+            self._file.seek(0)
+            self._file.truncate()
+            self._cache.clear()
+            self.block_times = []
+            self.first = self.end = first
+
+    def append(self, first, t, samples):
+        '''
+            spills the samples of absolute indices [first, first + len(samples))
+        '''
+        with self._lock:
+            n = samples.shape[0]
+            if n == 0:
+                return
+            if self.end != first: # not contiguous (e.g. nothing spilled yet), start over
+                self.reset(first)
+            records = np.empty(n, self.dtype)
+            records['t'] = t
+            records['data'] = samples
+            offset = self.end - self.first
+            starts = np.arange(-offset % self.block, n, self.block)
+            self.block_times.extend(records['t'][starts].tolist())
+            self._file.write(records.data)
+            self.end += n
+
+    def evict(self, buffer, times, depth, samples = None, t = None):
+        '''
+            spills what resizing 'buffer' and 'times' to 'depth', then
+            appending 'samples' of times 't' to them, will drop
+        '''
+        n = 0 if samples is None else samples.shape[0]
+        overflow = len(buffer) + n - depth
+        if overflow <= 0:
+            return
+        oldest = buffer.total - len(buffer)
+        kept = min(overflow, len(buffer))
+        if kept > 0:
+            self.append(oldest, times.read(oldest, kept), buffer.read(oldest, kept))
+        if overflow > kept: # the batch alone overflows
+            self.append(buffer.total, t[:overflow - kept], samples[:overflow - kept])
+
+    def load(self, k):
+        '''
+            records of block 'k', paged in if not cached
+        '''
+        with self._lock:
+            records = self._cache.get(k)
+            if records is not None:
+                self._cache.move_to_end(k)
+                return records
+            self._file.flush()
+            start = k * self.block
+            count = min(self.block, self.end - self.first - start)
+            mapped = np.memmap(self.path, self.dtype, 'r', offset = start * self.dtype.itemsize, shape = (count,))
+            records = np.array(mapped)
+            del mapped # unmapped, its pages don't count anymore
+            if count == self.block: # complete, won't change
+                self._cache[k] = records
+                while len(self._cache) > 1 and len(self._cache) * records.nbytes > self.cache_bytes:
+                    self._cache.popitem(last = False)
+            return records
+
+    def read(self, first, count):
+        '''
+            returns copies of the times and samples of absolute indices
+            [first, first + count). Raises IndexError if some of them were
+            never spilled.
+        '''
+        with self._lock:
+            if len(self) == 0 or first < self.first or first + count > self.end:
+                raise IndexError(f"samples [{first}, {first + count}) are not in [{self.first}, {self.end})")
+            records = np.empty(count, self.dtype)
+            position = first
+            while position < first + count:
+                k = (position - self.first) // self.block
+                block = self.load(k)
+                start = self.first + k * self.block
+                n = min(first + count, start + block.shape[0]) - position
+                records[position - first:position - first + n] = block[position - start:position - start + n]
+                position += n
+            return records['t'], records['data']
+
+    def index_at(self, t):
+        '''
+            absolute index of the first sample at or after time 't'
+        '''
+        with self._lock:
+            if len(self) == 0:
+                return self.first
+            k = max(bisect.bisect_right(self.block_times, t) - 1, 0)
+            return self.first + k * self.block + int(np.searchsorted(self.load(k)['t'], t))
+
+    def close(self):
+        with self._lock:
+            self._cache.clear()
+            self._file.close()
+            try:
+                os.remove(self.path)
+            except OSError:
+                pass
@@ -0,0 +1,50 @@
+import numpy as np
+
+BINS = np.logspace(-4, 1, 21) # 100 us to 10 s, 4 bins per decade
+
+class RollingLatency(object):
+    '''
+        The last 'size' latencies (in seconds) of one pipeline stage.
+    '''
+    def __init__(self, size = 4096):
+        self.samples = np.full(size, np.nan)
+        self.count = 0
+
+    def add(self, values):
+        values = np.asarray(values, np.float64).reshape(-1)[-self.samples.shape[0]:]
+        indices = (self.count + np.arange(values.shape[0])) % self.samples.shape[0]
+        self.samples[indices] = values
+        self.count += values.shape[0]
+
+    def valid(self):
+        return self.samples[:min(self.count, self.samples.shape[0])]
+
+    def summary(self):
+        '''
+            {p50, p90, p99, max} in milliseconds, 0 when nothing was measured
+        '''
+        samples = self.valid()
+        if samples.shape[0] == 0:
+            return {"p50": 0.0, "p90": 0.0, "p99": 0.0, "max": 0.0}
+        p50, p90, p99 = np.percentile(samples, [50, 90, 99]) * 1e3
+        return {"p50": float(p50), "p90": float(p90), "p99": float(p99), "max": float(samples.max() * 1e3)}
+
+    def histogram(self):
+        return np.histogram(self.valid(), BINS)[0].tolist()
+
+class LatencyStats(object):
+    '''
+        RollingLatency of each stage, 'stages' are measured from the time the
+        bytes were read
+    '''
+    def __init__(self, stages, size = 4096):
+        self.stages = {stage: RollingLatency(size) for stage in stages}
+
+    def add(self, stage, values):
+        self.stages[stage].add(values)
+
+    def summary(self):
+        return {stage: latency.summary() for (stage, latency) in self.stages.items()}
+
+    def histograms(self):
+        return {stage: latency.histogram() for (stage, latency) in self.stages.items()}
@@ -0,0 +1,258 @@
+import functools
+import re
+import numpy as np
+
+# (size, alignment) of the C types on the target, the byte order, and
+# whether plain char is signed
+ABIS = {
+    # ARM Cortex-M, ESP32 (Xtensa), RP2040, RISC-V 32
+    "ilp32": {"char": (1, 1), "short": (2, 2), "int": (4, 4), "long": (4, 4), "long long": (8, 8),
+              "float": (4, 4), "double": (8, 8), "long double": (8, 8), "pointer": (4, 4), "enum": (4, 4),
+              "bool": (1, 1), "byteorder": "<", "char_signed": False},
+    # 8-bit AVR (Arduino Uno, Mega): no alignment, double is a float
+    "avr": {"char": (1, 1), "short": (2, 1), "int": (2, 1), "long": (4, 1), "long long": (8, 1),
+            "float": (4, 1), "double": (4, 1), "long double": (4, 1), "pointer": (2, 1), "enum": (2, 1),
+            "bool": (1, 1), "byteorder": "<", "char_signed": True},
+}
+
+def host_abi():
+    import ctypes
+    types = {"char": ctypes.c_char, "short": ctypes.c_short, "int": ctypes.c_int, "long": ctypes.c_long,
+             "long long": ctypes.c_longlong, "float": ctypes.c_float, "double": ctypes.c_double,
+             "long double": ctypes.c_longdouble, "pointer": ctypes.c_void_p, "enum": ctypes.c_int, "bool": ctypes.c_bool}
+    abi = {name: (ctypes.sizeof(t), ctypes.alignment(t)) for (name, t) in types.items()}
+    abi.update({"byteorder": "=", "char_signed": True})
+    return abi
+
+ABIS["host"] = host_abi()
+
+FIXED_WIDTH = re.compile(r"(u?)int(8|16|32|64)_t$")
+PRAGMA_PACK = re.compile(r"#\s*pragma\s+pack\s*\(([^)]*)\)")
+ATTRIBUTES = r"(?:\s*__attribute__\s*\(\(.*?\)\))*"
+TOKENS = re.compile(r"(?P<pragma>#\s*pragma\s+pack\s*\([^)]*\))"
+                    rf"|\b(?P<kind>struct|union)\b(?P<prefix>{ATTRIBUTES})\s*(?P<name>\w+)?(?P<infix>{ATTRIBUTES})\s*\{{"
+                    rf"|(?P<open>\{{)|\}}(?P<postfix>{ATTRIBUTES})")
+COMMENTS = re.compile(r"//[^\n]*|/\*.*?\*/", re.DOTALL)
+
+class SimpleFOCParsingException(Exception):
+    def __init__(self, type):
+        super(Exception, self).__init__(f'Type {type} not reckognized')
+        self.type = type
+
+def packing(texts):
+    '''
+        {(kind, name): pack} of the structs and unions defined in the
+        header sources 'texts', from the '#pragma pack' in effect where
+        they are defined (MSVC and GCC semantics) or their
+        __attribute__((packed)) (pack 1), None if they aren't packed.
+        Anonymous ones are named as pyclibrary does: anon_struct0, ... in
+        the order they end.
+    '''
+    packs = {}
+    anonymous = {"struct": 0, "union": 0}
+    for text in texts:
+        pack, stack, braces = None, [], []
+        for token in TOKENS.finditer(COMMENTS.sub(" ", text)):
+            if token.group("pragma"):
+                options = [o.strip() for o in PRAGMA_PACK.match(token.group("pragma")).group(1).split(",") if o.strip()]
+                values = [int(o) for o in options if o.isdigit()]
+                labels = [o for o in options if not o.isdigit() and o not in ("push", "pop")]
+                if "push" in options:
+                    stack.append((pack, labels[0] if labels else None))
+                    pack = values[0] if values else pack
+                elif "pop" in options:
+                    if labels: # pops up to the push with that label
+                        while stack and stack[-1][1] != labels[0]:
+                            stack.pop()
+                    pack = stack.pop()[0] if stack else None
+                else:
+                    pack = values[0] if values else None # pack(): back to the default
+            elif token.group("kind"):
+                packed = "packed" in (token.group("prefix") or "") + (token.group("infix") or "")
+                braces.append((token.group("kind"), token.group("name"), pack, packed))
+            elif token.group("open"):
+                braces.append(None)
+            elif braces:
+                definition = braces.pop()
+                if definition is None:
+                    continue
+                kind, name, pack_at, packed = definition
+                if name is None:
+                    name = f"anon_{kind}{anonymous[kind]}"
+                    anonymous[kind] += 1
+                packed = packed or "packed" in (token.group("postfix") or "")
+                packs[(kind, name)] = 1 if packed else pack_at
+    return packs
+
+class LayoutEngine(object):
+    '''
+        Numpy dtypes with the exact layout (offsets, padding, itemsize)
+        the target's compiler gives the structs and unions parsed by
+        pyclibrary: nested structs and unions, multi-dimensional arrays,
+        typedefs, enums, pointers, '#pragma pack' and packed attributes.
+        Unions are fields at the same offset. Bit-fields aren't supported.
+    '''
+    def __init__(self, defs, packs = None, abi = "ilp32"):
+        if abi not in ABIS:
+            raise RuntimeError(f"Unknown ABI '{abi}', expected one of {list(ABIS)}")
+        self.defs = defs
+        self.packs = packs or {}
+        self.abi = ABIS[abi]
+        self._compounds = {} # (kind, name) -> (dtype, alignment)
+
+    def dtypes(self):
+        '''
+            {name: dtype} of every struct in declaration order, then of the
+            typedefs of anonymous structs
+        '''
+        dtypes = {name: self.compound("struct", name)[0] for name in self.defs['structs']}
+        for (name, type) in self.defs['types'].items():
+            if type.type_spec.startswith("struct anon_") and not type.declarators and name not in dtypes:
+                dtypes[name] = dtypes[type.type_spec[len("struct "):]]
+        return dtypes
+
+    def scalar(self, kind, signed):
+        size, alignment = self.abi[kind]
+        if kind in ("float", "double", "long double"):
+            code = "f"
+        elif kind == "bool":
+            code = "b"
+        else:
+            code = "i" if signed else "u"
+        return np.dtype(f"{self.abi['byteorder'] if size > 1 else '|'}{code}{size}"), alignment
+
+    def primitive(self, name):
+        words = [w for w in name.split() if w not in ("const", "volatile")]
+        match = FIXED_WIDTH.match(name)
+        if match: # as the standard type of the same size
+            size = int(match.group(2)) // 8
+            kind = next(kind for kind in ("char", "short", "int", "long", "long long") if self.abi[kind][0] == size)
+            return self.scalar(kind, not match.group(1))
+        if name in ("size_t", "uintptr_t"):
+            return self.scalar("pointer", False)
+        if name in ("ptrdiff_t", "intptr_t", "ssize_t"):
+            return self.scalar("pointer", True)
+        if name in ("bool", "_Bool"):
+            return self.scalar("bool", False)
+        signed = "unsigned" not in words
+        rest = [w for w in words if w not in ("signed", "unsigned")]
+        if rest.count("long") == 2:
+            return self.scalar("long long", signed)
+        if "char" in rest:
+            return self.scalar("char", "signed" in words or (signed and self.abi["char_signed"]))
+        for kind in ("short", "double", "float", "long"):
+            if kind in rest:
+                return self.scalar("long double" if kind == "double" and "long" in rest else kind, signed)
+        if rest in ([], ["int"]):
+            return self.scalar("int", signed)
+        raise SimpleFOCParsingException(name)
+
+    def type(self, type):
+        '''
+            (dtype, alignment) of a pyclibrary Type, with its array dimensions
+        '''
+        declarators = list(type.declarators)
+        pointers = [i for (i, d) in enumerate(declarators) if not isinstance(d, list)] # '*' or function arguments
+        if pointers:
+            dtype, alignment = self.scalar("pointer", False)
+            declarators = declarators[pointers[-1] + 1:]
+        else:
+            dtype, alignment = self.base(type.type_spec)
+        shape = tuple(int(d[0]) for d in declarators)
+        if shape:
+            dtype = np.dtype((dtype, shape)) # nested with the typedef's dimensions, if any: outermost first
+        return dtype, alignment
+
+    def base(self, name):
+        kind, _, tag = name.partition(" ")
+        if kind in ("struct", "union") and tag:
+            return self.compound(kind, tag)
+        if kind == "enum" and tag:
+            return self.scalar("enum", True)
+        if name in self.defs['types']:
+            return self.type(self.defs['types'][name])
+        return self.primitive(name)
+
+    def compound(self, kind, name):
+        key = (kind, name)
+        if key in self._compounds:
+            return self._compounds[key]
+        members = self.defs[kind + 's'][name]['members']
+        pack = self.packs.get(key)
+        names, formats, offsets = [], [], []
+        end, alignment = 0, 1
+        for member in members:
+            member_name, member_type = member[0], member[1]
+            if len(member) > 3:
+                raise SimpleFOCParsingException(f"{member_type} {member_name} : {member[3]} (bit-field)")
+            dtype, member_alignment = self.type(member_type)
+            if pack is not None:
+                member_alignment = min(member_alignment, pack)
+            offset = 0 if kind == "union" else -(-end // member_alignment) * member_alignment
+            if member_name is None and dtype.names is not None: # anonymous struct or union: its fields are ours
+                for field in dtype.names:
+                    names.append(field)
+                    formats.append(dtype.fields[field][0])
+                    offsets.append(offset + dtype.fields[field][1])
+            else:
+                names.append(member_name)
+                formats.append(dtype)
+                offsets.append(offset)
+            end = max(end, offset + dtype.itemsize)
+            alignment = max(alignment, member_alignment)
+        itemsize = -(-end // alignment) * alignment
+        self._compounds[key] = np.dtype({'names': names, 'formats': formats, 'offsets': offsets, 'itemsize': itemsize}), alignment
+        return self._compounds[key]
+
+@functools.lru_cache(maxsize = None)
+def channels(dtype):
+    '''
+        {label: view dtype} of every scalar of the structured 'dtype', e.g.
+        "foc.current.q" or "m[1][2]". A view dtype has a single field at the
+        scalar's offset and the itemsize of 'dtype': data.view(view)[label]
+        is a strided view of that scalar, nothing is copied.
+    '''
+    leaves = []
+    def walk(dt, label, offset):
+        if dt.names is not None:
+            for name in dt.names:
+                field, field_offset = dt.fields[name][:2]
+                walk(field, f"{label}.{name}" if label else name, offset + field_offset)
+        elif dt.subdtype is not None:
+            base, shape = dt.subdtype
+            for (i, index) in enumerate(np.ndindex(*shape)):
+                walk(base, label + "".join(f"[{j}]" for j in index), offset + i * base.itemsize)
+        else:
+            leaves.append((label, dt, offset))
+    walk(dtype, "", 0)
+    return {label: np.dtype({'names': [label], 'formats': [base], 'offsets': [offset], 'itemsize': dtype.itemsize})
+            for (label, base, offset) in leaves}
+
+@functools.lru_cache(maxsize = None)
+def flat_dtype(dtype):
+    '''
+        a packed dtype with one field per channel of 'dtype'
+    '''
+    return np.dtype([(label, view.fields[label][0]) for (label, view) in channels(dtype).items()])
+
+def resolve(dtype, label = None):
+    '''
+        the channel of 'dtype' named 'label'. A field that isn't a scalar (a
+        struct or an array) gives its first channel, None the first channel
+        of all.
+    '''
+    views = channels(dtype)
+    if label in views:
+        return label
+    for name in views:
+        if label is None or name.startswith(label + ".") or name.startswith(label + "["):
+            return name
+    raise KeyError(f"No channel '{label}' in {list(views)}")
+
+def channel(data, label = None):
+    '''
+        strided view of channel 'label' (see resolve()) of the structured
+        array 'data'
+    '''
+    label = resolve(data.dtype, label)
+    return data.view(channels(data.dtype)[label])[label]
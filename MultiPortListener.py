@@ -0,0 +1,136 @@
+from PySide6 import QtCore
+from PySide6.QtCore import Signal, Slot
+import logging
+import os
+import selectors
+import threading
+import time
+import numpy as np
+
+class MultiPortListener(QtCore.QThread):
+    '''
+        Reads any number of sources from a single thread. A selector waits on
+        all their file descriptors and only sources that are readable are
+        read, so no read blocks the others.
+        Each port keeps its own SerialPortListener, which is not started: it
+        holds the port's decoder state and statistics, and emits the port's
+        batches as if it read them itself. Batches are also emitted here,
+        tagged with the device they came from.
+    '''
+    TIMEOUT = 0.1 # seconds, how long stop() may take
+
+    dataReceived = Signal(str, str, np.ndarray, float, float) # device, name, frames, time.monotonic() at read and decode
+
+    _shared = None
+
+    @classmethod
+    def shared(cls):
+        '''
+            the listener used by every SimpleFOCSerialScope with 'multiplexed' set
+        '''
+        if cls._shared is None:
+            cls._shared = cls()
+            app = QtCore.QCoreApplication.instance()
+            if app is not None:
+                app.aboutToQuit.connect(cls._shared.shutdown)
+        return cls._shared
+
+    def __init__(self):
+        super(MultiPortListener, self).__init__()
+        self._stop_event = threading.Event()
+        self._lock = threading.Lock()
+        self._changes = [] # (device, source, listener) to add, (device, None, None) to remove
+        self._wakeup = os.pipe()
+        os.set_blocking(self._wakeup[1], False)
+        self.ports = {} # device: (source, listener), only touched by the listener thread
+        self.chunk_size = 1 << 16
+
+    def add_port(self, device, source, listener):
+        '''
+            'source' is an opened FrameSources.FrameSource with a fileno(),
+            decoded by 'listener' (a SerialPortListener). A port already
+            added as 'device' is closed and replaced.
+        '''
+        if source.fileno() is None:
+            raise ValueError(f"{type(source).__name__} can't be multiplexed, it has no file descriptor")
+        self._change(device, source, listener)
+        if not self.isRunning():
+            self._stop_event.clear()
+            self.start()
+
+    def remove_port(self, device):
+        self._change(device, None, None)
+
+    def _change(self, device, source, listener):
+        with self._lock:
+            self._changes.append((device, source, listener))
+        try:
+            os.write(self._wakeup[1], b'\0')
+        except BlockingIOError: # already woken up
+            pass
+
+    def _apply_changes(self, selector):
+        with self._lock:
+            changes, self._changes = self._changes, []
+        for (device, source, listener) in changes:
+            self._close_port(selector, device)
+            if source is not None:
+                selector.register(source.fileno(), selectors.EVENT_READ, device)
+                self.ports[device] = (source, listener)
+
+    def _close_port(self, selector, device):
+        port = self.ports.pop(device, None)
+        if port is None:
+            return
+        source, _ = port
+        try:
+            selector.unregister(source.fileno())
+        except (KeyError, ValueError):
+            pass
+        source.close()
+
+    def run(self):
+        chunk = bytearray(self.chunk_size) # reused for every read, of every port
+        view = memoryview(chunk)
+        selector = selectors.DefaultSelector()
+        selector.register(self._wakeup[0], selectors.EVENT_READ)
+        try:
+            self._apply_changes(selector)
+            while not self.stopped():
+                for (key, events) in selector.select(self.TIMEOUT):
+                    if key.data is None:
+                        os.read(self._wakeup[0], 4096)
+                        self._apply_changes(selector)
+                        continue
+                    device = key.data
+                    if device not in self.ports: # removed by a change applied in this round
+                        continue
+                    source, listener = self.ports[device]
+                    try:
+                        count = source.readinto(view) # readable, doesn't block
+                    except Exception as e:
+                        logging.error(f"{device}: {e}", exc_info=True)
+                        self._close_port(selector, device)
+                        continue
+                    if count:
+                        t_read = time.monotonic()
+                        batch, t_decode = listener.handle_received_data(view[:count], t_read)
+                        for (name, frames) in batch.items():
+                            self.dataReceived.emit(device, name, frames, t_read, t_decode)
+        except Exception as e:
+            logging.error(e, exc_info=True)
+        finally:
+            for device in list(self.ports):
+                self._close_port(selector, device)
+            selector.close()
+
+    @Slot()
+    def shutdown(self):
+        self.stop()
+        self.wait()
+
+    def stop(self):
+        self._stop_event.set()
+
+    def stopped(self):
+        return self._stop_event.is_set()
@@ -0,0 +1,44 @@
+from PySide6.QtGui import QPolygonF
+import shiboken6
+import ctypes
+import numpy as np
+
+class PolylineBuffer(object):
+    '''
+        Two QPolygonF of exactly the number of points of a series, each with
+        a float64 (qreal) numpy view over its points, used in turn.
+        Filling one is a few strided writes; a polygon is only reallocated
+        when the number of points changes.
+        The series may share the storage of the polygon it was given
+        (implicitly shared QList), so that one is left alone until the
+        other has replaced it.
+        inspired from https://github.com/PierreRaybaut/plotpy/wiki/Using-Qt-Charts-(PyQtChart)-to-plot-curves-efficiently-in-Python!
+    '''
+    def __init__(self):
+        self.polygons = [QPolygonF(), QPolygonF()]
+        self.points = [np.empty((0, 2), np.float64), np.empty((0, 2), np.float64)]
+        self.current = 0
+
+    def resize(self, index, size):
+        if self.points[index].shape[0] == size:
+            return
+        polygon = self.polygons[index] = QPolygonF()
+        self.points[index] = np.empty((0, 2), np.float64)
+        if size > 0:
+            polygon.resize(size)
+            address = shiboken6.getCppPointer(polygon.data())[0]
+            buffer = (2 * size * ctypes.c_double).from_address(address) #QPolygonF float type is qreal, which is double
+            self.points[index] = np.frombuffer(buffer, np.float64).reshape(size, 2)
+
+    def fill(self, xdata, ydata):
+        '''
+            writes the points in the polygon not handed out last and
+            returns it
+        '''
+        self.current ^= 1
+        size = ydata.shape[0]
+        self.resize(self.current, size)
+        points = self.points[self.current]
+        points[:, 0] = xdata
+        points[:, 1] = ydata
+        return self.polygons[self.current]
@@ -30,7 +30,9 @@
  
 from PySide6.QtCore import Signal, Property, Slot, QObject, QTimer
 from PySide6.QtQml import QJSValue
+import time
 import traceback
+import weakref
 
 class Setter(object):
     def __init__(self, name, callback = None, classvars = None):
@@ -188,6 +190,8 @@ class Product(QObject):
         self._error = None
         self._producer = None
         self._autoUpdate = False
+        self._stale = False # made dirty directly, not (only) by a dependency
+        self._updateTime = 0.0
 
     @Property(QObject, notify = productClean)
     def bind(self):
@@ -198,41 +202,41 @@ class Product(QObject):
             self._dirty = d
             self.dirtyChanged.emit()
         if self._dirty and self._autoUpdate:
-            QTimer.singleShot(0, self.update) # schedule an update as soon as we go back to event loop, but not before
+            scheduler().schedule(self) # updated as soon as we go back to event loop, along with the other products
     dirtyChanged = Signal()
     dirty = Property(bool, Getter('dirty'), set_dirty, dirtyChanged)
 
-    RWProperty(vars(), bool, 'autoUpdate')
+    def cb_autoUpdate(self, old_value):
+        if self._dirty and self._autoUpdate: # already dirty, set_dirty() won't be called
+            scheduler().schedule(self)
+
+    RWProperty(vars(), bool, 'autoUpdate', cb_autoUpdate)
+
+    ROProperty(vars(), float, 'updateTime') # ms, last _update()
 
     def _update(self):
         '''
         update function to override
+        return False if the outputs didn't change, dependents that have
+        no other reason to update are then skipped
         '''
         pass
 
     @Slot()
     def update(self):
-
-        if self.dirty:
-
-            self._error = None
-
-            for d in self._dependencies:
-                if not d.update():
-                    self._error = d._error
-                    return False
-            try:
-                self._update()
-            except Exception as e:
-                self._error = e
-                print(traceback.format_exc())
-
-            self.makeClean()
-
+        '''
+        updates this product and its dirty dependencies, see Scheduler
+        '''
+        scheduler().update([self])
         return self._error is None
 
     @Slot()
     def makeDirty(self):
+        self._stale = True
+        self.dependencyDirty()
+
+    @Slot()
+    def dependencyDirty(self):
         if not self.dirty:
             self.dirty = True
             self.productDirty.emit()
@@ -248,12 +252,7 @@ class Product(QObject):
             *Important" this property is meant to be used only from QML.
             Use add/remove_dependency() from python.
         '''
-        old = self._dependsOn
-        if assign_input(self, "dependsOn", v):
-            for d in old:
-                self.remove_dependency(d)
-            for d in self._dependsOn:
-                self.add_dependency(d)
+        assign_input(self, "dependsOn", v) # adds and removes the dependencies
 
     dependsOnChanged = Signal()
     dependsOn = Property(list, Getter('dependsOn'), set_dependsOn, dependsOnChanged)
@@ -261,13 +260,13 @@ class Product(QObject):
     def add_dependency(self, d):
         if d is not None:
             self._dependencies.append(d)
-            d.productDirty.connect(self.makeDirty)
+            d.productDirty.connect(self.dependencyDirty)
             self.makeDirty()
 
     def remove_dependency(self, d):
         if d is not None:
             self._dependencies.remove(d)
-            d.productDirty.disconnect(self.makeDirty)
+            d.productDirty.disconnect(self.dependencyDirty)
             self.makeDirty()
 
     def set_producer(self, producer):
@@ -279,6 +278,105 @@ class Product(QObject):
         producer.productClean.connect(self.makeClean)
 
 
+class Scheduler(QObject):
+    '''
+        Updates products in dependency order, each at most once per pass.
+        Products with 'autoUpdate' are collected as they get dirty and
+        updated together by a single pass once back in the event loop.
+        A product is skipped (made clean without calling _update()) when it
+        was only made dirty by its dependencies and all of them updated in
+        the same pass and returned False (outputs unchanged).
+        'timings' holds {product: [updates, skips, seconds in _update()]}.
+    '''
+    def __init__(self, parent = None):
+        super(Scheduler, self).__init__(parent)
+        self._scheduled = {} # used as an ordered set
+        self._posted = False
+        self.timings = weakref.WeakKeyDictionary()
+
+    def schedule(self, product):
+        self._scheduled[product] = None
+        if not self._posted:
+            self._posted = True
+            QTimer.singleShot(0, self.run)
+
+    @Slot()
+    def run(self):
+        self._posted = False
+        products, self._scheduled = list(self._scheduled), {}
+        self.update(products)
+
+    def order(self, products):
+        '''
+            the dirty products among 'products' and their dependencies,
+            dependencies first
+        '''
+        order = []
+        visited = set()
+        def visit(product, path):
+            if product in visited or not product._dirty:
+                return
+            if product in path:
+                raise RuntimeError(f"Dependency cycle through {product}")
+            path.add(product)
+            for d in product._dependencies:
+                visit(d, path)
+            path.discard(product)
+            visited.add(product)
+            order.append(product)
+        for product in products:
+            visit(product, set())
+        return order
+
+    def update(self, products):
+        updated = set()
+        changed = set()
+        for product in self.order(products):
+            if not product._dirty: # made clean by its producer
+                continue
+            product._error = None
+            failed = [d for d in product._dependencies if d._error is not None]
+            if failed:
+                product._error = failed[0]._error
+                continue
+            timing = self.timings.setdefault(product, [0, 0, 0.0])
+            if not product._stale and product._dependencies and all(d in updated and d not in changed for d in product._dependencies):
+                timing[1] += 1
+                updated.add(product) # unchanged as well
+                product.makeClean()
+                continue
+            start = time.perf_counter()
+            try:
+                result = product._update()
+            except Exception as e:
+                product._error = e
+                result = None
+                print(traceback.format_exc())
+            elapsed = time.perf_counter() - start
+            timing[0] += 1
+            timing[2] += elapsed
+            product.set_updateTime(product, elapsed * 1e3)
+            updated.add(product)
+            if result is not False:
+                changed.add(product)
+            product._stale = False
+            product.makeClean()
+
+    def report(self):
+        '''
+            [(product, updates, skips, total ms, mean ms)], most expensive first
+        '''
+        rows = [(product, n, skips, seconds * 1e3, seconds * 1e3 / max(n, 1)) for (product, (n, skips, seconds)) in list(self.timings.items())]
+        return sorted(rows, key = lambda row: -row[3])
+
+_scheduler = None
+
+def scheduler():
+    global _scheduler
+    if _scheduler is None:
+        _scheduler = Scheduler()
+    return _scheduler
+
 ################################################################################
 ############# Helpers ##########################################################
 
@@ -0,0 +1,169 @@
+import numpy as np
+import Layout
+
+class Level(object):
+    '''
+        Growable arrays of bucket summaries: time of the first sample, min
+        and max of each channel. Buckets [first, count) are held, the older
+        ones were dropped. The arrays are at most about twice the buckets held.
+    '''
+    def __init__(self, channels):
+        self.first = 0
+        self.count = 0
+        self._start = 0 # position of bucket 'first' in the arrays
+        self.t = np.empty(0, np.float64)
+        self.lo = np.empty((0, channels), np.float64)
+        self.hi = np.empty((0, channels), np.float64)
+
+    def __len__(self):
+        return self.count - self.first
+
+    @property
+    def nbytes(self):
+        return self.t.nbytes + self.lo.nbytes + self.hi.nbytes
+
+    def index(self, k):
+        '''
+            position of bucket 'k' in the arrays
+        '''
+        return k - self.first + self._start
+
+    def reallocate(self, capacity):
+        held = len(self)
+        for name in ("t", "lo", "hi"):
+            old = getattr(self, name)
+            new = np.empty((capacity,) + old.shape[1:], old.dtype)
+            new[:held] = old[self._start:self._start + held]
+            setattr(self, name, new)
+        self._start = 0
+
+    def append(self, t, lo, hi):
+        n = t.shape[0]
+        if self._start + len(self) + n > self.t.shape[0]:
+            self.reallocate(max(2 * (len(self) + n), 64))
+        end = self._start + len(self)
+        self.t[end:end + n] = t
+        self.lo[end:end + n] = lo
+        self.hi[end:end + n] = hi
+        self.count += n
+
+    def drop(self, first):
+        '''
+            drops the buckets before 'first'
+        '''
+        first = min(first, self.count)
+        if first <= self.first:
+            return
+        self._start += first - self.first
+        self.first = first
+        if self.t.shape[0] > 2 * len(self) + 64:
+            self.reallocate(max(2 * len(self), 64))
+
+class MinMaxPyramid(object):
+    '''
+        Min/max of every channel (Layout.channels) of a data source over
+        buckets of base * factor**level samples, aligned on absolute sample
+        indices (RingBuffer.total), level after level. append() is called
+        with each batch stored, whatever the buffers keep, so the pyramid
+        can cover the whole session for about 1 / (base - base / factor) of
+        its samples. discard() drops what can't be shown anymore, limit()
+        bounds its memory. buckets() gives the coarsest level with enough
+        buckets over a range: a window of any width is drawn from O(pixels)
+        summaries. The newest samples, not a whole bucket yet, are only in
+        the buffers.
+    '''
+    def __init__(self, dtype, base = 256, factor = 4, levels = 10):
+        self.labels = list(Layout.channels(dtype))
+        self.base = base
+        self.factor = factor
+        self.sizes = [base * factor ** level for level in range(levels)] # samples per bucket
+        self.levels = [Level(len(self.labels)) for _ in range(levels)]
+        self.total = 0
+        self._tail = np.empty((0, len(self.labels)), np.float64) # samples of the incomplete bucket of level 0
+        self._tail_t = np.empty(0, np.float64)
+
+    def append(self, samples, t):
+        values = np.empty((samples.shape[0], len(self.labels)), np.float64)
+        for (i, label) in enumerate(self.labels):
+            values[:, i] = Layout.channel(samples, label)
+        self.total += samples.shape[0]
+        values = np.concatenate((self._tail, values))
+        t = np.concatenate((self._tail_t, t))
+        complete = values.shape[0] // self.base
+        blocks = values[:complete * self.base].reshape(complete, self.base, len(self.labels))
+        self.levels[0].append(t[:complete * self.base:self.base], blocks.min(axis = 1), blocks.max(axis = 1))
+        self._tail = values[complete * self.base:]
+        self._tail_t = t[complete * self.base:]
+        for (lower, level) in zip(self.levels[:-1], self.levels[1:]):
+            new = lower.count // self.factor - level.count
+            if new <= 0:
+                break
+            start, end = lower.index(level.count * self.factor), lower.index((level.count + new) * self.factor)
+            lo = lower.lo[start:end].reshape(new, self.factor, -1).min(axis = 1)
+            hi = lower.hi[start:end].reshape(new, self.factor, -1).max(axis = 1)
+            level.append(lower.t[start:end:self.factor], lo, hi)
+
+    @property
+    def nbytes(self):
+        return sum(level.nbytes for level in self.levels)
+
+    def unmerged(self, i):
+        '''
+            first bucket of level 'i' not merged into level i + 1 yet, it
+            must be kept until it is
+        '''
+        if i + 1 == len(self.levels):
+            return self.levels[i].count
+        return self.levels[i + 1].count * self.factor
+
+    def discard(self, first):
+        '''
+            drops the buckets entirely before absolute index 'first', e.g.
+            the oldest sample that can still be shown
+        '''
+        for (i, (size, level)) in enumerate(zip(self.sizes, self.levels)):
+            level.drop(min(first // size, self.unmerged(i)))
+
+    def limit(self, nbytes):
+        '''
+            drops the oldest buckets, finest levels first, until the levels
+            take at most about 'nbytes'. Coarser levels still cover the
+            dropped range, at a lower resolution.
+        '''
+        bucket = 8 + 16 * len(self.labels) # t, lo, hi
+        held = sum(len(level) for level in self.levels) * bucket
+        for (i, level) in enumerate(self.levels):
+            excess = 2 * held - nbytes # the arrays are up to twice the buckets held
+            if excess <= 0:
+                return
+            n = min(int(-(-excess // (2 * bucket))), max(self.unmerged(i) - level.first, 0))
+            level.drop(level.first + n)
+            held -= n * bucket
+
+    def buckets(self, first, end, count):
+        '''
+            (first sample index, first sample time, min, max) of the buckets
+            of the coarsest level having at least 'count' of them in
+            [first, end), for all channels, merged down to between 'count'
+            and 2 * 'count'. If the levels with enough buckets dropped those
+            of 'first', the finest level that still has it is used, with
+            fewer buckets. None if even the finest level has fewer than
+            'count' buckets: the samples themselves are needed.
+        '''
+        if (end - first) // self.sizes[0] < count:
+            return None
+        held = [(size, level) for (size, level) in zip(self.sizes, self.levels) if first // size >= level.first]
+        enough = [(size, level) for (size, level) in held if (end - first) // size >= count]
+        if enough:
+            size, level = enough[-1]
+        elif held:
+            size, level = held[0]
+        else:
+            return None
+        a, b = first // size, min(-(-end // size), level.count)
+        if b <= a:
+            return None
+        starts = np.arange(a, b, max((b - a) // count, 1))
+        lo, hi = level.lo[level.index(a):level.index(b)], level.hi[level.index(a):level.index(b)]
+        return (starts * size, level.t[level.index(starts)], np.minimum.reduceat(lo, starts - a),
+                np.maximum.reduceat(hi, starts - a))
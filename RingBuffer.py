@@ -0,0 +1,108 @@
+import time
+import numpy as np
+
+class RingBuffer(object):
+    '''
+        Fixed-depth storage for structured samples.
+        Samples are written linearly into a backing array twice as long as the
+        depth. When the end is reached, the last 'depth' samples are moved back
+        to the front, so each sample is copied at most once per 'depth' appends
+        (amortised O(1)) and the most recent samples are always contiguous:
+        last(n) is a view, never a copy.
+        Only one thread may write. Other threads use read(), which copies:
+        'version' is odd while the samples are being changed.
+    '''
+    def __init__(self, dtype, depth):
+        self.dtype = np.dtype(dtype)
+        self.depth = max(int(depth), 1)
+        self._storage = np.empty(2 * self.depth, self.dtype)
+        self._end = 0 # one past the newest sample in _storage
+        self._size = 0 # number of valid samples, <= depth
+        self.total = 0 # number of samples ever appended
+        self.version = 0 # incremented before and after each change, see read()
+
+    def __len__(self):
+        return self._size
+
+    def append(self, samples):
+        samples = np.asarray(samples, self.dtype).reshape(-1)
+        n = samples.shape[0]
+        if n == 0:
+            return
+        self.version += 1
+        self.total += n
+        if n >= self.depth: # the batch alone fills the buffer
+            self._storage[:self.depth] = samples[-self.depth:]
+            self._end = self._size = self.depth
+        else:
+            if self._end + n > self._storage.shape[0]:
+                keep = min(self._size, self.depth - n)
+                self._storage[:keep] = self._storage[self._end - keep:self._end]
+                self._end = keep
+            self._storage[self._end:self._end + n] = samples
+            self._end += n
+            self._size = min(self._size + n, self.depth)
+        self.version += 1
+
+    def last(self, n = None):
+        '''
+            returns a view on the 'n' most recent samples (all of them if n is None)
+        '''
+        n = self._size if n is None else max(0, min(int(n), self._size))
+        return self._storage[self._end - n:self._end]
+
+    def data(self):
+        return self.last()
+
+    def read(self, first, count):
+        '''
+            returns a copy of the samples of absolute indices [first, first + count)
+            (index i is the i-th sample ever appended), may be called from any
+            thread. Raises IndexError if some of them are not kept anymore.
+        '''
+        while True:
+            version = self.version
+            if version % 2 == 0:
+                storage, end, size, total = self._storage, self._end, self._size, self.total
+                if first < total - size or first + count > total:
+                    raise IndexError(f"samples [{first}, {first + count}) are not in [{total - size}, {total})")
+                offset = end - (total - first)
+                samples = storage[offset:offset + count].copy()
+                if self.version == version:
+                    return samples
+            time.sleep(0) # changed meanwhile, let the writer finish
+
+    def __getitem__(self, key):
+        return self.last()[key]
+
+    def resize(self, depth):
+        '''
+            changes the depth, keeping as many of the most recent samples as possible
+        '''
+        depth = max(int(depth), 1)
+        if depth == self.depth:
+            return
+        self.version += 1
+        kept = self.last(min(self._size, depth))
+        storage = np.empty(2 * depth, self.dtype)
+        storage[:kept.shape[0]] = kept
+        self._storage = storage
+        self._end = self._size = kept.shape[0]
+        self.depth = depth
+        self.version += 1
+
+    def truncate(self, n):
+        '''
+            removes the 'n' most recent samples
+        '''
+        n = max(0, min(int(n), self._size))
+        self.version += 1
+        self.total -= n
+        self._end -= n
+        self._size -= n
+        self.version += 1
+
+    def clear(self):
+        self.version += 1
+        self._end = self._size = 0
+        self.version += 1
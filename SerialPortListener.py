@@ -1,15 +1,25 @@
 from PySide6 import QtCore
 from PySide6.QtCore import Signal, Slot
 import logging
+import os
 import threading
 from PySide6.QtQuick import QQuickItem
 from pyclibrary import CParser
 import numpy as np
-import ctypes
 import time  
 import serial
 import Product
 import SimpleFOCScope
+import FrameDecoder
+import FrameSources
+import CaptureRecorder
+import FanOut
+import HeaderCache
+import MultiPortListener
+import Handoff
+import SharedIngest
+import Layout
+import Commands
 
 class SimpleFOCSerialScope(QQuickItem):
     def __init__(self, parent = None):
@@ -18,136 +28,428 @@ class SimpleFOCSerialScope(QQuickItem):
         self._port = ""
         self._bauds = ""
         self._traces = None
+        self._recorder = None
+        self._fanOut = None
         self._headers = ['demo.h']
+        self._abi = "ilp32"
+        self._framing = "ascii"
+        self._streamIds = {}
+        self._badFrames = 0
+        self._droppedBytes = 0
+        self._sourceType = "serial"
+        self._replaySpeed = 1.0
+        self._ptyName = ""
+        self._multiplexed = False
+        self._outOfProcess = False
+        self._ringCapacity = 0
+        self.ingest = None # SharedIngest.DecoderProcess when outOfProcess
+        self._pty = None # its slave end, when outOfProcess
+        self.source = None # the FrameSource read in this process, if any
+        self._commandChannel = False
+        self._commandsSent = 0
+        self.subscriptions = {} # struct name -> (subscribed, downsample factor), what the MCU was told
+        self._readBacklog = 0
+        self._signalQueueDepth = 0
+        self._handoffCapacity = 1 << 20
+        self._dropPolicy = "oldest"
+        self._framesDropped = 0
         self.connector = SerialPortListener()
+        self._headersFromCache = False
+        self._headersLoadTime = 0.0
+        self.connector.decodeErrors.connect(self.on_decode_errors)
+        self.connector.headersParsed.connect(self.on_headers_parsed)
         self.connector.parseHeaders(self.headers)
+        self._statsTimer = QtCore.QTimer(self)
+        self._statsTimer.setInterval(250)
+        self._statsTimer.timeout.connect(self.publish_queue_depths)
+        self._statsTimer.start()
 
 
     def cb_traces(self, old_value):
         if self._traces is not None:
             if old_value is not None:
-                self.connector.dataReceived.disconnect(old_value.dataReceived)
+                old_value.detach(self.connector.handoff)
             
-            self.connector.dataReceived.connect(self._traces.dataReceived)
+            self._traces.attach(self.connector.handoff) # drained once per refresh rather than one queued signal per batch
         pass
 
     Product.RWProperty(vars(), SimpleFOCScope.SimpleFOCScope , "traces", cb_traces)
 
-    Product.RWProperty(vars(), str , "port")
+    def cb_recorder(self, old_value):
+        if old_value is not None:
+            self.connector.dataReceived.disconnect(old_value.dataReceived)
+        if self._recorder is not None:
+            # called from the listener thread, the GUI thread is not involved
+            self.connector.dataReceived.connect(self._recorder.dataReceived, QtCore.Qt.DirectConnection)
+
+    Product.RWProperty(vars(), CaptureRecorder.SimpleFOCRecorder , "recorder", cb_recorder)
+
+    def cb_fanOut(self, old_value):
+        if old_value is not None:
+            self.connector.dataReceived.disconnect(old_value.dataReceived)
+        if self._fanOut is not None:
+            # called from the listener thread, as the recorder
+            self.connector.dataReceived.connect(self._fanOut.dataReceived, QtCore.Qt.DirectConnection)
+
+    Product.RWProperty(vars(), FanOut.SimpleFOCFanOut , "fanOut", cb_fanOut)
+
+    Product.RWProperty(vars(), str , "port") # serial device, capture directory (replay) or "host:port" (tcp)
     Product.RWProperty(vars(), int , "bauds")
+    Product.RWProperty(vars(), str , "sourceType") # one of FrameSources.SOURCE_TYPES
+    Product.RWProperty(vars(), float , "replaySpeed") # 1: real time, N: N times faster, 0: as fast as possible
+    Product.ROProperty(vars(), str , "ptyName") # the device to write to when sourceType is "pty"
+    Product.RWProperty(vars(), bool , "multiplexed") # read from the shared MultiPortListener thread rather than a thread of its own
+    Product.RWProperty(vars(), bool , "outOfProcess") # read and decode in a separate process, see SharedIngest
+    Product.RWProperty(vars(), int , "ringCapacity") # frames per struct in the shared memory rings, when outOfProcess. 0: SharedIngest.RING_MEMORY shared between structs
 
     def cb_headers(self, old_value):
         self.connector.parseHeaders(self.headers)
 
     Product.RWProperty(vars(), list , "headers", cb_headers)
 
+    def cb_abi(self, old_value):
+        if self.abi not in Layout.ABIS:
+            raise RuntimeError(f"Unknown ABI '{self.abi}', expected one of {list(Layout.ABIS)}")
+        self.connector.abi = self.abi
+        self.connector.parseHeaders(self.headers)
+
+    Product.RWProperty(vars(), str , "abi", cb_abi) # one of Layout.ABIS: sizes, alignments and byte order of the MCU's compiler
+
+    Product.ROProperty(vars(), bool , "headersFromCache")
+    Product.ROProperty(vars(), float , "headersLoadTime") # ms, cold parse or cache hit
+
+    @Slot(bool, float)
+    def on_headers_parsed(self, from_cache, seconds):
+        self.set_headersFromCache(self, from_cache)
+        self.set_headersLoadTime(self, seconds * 1e3)
+        logging.info(f"headers {self.headers} loaded in {seconds * 1e3:.1f} ms ({'cache' if from_cache else 'parsed'})")
+
+    def cb_framing(self, old_value):
+        self.connector.set_framing(self.framing, self.streamIds)
+
+    Product.RWProperty(vars(), str , "framing", cb_framing) # "ascii" or "binary"
+    Product.RWProperty(vars(), dict , "streamIds", cb_framing) # binary framing stream ID overrides, {struct name: ID}
+
+    Product.ROProperty(vars(), int , "badFrames")
+    Product.ROProperty(vars(), int , "droppedBytes")
+
+    Product.ROProperty(vars(), int , "readBacklog") # bytes read but not decoded yet
+    Product.ROProperty(vars(), int , "signalQueueDepth") # batches handed off but not drained by traces yet
+
+    def cb_handoff(self, old_value):
+        if self.dropPolicy not in Handoff.DROP_POLICIES:
+            raise RuntimeError(f"Unknown drop policy '{self.dropPolicy}', expected one of {Handoff.DROP_POLICIES}")
+        self.connector.handoff.capacity = self.handoffCapacity
+        self.connector.handoff.policy = self.dropPolicy
+
+    Product.RWProperty(vars(), int , "handoffCapacity", cb_handoff) # frames pending for traces before dropping
+    Product.RWProperty(vars(), str , "dropPolicy", cb_handoff) # "oldest" or "newest", see Handoff.BatchHandoff
+    Product.ROProperty(vars(), int , "framesDropped") # dropped because traces didn't keep up
+
+    @Slot()
+    def publish_queue_depths(self):
+        if self.ingest is not None:
+            control = self.ingest.control
+            self.set_readBacklog(self, int(control[SharedIngest.BACKLOG]))
+            self.set_signalQueueDepth(self, len(self.ingest.reader))
+            self.set_framesDropped(self, self.ingest.reader.dropped + self.ingest.reader.torn)
+            self.set_badFrames(self, int(control[SharedIngest.BAD_FRAMES]))
+            self.set_droppedBytes(self, int(control[SharedIngest.DROPPED_BYTES]))
+            return
+        self.set_readBacklog(self, self.connector.backlog)
+        self.set_signalQueueDepth(self, len(self.connector.handoff))
+        self.set_framesDropped(self, self.connector.handoff.dropped)
+
+    @Slot(int, int)
+    def on_decode_errors(self, bad_frames, dropped_bytes):
+        self.set_badFrames(self, bad_frames)
+        self.set_droppedBytes(self, dropped_bytes)
+
+    def cb_commandChannel(self, old_value):
+        if self.commandChannel and not old_value:
+            self.send_subscriptions()
+
+    Product.RWProperty(vars(), bool , "commandChannel", cb_commandChannel) # send subscriptions, downsample factors and bursts to the MCU, see Commands
+    Product.ROProperty(vars(), int , "commandsSent")
+
+    def stream_id(self, name):
+        ids = {struct: i for (i, (struct, _)) in FrameDecoder.stream_ids(self.connector.dtypes, self.streamIds).items()}
+        if name not in ids:
+            logging.warning(f"No stream '{name}' to send commands for")
+        return ids.get(name)
+
+    def send_command(self, command, name, argument = 0):
+        if not self.commandChannel:
+            return
+        stream_id = self.stream_id(name)
+        if stream_id is None:
+            return
+        data = Commands.encode(command, stream_id, argument)
+        try:
+            if self.ingest is not None:
+                self.ingest.send(data)
+            elif self.source is not None:
+                self.source.write(data)
+            else:
+                return
+        except OSError as e:
+            logging.warning(f"Could not send a command to the MCU: {e}")
+            return
+        self.set_commandsSent(self, self.commandsSent + 1)
+
+    def send_subscriptions(self):
+        '''
+            tells a (re)connected MCU what it was told before
+        '''
+        for (name, (subscribed, factor)) in self.subscriptions.items():
+            self.send_command(Commands.SUBSCRIBE if subscribed else Commands.UNSUBSCRIBE, name)
+            self.send_command(Commands.DOWNSAMPLE, name, factor)
+
+    @Slot(str, bool)
+    def subscribe(self, name, subscribed):
+        '''
+            asks the MCU to send struct 'name' or not, e.g. when its data source is toggled
+        '''
+        if name not in self.connector.dtypes:
+            return # not a struct, e.g. the output of a DSP stage
+        factor = self.subscriptions.get(name, (True, 1))[1]
+        self.subscriptions[name] = (subscribed, factor)
+        self.send_command(Commands.SUBSCRIBE if subscribed else Commands.UNSUBSCRIBE, name)
+
+    @Slot(str, int)
+    def downsample(self, name, factor):
+        '''
+            asks the MCU to send one frame of struct 'name' out of 'factor'
+        '''
+        if name not in self.connector.dtypes:
+            return
+        subscribed = self.subscriptions.get(name, (True, 1))[0]
+        self.subscriptions[name] = (subscribed, max(factor, 1))
+        self.send_command(Commands.DOWNSAMPLE, name, max(factor, 1))
+
+    @Slot(str, int)
+    def burst(self, name, frames):
+        '''
+            asks the MCU to send the next 'frames' frames of struct 'name'
+            at full rate, even if unsubscribed or downsampled
+        '''
+        self.send_command(Commands.BURST, name, frames)
+
     @Slot()
     def beginListneing(self):
+        self.connector.wait_for_headers() # only blocks while headers are parsed for the first time
+        if self.outOfProcess:
+            self.begin_process()
+            return
         try:
-            serial_port = serial.Serial(self.port, self.bauds, serial.EIGHTBITS, serial.PARITY_NONE, serial.STOPBITS_ONE)
-            if not serial_port.isOpen():
-                serial_port = None
-        except:
-            serial_port = None
-        self.connector.beginListneing(serial_port)
+            source = FrameSources.make_source(self.sourceType, self.port, self.bauds, self.connector.make_encoder(),
+                                              self.connector.dtypes.get("Demo"), self.replaySpeed)
+            source.open()
+        except Exception as e:
+            logging.warning(f"Could not open {self.sourceType} source '{self.port}' ({e}), falling back to demo")
+            source = None
+        self.source = source
+        if isinstance(source, FrameSources.PtySource):
+            self.set_ptyName(self, source.name)
+        self.send_subscriptions()
+        if self.multiplexed and source is not None and source.fileno() is not None:
+            MultiPortListener.MultiPortListener.shared().add_port(self.ptyName or self.port, source, self.connector)
+            return
+        self.connector.beginListneing(source)
 
+    def begin_process(self):
+        '''
+            reads and decodes in a SharedIngest.DecoderProcess, the traces
+            read its shared memory rings. A pty is opened here, so its name
+            is known, and read by the process.
+        '''
+        self.stop_process()
+        if self.recorder is not None:
+            logging.info("The recorder only records frames decoded in this process, not with outOfProcess")
+        if self.fanOut is not None:
+            logging.info("The fan-out server only publishes frames decoded in this process, not with outOfProcess")
+        pty = None
+        if self.sourceType == "pty":
+            pty = self._pty = FrameSources.PtySource()
+            pty.open()
+            self.set_ptyName(self, pty.name)
+        self.ingest = SharedIngest.DecoderProcess(self.connector.dtypes, self.ringCapacity)
+        reader = self.ingest.start(self.sourceType, self.port, self.bauds, self.connector.framing, self.connector.stream_ids,
+                                   self.replaySpeed, pty.master if pty is not None else None)
+        if pty is not None:
+            os.close(pty.master) # the process has its own copy, the slave stays open here so writers don't get EIO
+            pty.master = None
+        self.send_subscriptions()
+        if self.traces is not None:
+            self.traces.attach(reader)
+        app = QtCore.QCoreApplication.instance()
+        if app is not None:
+            app.aboutToQuit.connect(self.stop_process)
 
-class SimpleFOCParsingException(Exception):
-    def __init__(self, type):
-        super(Exception, self).__init__(f'Type {type} not reckognized')
-        self.type = type
+    @Slot()
+    def stop_process(self):
+        if self.ingest is None:
+            return
+        if self.traces is not None:
+            self.traces.detach(self.ingest.reader)
+        self.ingest.stop()
+        self.ingest = None
+        if self._pty is not None:
+            self._pty.close()
+            self._pty = None
 
 
 class SerialPortListener(QtCore.QThread):
 
-    dataReceived = Signal(str, np.ndarray)
+    dataReceived = Signal(str, np.ndarray, float, float) # name, frames, time.monotonic() at read and decode
+    decodeErrors = Signal(int, int) # bad frames, dropped bytes
+    headersParsed = Signal(bool, float) # from cache, seconds
+    parsed = Signal() # from the parse thread, see apply_parsed()
 
     def __init__(self):
         super(SerialPortListener, self).__init__()
         self._stop_event = threading.Event()
-        self._serial_port = None
+        self._source = None
         self.parser = None
         self.dtypes = {}
+        self.include_paths = []
+        self.abi = "ilp32" # target the headers are laid out for, one of Layout.ABIS
+        self._parse_thread = None
+        self._parse_lock = threading.Lock()
+        self._parsed = None # (generation, dtypes, seconds) of the last parse, until applied
+        self._generation = 0 # of the last parseHeaders() call
+        self.framing = "ascii"
+        self.stream_ids = {}
+        self.decoder = self.make_decoder()
+        self.chunk_size = 1 << 16
+        self.emitted = 0 # batches emitted
+        self.backlog = 0 # bytes read but not decoded yet (partial frames)
+        self.handoff = Handoff.BatchHandoff() # to the traces, dataReceived is for direct consumers (e.g. the recorder)
+        self.parsed.connect(self.apply_parsed)
     
-    def parseHeaders(self, headers):
-        
-        self.parser = CParser(headers)
-        self.dtypes = {}
-        for (struct_name, s) in self.parser.defs['structs'].items():
-            members = s['members']
-            for (name, type, default_Value) in members:
-                c_typename = type[0]
-                if c_typename in self.parser.defs['structs'] and c_typename not in self.dtypes:
-                    self.add_type(c_typename, self.parser.defs['structs'][c_typename])
-
-            self.add_dtype(struct_name, members)
-        
-    def beginListneing(self, serial_port = None):
-        self._serial_port = serial_port
-        self.start()
+    def parseHeaders(self, headers, background = True):
+        '''
+            Sets self.dtypes from the cache if the headers were parsed before,
+            otherwise parses them, in a background thread unless 'background'
+            is False. headersParsed is emitted once dtypes are set.
+            The dtypes of a parse are only set in this object's thread, and
+            not at all if parseHeaders() was called again meanwhile.
+        '''
+        t = time.perf_counter()
+        self._generation += 1
+        key = HeaderCache.cache_key(headers, self.include_paths, self.abi)
+        dtypes = HeaderCache.load(key)
+        if dtypes is not None:
+            self.set_dtypes(dtypes)
+            self.headersParsed.emit(True, time.perf_counter() - t)
+            return
+        self.wait_for_headers()
+        if background:
+            self._parse_thread = threading.Thread(target = self.parse, args = (headers, key, t, self._generation), daemon = True)
+            self._parse_thread.start()
+        else:
+            self.parse(headers, key, t, self._generation)
+            self.apply_parsed()
 
-    def add_dtype(self, struct_name, members):
-        if struct_name not in self.dtypes:
-            np_type = np.dtype([self.to_dtype(name, type) for (name, type, default_Value) in members])
-            self.dtypes[struct_name] = np_type
+    def parse(self, headers, key, t, generation):
+        try:
+            paths = [HeaderCache.find_header(header, self.include_paths) for header in headers]
+            self.parser = CParser(paths, replace = {r'__attribute__\s*\(\(.*?\)\)': ''}) # packing is read from the sources
+            texts = []
+            for path in paths:
+                with open(path) as f:
+                    texts.append(f.read())
+            dtypes = Layout.LayoutEngine(self.parser.defs, Layout.packing(texts), self.abi).dtypes()
+        except Exception as e:
+            logging.error(e, exc_info=True)
+            return
+        HeaderCache.store(key, dtypes)
+        with self._parse_lock:
+            self._parsed = (generation, dtypes, time.perf_counter() - t)
+        self.parsed.emit() # queued to this object's thread when parsing in the background
 
+    @Slot()
+    def apply_parsed(self):
+        with self._parse_lock:
+            parsed, self._parsed = self._parsed, None
+        if parsed is None:
+            return
+        generation, dtypes, seconds = parsed
+        if generation != self._generation: # headers or abi changed while parsing
+            return
+        self.set_dtypes(dtypes)
+        self.headersParsed.emit(False, seconds)
 
-    def to_dtype(self, name, type):
-        c_typename = type[0]
-        n = 0
-        if c_typename in self.dtypes:
-            return (name, self.dtypes[c_typename])
+    def wait_for_headers(self):
+        if self._parse_thread is not None:
+            self._parse_thread.join()
+            self._parse_thread = None
+        self.apply_parsed() # may not have been delivered yet
 
-        if c_typename.endswith("_t"): #e.g. uint18_t -> uint8
-            c_typename = c_typename[:-2]
+    def set_dtypes(self, dtypes):
+        self.dtypes = dtypes
+        self.decoder = self.make_decoder()
 
-        try:
-            ctype = getattr(ctypes, f"c_{c_typename}")
-        except:
-            raise SimpleFOCParsingException(type)
+    def make_decoder(self):
+        if self.framing == "binary":
+            return FrameDecoder.BinaryFrameDecoder(self.dtypes, self.stream_ids)
+        return FrameDecoder.AsciiFrameDecoder(self.dtypes)
+
+    def make_encoder(self):
+        return FrameDecoder.make_encoder(self.framing, self.dtypes, self.stream_ids)
 
-        if len(type) > 1:
-            return (name, ctype, type[1][0])
+    def set_framing(self, framing, stream_ids = None):
+        if framing not in FrameDecoder.DECODERS:
+            raise RuntimeError(f"Unknown framing '{framing}', expected one of {list(FrameDecoder.DECODERS)}")
+        self.framing = framing
+        self.stream_ids = stream_ids or {}
+        self.decoder = self.make_decoder()
         
-        return (name, ctype)
+    def beginListneing(self, source = None):
+        '''
+            'source' is an opened FrameSources.FrameSource, the demo source is used if None
+        '''
+        if source is None:
+            self.wait_for_headers()
+            source = FrameSources.DemoSource(self.make_encoder(), self.dtypes["Demo"])
+        self._source = source
+        self.start()
 
-    def handle_received_data(self, header_string, data, header_dtype):
+    def handle_received_data(self, data, t_read = None):
+        '''
+            decodes a chunk of bytes and emits one array per struct type found,
+            returns the {name: frames} emitted and the decode time
+        '''
+        if t_read is None:
+            t_read = time.monotonic()
+        batch, t_decode = {}, t_read
         try:
-            b = np.frombuffer(data, header_dtype)
-            self.dataReceived.emit(header_string, b)
+            decoder = self.decoder
+            errors = (decoder.bad_frames, decoder.dropped_bytes)
+            batch = decoder.feed(data)
+            t_decode = time.monotonic()
+            self.backlog = len(decoder._pending)
+            for (header_string, b) in batch.items():
+                self.emitted += 1
+                self.dataReceived.emit(header_string, b, t_read, t_decode)
+                self.handoff.push(header_string, b, t_read, t_decode)
+            if errors != (decoder.bad_frames, decoder.dropped_bytes):
+                self.decodeErrors.emit(decoder.bad_frames, decoder.dropped_bytes)
 
         except Exception as e:
             logging.error(e, exc_info=True)
-
-    def match_header(self, header):
-        if header in self.dtypes:
-            return self.dtypes[header]
-
-        logging.warning(f"Header '{header}' not reckognized")
-        
-        return None
+        return batch, t_decode
 
     def run(self):
+        chunk = bytearray(self.chunk_size) # reused for every read
+        view = memoryview(chunk)
+        source = self._source
         try:
             while not self.stopped():
-                if self._serial_port is not None:
-                    if self._serial_port.isOpen():
-                        header_dtype = None
-                        
-                        while True:
-                            header_string = self._serial_port.readline().rstrip().decode("ascii")
-                            if header_string:
-                                header_dtype = self.match_header(header_string)
-                            if header_dtype is not None :
-                                break
-                        data = self._serial_port.read(header_dtype.itemsize)
-                        self.handle_received_data(header_string, data, header_dtype)
-                else:
-                    t = time.time()
-                    dtype = self.dtypes["Demo"]
-                    self.dataReceived.emit("Demo", np.array([(np.sin(t), np.cos(t))], dtype ))
-                    self.msleep(1)
-                        
+                count = source.readinto(view)
+                if count:
+                    self.handle_received_data(view[:count], time.monotonic())
+
         except serial.SerialException as serialException:
             logging.error(serialException, exc_info=True)
         except TypeError as typeError:
@@ -156,6 +458,8 @@ class SerialPortListener(QtCore.QThread):
             logging.error(ae, exc_info=True)
         except Exception as e:
              logging.error(e, exc_info=True)          
+        finally:
+            source.close()
 
     def stop(self):
         self._stop_event.set()
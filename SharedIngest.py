@@ -0,0 +1,356 @@
+# This Python file uses the following encoding: utf-8
+'''
+    Ingest and decode in a separate process, so the GUI thread holding the
+    GIL (rendering, refresh) can't make the serial input overrun.
+
+    The decoder process writes the frames of each struct into its own ring
+    in a multiprocessing.shared_memory block; the GUI process gets views
+    of the new frames and copies them straight into its buffers, nothing
+    else is serialized or copied on the way. Each ring has a header
+    holding two sequence numbers (frames ever written):
+    - WRITING, set before the writer overwrites anything: frames older
+      than WRITING - capacity may be overwritten from then on
+    - PUBLISHED, set once the frames are written
+    The reader only hands out frames below PUBLISHED and, once the
+    consumer copied them, checks with WRITING that they weren't
+    overwritten meanwhile: the consumer takes those out again before
+    anything else reads them. It never hands out frames more than half a
+    ring behind the writer: to tear them, the writer would have to write
+    half a ring of frames during the copy.
+    The decoder process is woken up by nothing but its source; the GUI is
+    woken up through a pipe, at most once per drain (see SIGNALLED).
+    Commands to the MCU (see Commands) go through another pipe, the decoder
+    process writes them to its source between two reads.
+
+    This file is also the decoder process' main:
+    python SharedIngest.py <shared memory name> <config json> <notify fd> [pty fd]
+'''
+import json
+import logging
+import os
+import select
+import subprocess
+import sys
+import time
+import numpy as np
+from multiprocessing import shared_memory, resource_tracker
+from PySide6.QtCore import QObject, QSocketNotifier, Signal, Slot
+import FrameDecoder
+import FrameSources
+import HeaderCache
+
+CONTROL = 64 # bytes
+RING_HEADER = 64 # bytes
+RING_MEMORY = 64 << 20 # bytes for all the rings, unless their capacity is given
+MIN_CAPACITY = 4096 # frames per ring
+POLL_INTERVAL = 0.05 # seconds, the decoder process checks STOP at least this often
+# control block, int64
+SIGNALLED, STOP, BAD_FRAMES, DROPPED_BYTES, BACKLOG, FRAMES = range(6)
+# ring header, int64 then float64
+PUBLISHED, WRITING, T_READ, T_DECODE = range(4)
+
+def capacities(dtypes, capacity = 0):
+    '''
+        frames per ring: 'capacity' if given, else as many as fit an equal
+        share of RING_MEMORY, at least MIN_CAPACITY
+    '''
+    if capacity > 0:
+        return {name: capacity for name in dtypes}
+    share = RING_MEMORY // max(len(dtypes), 1)
+    return {name: max(share // max(dtype.itemsize, 1), MIN_CAPACITY) for (name, dtype) in dtypes.items()}
+
+def layout(dtypes, capacities):
+    '''
+        returns {struct name: (offset, capacity)} of each ring and the size of the block
+    '''
+    offset = CONTROL
+    rings = {}
+    for (name, dtype) in dtypes.items():
+        capacity = capacities[name]
+        rings[name] = (offset, capacity)
+        offset += RING_HEADER + -(-capacity * dtype.itemsize // 64) * 64 # rings stay 64 bytes aligned
+    return rings, offset
+
+class SharedFrames(object):
+    '''
+        Views of the control block and of the rings in a shared memory block.
+    '''
+    def __init__(self, shm, dtypes, rings):
+        self.shm = shm
+        self.control = np.ndarray(CONTROL // 8, np.int64, shm.buf, 0)
+        self.rings = {}
+        for (name, (offset, capacity)) in rings.items():
+            header = np.ndarray(RING_HEADER // 8, np.int64, shm.buf, offset)
+            times = np.ndarray(RING_HEADER // 8, np.float64, shm.buf, offset)
+            data = np.ndarray(capacity, dtypes[name], shm.buf, offset + RING_HEADER)
+            self.rings[name] = (header, times, data)
+
+    def write(self, name, frames, t_read, t_decode):
+        '''
+            writer side, only the last 'capacity' frames are kept if there are more
+        '''
+        header, times, data = self.rings[name]
+        capacity = data.shape[0]
+        total = int(header[PUBLISHED]) + frames.shape[0]
+        frames = frames[-capacity:]
+        n = frames.shape[0]
+        header[WRITING] = total
+        start = (total - n) % capacity
+        split = min(n, capacity - start)
+        data[start:start + split] = frames[:split]
+        data[:n - split] = frames[split:]
+        times[T_READ], times[T_DECODE] = t_read, t_decode
+        header[PUBLISHED] = total
+
+    def close(self):
+        self.control = None
+        self.rings = {} # views must be released before the block is closed
+        self.shm.close()
+
+def make_source(config, pty_fd):
+    dtypes = config["dtypes"]
+    encode = FrameDecoder.make_encoder(config["framing"], dtypes, config["stream_ids"])
+    if pty_fd is not None: # opened by the GUI process, which shows its name
+        source = FrameSources.PtySource()
+        source.master = pty_fd
+        return source
+    try:
+        source = FrameSources.make_source(config["source_type"], config["port"], config["bauds"], encode,
+                                          dtypes.get("Demo"), config["replay_speed"])
+        source.open()
+        return source
+    except Exception as e:
+        logging.warning(f"Could not open {config['source_type']} source '{config['port']}' ({e}), falling back to demo")
+        return FrameSources.DemoSource(encode, dtypes["Demo"])
+
+def run(name, config, notify_fd, pty_fd = None):
+    '''
+        decoder process: reads the source and writes the decoded frames
+        into the shared rings until STOP is set. Waits on the source and
+        the commands with select(), waking up every POLL_INTERVAL to check
+        STOP, sources without a file descriptor wait in readinto().
+    '''
+    shm = shared_memory.SharedMemory(name)
+    resource_tracker.unregister(shm._name, "shared_memory") # the GUI process owns and unlinks it
+    config["dtypes"] = {struct: HeaderCache.dtype_from_json(dtype) for (struct, dtype) in config["dtypes"]}
+    frames = SharedFrames(shm, config["dtypes"], {struct: tuple(ring) for (struct, ring) in config["rings"].items()})
+    control = frames.control
+    if config["framing"] == "binary":
+        decoder = FrameDecoder.BinaryFrameDecoder(config["dtypes"], config["stream_ids"])
+    else:
+        decoder = FrameDecoder.AsciiFrameDecoder(config["dtypes"])
+    source = make_source(config, pty_fd)
+    command_fd = config["command_fd"]
+    os.set_blocking(command_fd, False)
+    source_fd = source.fileno()
+    waited = [source_fd, command_fd]
+    chunk = bytearray(1 << 16)
+    view = memoryview(chunk)
+    try:
+        while not control[STOP]:
+            try:
+                commands = os.read(command_fd, 4096)
+                if not commands: # closed by the GUI process, always readable from now on
+                    waited = [source_fd]
+            except BlockingIOError:
+                commands = b''
+            if commands:
+                source.write(commands)
+            if source_fd is not None: # else readinto() waits for the source
+                readable, _, _ = select.select(waited, [], [], POLL_INTERVAL)
+                if source_fd not in readable:
+                    continue
+            count = source.readinto(view)
+            if not count:
+                if source_fd is not None: # readable but empty: closed on the other end, don't spin
+                    time.sleep(POLL_INTERVAL)
+                continue
+            t_read = time.monotonic()
+            batch = decoder.feed(view[:count])
+            t_decode = time.monotonic()
+            for (struct, array) in batch.items():
+                frames.write(struct, array, t_read, t_decode)
+                control[FRAMES] += array.shape[0]
+            control[BAD_FRAMES], control[DROPPED_BYTES], control[BACKLOG] = decoder.bad_frames, decoder.dropped_bytes, len(decoder._pending)
+            if batch and not control[SIGNALLED]:
+                control[SIGNALLED] = 1
+                os.write(notify_fd, b'\0')
+    except Exception as e:
+        logging.error(e, exc_info=True)
+    finally:
+        source.close()
+        del control
+        frames.close()
+        os.close(notify_fd)
+        os.close(command_fd)
+
+class SharedRingReader(QObject):
+    '''
+        GUI side of the rings, drained like a Handoff.BatchHandoff: 'ready'
+        is emitted when frames were published after the last drain().
+        drain() returns views of the new frames in the rings, valid until
+        release(). Once the consumer copied the next frames drained for a
+        struct, overwritten() tells how many of them the writer may have
+        overwritten meanwhile: they are counted in 'torn' and must be
+        discarded. Frames the reader fell behind on are skipped and counted
+        in 'dropped'.
+    '''
+    ready = Signal()
+
+    def __init__(self, frames, notify_fd, parent = None):
+        super(SharedRingReader, self).__init__(parent)
+        self.frames = frames
+        self.consumers = 0
+        self.consumed = {name: 0 for name in frames.rings}
+        self.dropped = 0
+        self.torn = 0
+        self.drained = 0
+        self._handed = {} # name -> sequence number of the next frame drained and not checked yet
+        self._notify_fd = notify_fd
+        self._notifier = QSocketNotifier(notify_fd, QSocketNotifier.Read, self)
+        self._notifier.activated.connect(self.on_notify)
+
+    @Slot()
+    def on_notify(self):
+        if not os.read(self._notify_fd, 4096): # the decoder process exited
+            self._notifier.setEnabled(False)
+        self.ready.emit()
+
+    def __len__(self):
+        return sum(1 for (name, (header, _, _)) in self.frames.rings.items() if header[PUBLISHED] > self.consumed[name])
+
+    @property
+    def pending(self):
+        return sum(int(header[PUBLISHED]) - self.consumed[name] for (name, (header, _, _)) in self.frames.rings.items())
+
+    def drain(self):
+        '''
+            returns (name, frames, t_read, t_decode) for every ring with new
+            frames, 'frames' being a view of the ring (two if it wraps)
+        '''
+        self.frames.control[SIGNALLED] = 0 # before reading, so frames published meanwhile signal again
+        batches = []
+        for (name, (header, times, data)) in self.frames.rings.items():
+            capacity = data.shape[0]
+            end = int(header[PUBLISHED])
+            first = self.consumed[name]
+            if end == first:
+                continue
+            if first < end - capacity // 2: # leave the writer half a ring to write while the views are used
+                self.dropped += end - capacity // 2 - first
+                first = end - capacity // 2
+            t_read, t_decode = float(times[T_READ]), float(times[T_DECODE])
+            start = first % capacity
+            split = min(end - first, capacity - start)
+            batches.append((name, data[start:start + split], t_read, t_decode))
+            if split < end - first:
+                batches.append((name, data[:end - first - split], t_read, t_decode))
+            self._handed[name] = first
+            self.consumed[name] = end
+            self.drained += end - first
+        return batches
+
+    def overwritten(self, name, count):
+        '''
+            consumer side, once it copied the next 'count' frames drained
+            for 'name': how many of them, the oldest, the writer may have
+            overwritten before the copy ended. Those must be discarded.
+        '''
+        header, _, data = self.frames.rings[name]
+        first = self._handed[name]
+        self._handed[name] = first + count
+        torn = max(min(int(header[WRITING]) - data.shape[0], first + count) - first, 0) # checked after the copy
+        if torn > 0:
+            self.torn += torn
+            logging.warning(f"{name}: {torn} frames were overwritten while being read, discarded")
+        return torn
+
+    def release(self):
+        '''
+            consumer side, once the drained frames were stored: the views
+            aren't used anymore. Frames drained but never checked with
+            overwritten() (not stored) are checked now, to count them.
+        '''
+        for (name, first) in list(self._handed.items()):
+            if self.consumed[name] > first:
+                self.overwritten(name, self.consumed[name] - first)
+        self._handed = {}
+
+    def close(self):
+        self._notifier.setEnabled(False)
+        os.close(self._notify_fd)
+
+class DecoderProcess(object):
+    '''
+        Runs run() in a child process, owns the shared memory block.
+    '''
+    STOP_TIMEOUT = 1.0 # seconds
+
+    def __init__(self, dtypes, capacity = 0):
+        '''
+            'capacity': frames per ring, 0: see capacities()
+        '''
+        self.dtypes = dtypes
+        self.rings, size = layout(dtypes, capacities(dtypes, capacity))
+        self.shm = shared_memory.SharedMemory(create = True, size = size)
+        self.frames = SharedFrames(self.shm, dtypes, self.rings)
+        self.frames.control[:] = 0
+        self.process = None
+        self.reader = None
+        self._command_fd = None
+
+    def start(self, source_type, port, bauds, framing, stream_ids, replay_speed, pty_fd = None):
+        '''
+            returns the SharedRingReader to attach to the scope
+        '''
+        config = {"dtypes": [[name, HeaderCache.dtype_to_json(dtype)] for (name, dtype) in self.dtypes.items()],
+                  "rings": self.rings, "framing": framing, "stream_ids": stream_ids, "source_type": source_type,
+                  "port": port, "bauds": bauds, "replay_speed": replay_speed}
+        notify_r, notify_w = os.pipe()
+        command_r, self._command_fd = os.pipe()
+        config["command_fd"] = command_r
+        fds = (notify_w, command_r) if pty_fd is None else (notify_w, command_r, pty_fd)
+        command = [sys.executable, os.path.abspath(__file__), self.shm.name, json.dumps(config), str(notify_w)]
+        if pty_fd is not None:
+            command.append(str(pty_fd))
+        self.process = subprocess.Popen(command, pass_fds = fds, cwd = os.path.dirname(os.path.abspath(__file__)))
+        os.close(notify_w)
+        os.close(command_r)
+        self.reader = SharedRingReader(self.frames, notify_r)
+        return self.reader
+
+    def send(self, data):
+        '''
+            bytes for the decoder process to write to its source
+        '''
+        if self._command_fd is not None:
+            os.write(self._command_fd, data)
+
+    @property
+    def control(self):
+        return self.frames.control
+
+    def stop(self):
+        if self.process is not None:
+            self.frames.control[STOP] = 1
+            try:
+                self.process.wait(self.STOP_TIMEOUT)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+                self.process.wait()
+            self.process = None
+        if self._command_fd is not None:
+            os.close(self._command_fd)
+            self._command_fd = None
+        if self.reader is not None:
+            self.reader.close()
+            self.reader = None
+        try:
+            self.frames.close()
+        except BufferError: # views still referenced, the block is unmapped when they are collected
+            pass
+        self.shm.unlink()
+
+if __name__ == "__main__":
+    logging.basicConfig()
+    run(sys.argv[1], json.loads(sys.argv[2]), int(sys.argv[3]), int(sys.argv[4]) if len(sys.argv) > 4 else None)
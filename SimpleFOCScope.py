@@ -1,43 +1,414 @@
 # This Python file uses the following encoding: utf-8
-from PySide6.QtGui import QPolygonF
 from PySide6.QtQml import QQmlProperty, QmlElement
 from PySide6.QtQuick import QQuickItem
-from PySide6.QtCore import Signal, Property, Slot, QGenericArgument
+from PySide6.QtCore import Signal, Property, Slot, QGenericArgument, QCoreApplication, QTimer
+from PySide6.QtGui import QGuiApplication
 import PySide6.QtCharts #critical for QObject returned from self._chart.createSeriesWithLabel() to be casted in QLineSeries
-import shiboken6
-import ctypes
+import math
+import os
+import tempfile
+import time
 import numpy as np
 import Product
+import Decimation
+import Layout
+from RingBuffer import RingBuffer
+from Extrema import BlockExtrema
+from History import SpilledHistory
+from Pyramid import MinMaxPyramid
+from Polyline import PolylineBuffer
+from Latency import LatencyStats, BINS
+from Trigger import SimpleFOCTrigger
 
 class SimpleFOCScope(Product.Product):
     def __init__(self, parent = None):
         super(SimpleFOCScope, self).__init__(parent)
-        self._xdata = None
         self._spacing = 500.0
         self._normalize = False
         self._chart = None
+        self._trigger = None
         self.arrays = {}
         self.buffers = {}
+        self.times = {} # dataSource -> RingBuffer of each sample's time (seconds), in step with buffers
+        self.extrema = {}
+        self.pyramids = {} # dataSource -> MinMaxPyramid of the samples that can be shown
+        self.polylines = {} # (dataSource, label) -> PolylineBuffer
         self._xMin = 0
         self._xMax = 0
+        self._xFirst = 0.0
+        self._xLast = 0.0
         self._yMin = 0
         self._yMax = 0
         self._dtypes = {}
         self._selected = {}
+        self._bufferDepth = 100000
+        self._bufferDuration = 0.0
+        self._memoryBudget = 0
+        self._historyDirectory = ""
+        self._spilledSamples = 0
+        self.histories = {} # dataSource -> SpilledHistory of the samples evicted from buffers, when memoryBudget is set
+        self._spill_directory = None # temporary, when historyDirectory isn't set
+        self._rates = {} # dataSource -> (first receive time, samples received)
+        self._windowSize = 1000
+        self._windowDuration = 0.0
+        self._follow = True
+        self._windowEnd = 0.0
+        self._xAxis = "index"
+        self._timestampFields = {}
+        self._timestampScales = {}
+        self._arrivals = {} # dataSource -> receive times of the batches not stored yet
+        self._handed = {} # dataSource -> handoff of each batch not stored yet, None if received directly
+        self._arrived = {} # dataSource -> receive time of the last batch stored
+        self._ticks = {} # dataSource -> (last raw timestamp, wrap arounds) of wrapping counters
+        self._origin = None # time of x = 0
+        self._newest = 0.0 # seconds, newest sample time of the displayed sources
+        self._decimation = "minmax"
+        self._pointsPerPixel = 2.0
+        self._autoscale = "window"
+        self._envelopeDecay = 0.05
+        self._fixedYMin = -1.0
+        self._fixedYMax = 1.0
+        self.latencies = LatencyStats(["decode", "delivery", "store", "draw"])
+        self._stamps = {} # dataSource -> read times of the batches not stored yet
+        self._undrawn = {} # dataSource -> read times of the batches stored but not drawn yet
+        self.delivered = 0 # batches received
+        self.handoffs = [] # Handoff.BatchHandoff drained by _update
+        self._latency = self.latencies.summary()
+        self._latencyHistograms = self.latencies.histograms()
+        self._pendingFrames = 0
+        self._published = 0.0
+        self._drawn = {} # dataSource -> (what was drawn, (x min, x max, y min, y max))
+        self._autoRefresh = True
+        self._targetFps = 0.0
+        self._refreshTime = 0.0
+        self._fps = 0.0
+        self._budgetScale = 1.0
+        self._cost = 0.0 # seconds, smoothed refresh time
+        self._lastRefresh = 0.0
+        self._frames = (time.monotonic(), 0) # fps measurement start, refreshes since
+        self._refreshTimer = QTimer(self)
+        self._refreshTimer.setSingleShot(True)
+        self._refreshTimer.timeout.connect(self.refresh)
+        self.productDirty.connect(self.schedule_refresh)
 
 
     def _update(self):
-        self._xdata = None
-        for dataSource in self.dataSources:
+        for handoff in self.handoffs:
+            for (name, buffer, t_read, t_decode) in handoff.drain():
+                self.receive(name, buffer, t_read, t_decode, handoff)
 
-            new = np.hstack(self.arrays[dataSource])
-            
-            if dataSource in self.buffers:
-                self.buffers[dataSource] = np.hstack([self.buffers[dataSource], new])
-            else:
-                self.buffers[dataSource] = new
+        stored = False
+        for dataSource in self.dataSources:
 
+            pending = self.arrays[dataSource]
+            if not pending:
+                continue
             self.arrays[dataSource] = []
+            arrivals = self._arrivals.pop(dataSource)
+            handoffs = self._handed.pop(dataSource)
+            stored = True
+
+            depth = self.depth_for(dataSource, pending[0].dtype)
+            if dataSource not in self.buffers:
+                self.buffers[dataSource] = RingBuffer(pending[0].dtype, depth)
+                self.times[dataSource] = RingBuffer(np.float64, depth)
+                self.extrema[dataSource] = BlockExtrema(self.buffers[dataSource])
+                self.pyramids[dataSource] = MinMaxPyramid(pending[0].dtype)
+            buffer = self.buffers[dataSource]
+            times = self.times[dataSource]
+            history = self.history(dataSource)
+            if abs(depth - buffer.depth) > buffer.depth // 8: # follow rate changes when depth is given in seconds
+                if history is not None:
+                    history.evict(buffer, times, depth)
+                buffer.resize(depth)
+                times.resize(depth)
+            count = sum(self.store(dataSource, array, arrival, handoff) for (array, arrival, handoff) in zip(pending, arrivals, handoffs))
+            self.pyramids[dataSource].discard(self.oldest(dataSource))
+            if self._memoryBudget > 0:
+                self.pyramids[dataSource].limit(self._memoryBudget * (1 << 20) * self.PYRAMID_FRACTION / max(len(self.arrays), 1))
+            if self._origin is None:
+                self._origin = float(times.last(len(times))[0])
+            self.extrema[dataSource].update()
+            if self._trigger is not None and self._trigger.dataSource == dataSource:
+                self._trigger.process(buffer, count)
+
+            stamps = self._stamps.pop(dataSource, None)
+            if stamps:
+                self.latencies.add("store", time.monotonic() - np.array(stamps))
+                self._undrawn.setdefault(dataSource, []).extend(stamps)
+        for handoff in self.handoffs:
+            handoff.release() # drained batches may be views, they are copied into the buffers by now
+        if stored:
+            self.publish_spilled()
+        return stored # dependents (e.g. Dsp stages) are skipped if nothing new was stored
+
+    def store(self, dataSource, array, arrival, handoff = None):
+        '''
+            appends 'array' to the buffers of 'dataSource' and returns the
+            number of samples stored. It may be a view of a SharedIngest
+            ring: it is copied straight into the buffer, at most a buffer
+            depth at a time so only samples already stored get spilled to
+            the history, and the samples 'handoff' reports overwritten during
+            the copy are taken out again before anything else reads them.
+        '''
+        buffer, times, history = self.buffers[dataSource], self.times[dataSource], self.history(dataSource)
+        spread = None if self._timestampFields.get(dataSource) else self.timestamps(dataSource, array, arrival) # doesn't read the samples
+        count = 0
+        for start in range(0, array.shape[0], buffer.depth):
+            chunk = array[start:start + buffer.depth]
+            n = chunk.shape[0]
+            if history is not None:
+                history.evict(buffer, times, buffer.depth, chunk)
+            buffer.append(chunk)
+            torn = handoff.overwritten(dataSource, n) if handoff is not None else 0
+            if torn > 0: # the oldest of the chunk
+                kept = buffer.last(n - torn).copy()
+                buffer.truncate(n)
+                buffer.append(kept)
+                if torn == n:
+                    continue
+            samples = buffer.last(n - torn)
+            t = spread[start + torn:start + n] if spread is not None else self.timestamps(dataSource, samples, arrival)
+            times.append(t)
+            self.pyramids[dataSource].append(samples, t)
+            count += n - torn
+        return count
+
+    def timestamps(self, dataSource, array, arrival):
+        '''
+            time of each sample of 'array' in seconds: its timestamp field
+            ('timestampFields') times its scale ('timestampScales') if the
+            data source has one, else the host receive time, the frames of a
+            batch being spread over the time they took to arrive
+        '''
+        n = array.shape[0]
+        field = self._timestampFields.get(dataSource)
+        if field:
+            ticks = Layout.channel(array, field)
+            if ticks.dtype.kind == 'u' and ticks.dtype.itemsize <= 4: # a wrapping counter, e.g. micros()
+                period = 1 << (8 * ticks.dtype.itemsize)
+                ticks = ticks.astype(np.int64)
+                last, wraps = self._ticks.get(dataSource, (ticks[0], 0))
+                wraps = wraps + np.cumsum(np.diff(ticks, prepend = last) < -period // 2)
+                self._ticks[dataSource] = (ticks[-1], int(wraps[-1]))
+                ticks = ticks + wraps * period
+            return ticks.astype(np.float64) * float(self._timestampScales.get(dataSource, 1.0))
+
+        span = arrival - self._arrived.get(dataSource, arrival)
+        self._arrived[dataSource] = arrival
+        t0, count = self._rates[dataSource]
+        if arrival > t0 and count > n: # after a pause, the batch took no longer than at the mean rate
+            span = min(span, n * (arrival - t0) / (count - n))
+        return arrival - span + span * np.arange(1, n + 1) / n
+
+    HOT_FRACTION = 0.75 # of memoryBudget for the buffers
+    PYRAMID_FRACTION = 0.1 # for the min/max pyramids, the rest caches the history read back
+
+    def depth_for(self, dataSource, dtype):
+        '''
+            number of samples to keep for 'dataSource', from 'bufferDuration' if
+            set and the source rate is known, from 'bufferDepth' otherwise,
+            within its share of 'memoryBudget' if set
+        '''
+        depth = self._bufferDepth
+        if self._bufferDuration > 0 and dataSource in self._rates:
+            t0, count = self._rates[dataSource]
+            elapsed = time.monotonic() - t0
+            if elapsed > 0 and count > 1:
+                depth = max(1, math.ceil(self._bufferDuration * count / elapsed))
+        if self._memoryBudget > 0:
+            share = self._memoryBudget * (1 << 20) * self.HOT_FRACTION / max(len(self.arrays), 1)
+            depth = min(depth, max(1, int(share // (2 * (dtype.itemsize + 8))))) # samples and times, RingBuffer keeps twice its depth
+        return depth
+
+    def history(self, dataSource):
+        '''
+            the SpilledHistory of 'dataSource', None if memoryBudget isn't set
+        '''
+        if self._memoryBudget <= 0:
+            return None
+        history = self.histories.get(dataSource)
+        if history is None:
+            directory = self._historyDirectory
+            if not directory:
+                if self._spill_directory is None:
+                    self._spill_directory = tempfile.TemporaryDirectory(prefix = "simplefocscope-")
+                directory = self._spill_directory.name
+            os.makedirs(directory, exist_ok = True)
+            history = self.histories[dataSource] = SpilledHistory(os.path.join(directory, f"{dataSource}.bin"), self.buffers[dataSource].dtype)
+        history.cache_bytes = self._memoryBudget * (1 << 20) * (1 - self.HOT_FRACTION - self.PYRAMID_FRACTION) / max(len(self.arrays), 1)
+        return history
+
+    def cb_depth(self, old_value):
+        if self._memoryBudget <= 0:
+            for history in self.histories.values():
+                history.close()
+            self.histories = {}
+        for (dataSource, buffer) in self.buffers.items():
+            depth = self.depth_for(dataSource, buffer.dtype)
+            history = self.history(dataSource)
+            if history is not None:
+                history.evict(buffer, self.times[dataSource], depth)
+            buffer.resize(depth)
+            self.times[dataSource].resize(buffer.depth)
+        self.publish_spilled()
+
+    def publish_spilled(self):
+        self.set_spilledSamples(self, sum(len(history) for history in self.histories.values()))
+
+    Product.RWProperty(vars(), int, "bufferDepth", cb_depth)
+    Product.RWProperty(vars(), float, "bufferDuration", cb_depth)
+    Product.RWProperty(vars(), int, "memoryBudget", cb_depth) # MB for the samples, 0: unbounded. Older samples are spilled to disk
+    Product.RWProperty(vars(), str, "historyDirectory") # where spilled samples go, a temporary directory if empty
+    Product.ROProperty(vars(), int, "spilledSamples") # on disk, all data sources
+
+    def oldest(self, dataSource):
+        '''
+            absolute index of the oldest sample of 'dataSource' that can be read()
+        '''
+        buffer = self.buffers[dataSource]
+        history = self.histories.get(dataSource)
+        if history is not None and len(history) > 0 and history.end == buffer.total - len(buffer):
+            return history.first
+        return buffer.total - len(buffer)
+
+    def read(self, dataSource, first, count):
+        '''
+            copies of the times and samples of absolute indices [first, first + count)
+            of 'dataSource', the older ones paged in from its history
+        '''
+        buffer, times = self.buffers[dataSource], self.times[dataSource]
+        retained = buffer.total - len(buffer)
+        parts = []
+        if first < retained:
+            history = self.histories.get(dataSource)
+            if history is None:
+                raise IndexError(f"samples [{first}, {retained}) of {dataSource} are not kept")
+            parts.append(history.read(first, min(count, retained - first)))
+        if first + count > retained:
+            start = max(first, retained)
+            parts.append((times.read(start, first + count - start), buffer.read(start, first + count - start)))
+        if len(parts) == 1:
+            return parts[0]
+        return np.concatenate([t for (t, _) in parts]), np.concatenate([data for (_, data) in parts])
+
+    def index_of_x(self, dataSource, x):
+        '''
+            absolute index of the first sample of 'dataSource' at or after 'x'
+            (x axis units: sample index, or seconds with xAxis "time")
+        '''
+        if self._xAxis == "time" and self._origin is not None:
+            return self.index_at(dataSource, x + self._origin)
+        return int(math.ceil(x))
+
+    def index_at(self, dataSource, t):
+        '''
+            absolute index of the first sample of 'dataSource' at or after time 't' (seconds)
+        '''
+        times = self.times[dataSource]
+        retained = times.last(len(times))
+        history = self.histories.get(dataSource)
+        if history is not None and len(history) > 0 and (retained.shape[0] == 0 or t < retained[0]):
+            return history.index_at(t)
+        return times.total - retained.shape[0] + int(np.searchsorted(retained, t))
+
+    Product.RWProperty(vars(), int, "windowSize") # number of samples displayed, see also windowDuration
+    Product.RWProperty(vars(), bool, "follow") # the window ends at the newest sample, else at windowEnd
+    Product.RWProperty(vars(), float, "windowEnd") # x of the end of the window when not following, older samples are paged in from the history
+
+    X_AXES = ["index", "time"]
+
+    def cb_xAxis(self, old_value):
+        if self._xAxis not in self.X_AXES:
+            raise RuntimeError(f"Unknown x axis '{self._xAxis}', expected one of {self.X_AXES}")
+        self._drawn = {}
+        self.schedule_refresh()
+
+    Product.RWProperty(vars(), str, "xAxis", cb_xAxis) # "index": absolute sample index, "time": seconds
+    Product.RWProperty(vars(), float, "windowDuration", cb_xAxis) # seconds displayed with the "time" x axis, 0: windowSize samples
+    Product.RWProperty(vars(), 'QVariantMap', "timestampFields") # {dataSource: field}, the host receive time for the others
+    Product.RWProperty(vars(), 'QVariantMap', "timestampScales") # {dataSource: seconds per unit of its timestamp field}, 1 if missing
+    Product.RWProperty(vars(), str, "decimation") # one of Decimation.METHODS
+    Product.RWProperty(vars(), float, "pointsPerPixel")
+
+    Product.RWProperty(vars(), str, "autoscale") # "window", "envelope" or "fixed"
+    Product.RWProperty(vars(), float, "envelopeDecay") # fraction of the gap to the window range recovered per refresh
+    Product.RWProperty(vars(), float, "fixedYMin")
+    Product.RWProperty(vars(), float, "fixedYMax")
+
+    def y_range(self, y_min, y_max):
+        '''
+            applies the autoscale mode to the range of the visible window
+        '''
+        if self._autoscale == "fixed":
+            return self._fixedYMin, self._fixedYMax
+        if self._autoscale == "envelope" and self._yMin < self._yMax:
+            # expand at once, shrink slowly
+            y_min = min(y_min, self._yMin + self._envelopeDecay * (y_min - self._yMin))
+            y_max = max(y_max, self._yMax + self._envelopeDecay * (y_max - self._yMax))
+        return y_min, y_max
+
+    def point_budget(self):
+        '''
+            number of points drawn per series, whatever the window size
+        '''
+        width = self._chart.width() if self._chart is not None else 0
+        return max(int(self._pointsPerPixel * self._budgetScale * (width if width > 0 else 800)), 4)
+
+    def cb_autoRefresh(self, old_value):
+        if self.dirty:
+            self.schedule_refresh()
+
+    Product.RWProperty(vars(), bool, "autoRefresh", cb_autoRefresh) # refresh() when data changed, at most at targetFps
+    Product.RWProperty(vars(), float, "targetFps") # 0: the display refresh rate
+
+    Product.ROProperty(vars(), float, "refreshTime") # ms, last refresh()
+    Product.ROProperty(vars(), float, "fps") # refreshes per second
+    Product.ROProperty(vars(), float, "budgetScale") # point budget reduction, 1: pointsPerPixel is honoured
+
+    MAX_LOAD = 0.5 # fraction of each frame refresh() may take
+    MIN_BUDGET_SCALE = 0.1
+
+    def frame_interval(self):
+        fps = self._targetFps
+        if fps <= 0:
+            app = QCoreApplication.instance()
+            screen = app.primaryScreen() if isinstance(app, QGuiApplication) else None
+            fps = screen.refreshRate() if screen is not None and screen.refreshRate() > 0 else 60.0
+        return 1.0 / fps
+
+    @Slot()
+    def schedule_refresh(self):
+        '''
+            refresh() one frame after the last one, or later if refreshes
+            take more than MAX_LOAD of a frame even with a reduced point budget
+        '''
+        if not self._autoRefresh or self._refreshTimer.isActive():
+            return
+        interval = max(self.frame_interval(), self._cost / self.MAX_LOAD)
+        delay = max(0.0, self._lastRefresh + interval - time.monotonic())
+        self._refreshTimer.start(int(delay * 1e3))
+
+    def refreshed(self, start):
+        '''
+            measures a refresh() and adapts the point budget to the frame budget
+        '''
+        cost = time.perf_counter() - start
+        self._cost = cost if self._cost == 0 else 0.8 * self._cost + 0.2 * cost
+        budget = self.MAX_LOAD * self.frame_interval()
+        if self._cost > budget:
+            self.set_budgetScale(self, max(self.MIN_BUDGET_SCALE, self._budgetScale * 0.8))
+        elif self._cost < budget / 2 and self._budgetScale < 1.0:
+            self.set_budgetScale(self, min(1.0, self._budgetScale * 1.1))
+        self.set_refreshTime(self, cost * 1e3)
+
+        now = time.monotonic()
+        t0, count = self._frames
+        if now - t0 >= 1.0:
+            self.set_fps(self, (count + 1) / (now - t0))
+            self._frames = (now, 0)
+        else:
+            self._frames = (t0, count + 1)
     
     dataSourcesChanged = Signal()
     @Property(list, notify = dataSourcesChanged)
@@ -45,33 +416,215 @@ class SimpleFOCScope(Product.Product):
         return list(self.arrays.keys())
     
     Product.InputProperty(vars(), QQuickItem, "chart")
+    Product.InputProperty(vars(), SimpleFOCTrigger, "trigger") # if set, its 'dataSource' displays triggered captures
+
+    def span(self, dataSource, buffer):
+        '''
+            absolute indices [first, end) of the samples of 'dataSource' in the
+            window: 'windowSize' samples or 'windowDuration' seconds, ending
+            at the newest sample if 'follow', at 'windowEnd' otherwise
+        '''
+        oldest = self.oldest(dataSource)
+        time_axis = self._xAxis == "time" and self._origin is not None
+        newest = self._newest
+        if self._follow:
+            end = buffer.total
+        elif time_axis:
+            newest = self._windowEnd + self._origin
+            end = self.index_at(dataSource, newest)
+        else:
+            end = int(math.floor(self._windowEnd)) + 1
+        if time_axis and self._windowDuration > 0:
+            first = self.index_at(dataSource, newest - self._windowDuration)
+        else:
+            first = end - self._windowSize
+        end = min(max(end, oldest), buffer.total)
+        return min(max(first, oldest), end), end
+
+    def window(self, dataSource, buffer, points):
+        '''
+            returns what to display for 'dataSource': an id that changes when
+            the samples do, the absolute indices [first, end) of the samples,
+            then either the samples or, if there are too many to draw 'points'
+            points, the pyramid's buckets over them
+        '''
+        if self._trigger is not None and self._trigger.dataSource == dataSource:
+            capture = self._trigger.displayed()
+            if capture is not None:
+                number, first, data = capture
+                return ("capture", number), first, first + data.shape[0], data, None
+        first, end = self.span(dataSource, buffer)
+        version = buffer.total if self._follow else ("past", first, end)
+        buckets = self.pyramids[dataSource].buckets(first, end, max(points // 2, 1))
+        if buckets is not None:
+            return version, first, end, None, buckets
+        if first >= buffer.total - len(buffer): # retained, a view of [first, end)
+            return version, first, end, buffer.last(buffer.total - first)[:end - first], None
+        return version, first, end, self.read(dataSource, first, end - first)[1], None
+
+    def x(self, dataSource, first, count):
+        '''
+            x of the samples of absolute indices [first, first + count)
+        '''
+        if self._xAxis == "time":
+            times = self.times[dataSource]
+            if first >= times.total - len(times): # still retained
+                return times.last(times.total - first)[:count] - self._origin
+            if first >= self.oldest(dataSource):
+                return self.read(dataSource, first, count)[0] - self._origin
+        return np.arange(first, first + count, dtype = np.float64)
 
 
     Product.ROProperty(vars(), float, "xMax")
     Product.ROProperty(vars(), float, "xMin")
     Product.ROProperty(vars(), float, "yMax")
     Product.ROProperty(vars(), float, "yMin")
+    Product.ROProperty(vars(), float, "xFirst") # x of the oldest sample that can be displayed, for scroll bars
+    Product.ROProperty(vars(), float, "xLast") # x of the newest sample
+
+    def extent(self):
+        '''
+            (xFirst, xLast) over the selected data sources
+        '''
+        firsts, lasts = [], []
+        for dataSource in self._selected:
+            buffer = self.buffers.get(dataSource)
+            if buffer is None or len(buffer) == 0:
+                continue
+            oldest = self.oldest(dataSource)
+            if self._xAxis == "time":
+                firsts.append(float(self.read(dataSource, oldest, 1)[0][0]) - self._origin)
+                lasts.append(float(self.times[dataSource].last(1)[0]) - self._origin)
+            else:
+                firsts.append(float(oldest))
+                lasts.append(float(buffer.total - 1))
+        return min(firsts, default = 0.0), max(lasts, default = 0.0)
+
+    def set_width(self, width):
+        if self._xAxis == "time":
+            self.windowDuration = max(width, 0.0)
+        else:
+            self.windowSize = max(int(round(width)), 2)
+
+    def move_to(self, end):
+        '''
+            ends the window at x 'end', following the newest samples if it is past them
+        '''
+        if end >= self._xLast:
+            self.follow = True
+        else:
+            self.follow = False
+            self.windowEnd = end
+        self.schedule_refresh()
+
+    @Slot(float, float)
+    def zoom(self, factor, at):
+        '''
+            zooms in ('factor' > 1) or out ('factor' < 1) around 'at', from 0
+            (start of the window) to 1 (its end)
+        '''
+        width = self._xMax - self._xMin
+        if width <= 0 or factor <= 0:
+            return
+        anchor = self._xMin + at * width
+        self.set_width(width / factor)
+        if self._follow and at >= 1:
+            self.schedule_refresh()
+            return
+        self.move_to(anchor + (self._xMax - anchor) / factor)
+
+    @Slot(float)
+    def pan(self, fraction):
+        '''
+            moves the window by 'fraction' of its width, towards older samples if negative
+        '''
+        self.move_to(self._xMax + fraction * (self._xMax - self._xMin))
+
+    @Slot()
+    def showAll(self):
+        '''
+            the whole history in the window
+        '''
+        self._xFirst, self._xLast = self.extent()
+        self.set_width(self._xLast - self._xFirst + (0 if self._xAxis == "time" else 1))
+        self.move_to(self._xLast)
+
+    # latency of each stage (decode, delivery, store, draw) from the time bytes were read, in ms
+    Product.ROProperty(vars(), 'QVariantMap', "latency") # {stage: {p50, p90, p99, max}}
+    Product.ROProperty(vars(), 'QVariantMap', "latencyHistograms") # {stage: counts per latencyBins}
+    Product.ConstProperty(vars(), list, "latencyBins")
+    _latencyBins = (BINS * 1e3).tolist()
+    Product.ROProperty(vars(), int, "pendingFrames") # received but not stored yet, at the last refresh
+    PUBLISH_PERIOD = 0.25 # seconds
+
+    def publish_latencies(self):
+        now = time.monotonic()
+        if now - self._published < self.PUBLISH_PERIOD:
+            return
+        self._published = now
+        self.set_latency(self, self.latencies.summary())
+        self.set_latencyHistograms(self, self.latencies.histograms())
+
+    def attach(self, handoff):
+        '''
+            'handoff' only wakes us up (once until drained), batches are
+            drained by the next update()
+        '''
+        self.handoffs.append(handoff)
+        handoff.consumers += 1
+        handoff.ready.connect(self.makeDirty)
+
+    def detach(self, handoff):
+        if handoff in self.handoffs:
+            self.handoffs.remove(handoff)
+            handoff.consumers -= 1
+            handoff.ready.disconnect(self.makeDirty)
 
     @Slot(str, object)
-    def dataReceived(self, name, buffer):
+    @Slot(str, object, float, float)
+    def dataReceived(self, name, buffer, t_read = None, t_decode = None):
+        '''
+            't_read' and 't_decode' are the time.monotonic() times the batch's bytes
+            were read and decoded, if known
+        '''
+        self.receive(name, buffer, t_read, t_decode)
+        self.makeDirty()
+
+    def receive(self, name, buffer, t_read = None, t_decode = None, handoff = None):
+        self.delivered += 1
+        if t_read is not None:
+            self.latencies.add("decode", t_decode - t_read)
+            self.latencies.add("delivery", time.monotonic() - t_read)
+            self._stamps.setdefault(name, []).append(t_read)
+
         if name not in self.arrays:
             self.arrays[name] = []
             self.dataSourcesChanged.emit()
 
         self.arrays[name].append(buffer)
-        self.makeDirty()
+        self._arrivals.setdefault(name, []).append(t_read if t_read is not None else time.monotonic())
+        self._handed.setdefault(name, []).append(handoff) # to check 'buffer' once copied, if a view
+
+        if name in self._rates:
+            t0, count = self._rates[name]
+            self._rates[name] = (t0, count + buffer.shape[0])
+        else:
+            self._rates[name] = (time.monotonic(), buffer.shape[0])
 
     @Slot(str)
     def toggleDatasource(self, channel):
         
         if channel in self._selected:
-            label_to_series_map = self._selected[channel] 
+            label_to_series_map = self._selected[channel] or {} # None if never drawn
             for (label, serie) in label_to_series_map.items():
                 self._chart.removeSeries(serie) #QMLWrapper "hack"
+                self.polylines.pop((channel, label), None)
             
             del self._selected[channel]
         else:
             self._selected[channel] = None #will be added in refresh()
+        self._drawn.pop(channel, None)
+        self.schedule_refresh()
 
     @Slot()
     def refresh(self):
@@ -79,50 +632,80 @@ class SimpleFOCScope(Product.Product):
             index: the series index
             channel: the channel index (relative to roi start)
         '''
-        def series_to_polyline(xdata, ydata):
-            #inspired from https://github.com/PierreRaybaut/plotpy/wiki/Using-Qt-Charts-(PyQtChart)-to-plot-curves-efficiently-in-Python!
-            size = len(xdata)
-            polyline = QPolygonF()
-            polyline.resize(size)
-            address = shiboken6.getCppPointer(polyline.data())[0]
-            buffer = (2 * size * ctypes.c_double).from_address(address) #QPolygonF float type is qreal, which is double
-            memory = np.frombuffer(buffer, xdata.dtype)
-            memory[:(size-1)*2+1:2] = xdata
-            memory[1:(size-1)*2+2:2] = ydata
-            return polyline
-
+        start = time.perf_counter()
+        self._lastRefresh = time.monotonic()
+        self.set_pendingFrames(self, sum(array.shape[0] for arrays in self.arrays.values() for array in arrays) + sum(handoff.pending for handoff in self.handoffs))
         self.update()
 
+        points = self.point_budget()
         y_min = np.finfo(np.float32).max
         y_max = np.finfo(np.float32).min
         x_min = np.finfo(np.float32).max
         x_max = np.finfo(np.float32).min
+        newest = [self.times[dataSource].last(1) for dataSource in self._selected if dataSource in self.times]
+        self._newest = max((float(t[0]) for t in newest if t.shape[0] > 0), default = 0.0)
+        x_first, x_last = self.extent()
+        self.set_xFirst(self, x_first)
+        self.set_xLast(self, x_last)
         for (dataSource, label_to_series_map) in self._selected.items():
 
-            data = self.buffers[dataSource]
-            if data is None:
+            buffer = self.buffers.get(dataSource)
+            if buffer is None:
                 break
-            
+
+            version, first, end, data, buckets = self.window(dataSource, buffer, points)
+            state = (version, points, self._windowSize, self._windowDuration, self._decimation, self._normalize,
+                     self._newest if self._xAxis == "time" and self._windowDuration > 0 else None)
+            drawn = self._drawn.get(dataSource)
+            if label_to_series_map is not None and drawn is not None and drawn[0] == state: # unchanged, only its range is needed
+                ranges = drawn[1]
+                x_min, x_max = np.fmin(x_min, ranges[0]), np.fmax(x_max, ranges[1])
+                y_min, y_max = np.fmin(y_min, ranges[2]), np.fmax(y_max, ranges[3])
+                continue
+
+            captured = version != buffer.total
+            if buckets is None:
+                xdata = self.x(dataSource, first, data.shape[0])
+            else: # zoomed out, drawn from the pyramid's min/max
+                starts, bucket_times, bucket_lo, bucket_hi = buckets
+                xdata = bucket_times - self._origin if self._xAxis == "time" else starts.astype(np.float64)
+                columns = self.pyramids[dataSource].labels
+
             if label_to_series_map is None:
-                label_to_series_map = self._selected[dataSource] = {label:None for label in data.dtype.fields.keys()}
+                label_to_series_map = self._selected[dataSource] = {label:None for label in Layout.channels(buffer.dtype)}
+            ranges = [np.finfo(np.float32).max, np.finfo(np.float32).min, np.finfo(np.float32).max, np.finfo(np.float32).min]
             for (label, serie) in label_to_series_map.items():
-                channel_data = data[label]
-                if channel_data.size == 0:
-                    break
+                if buckets is not None:
+                    column = columns.index(label)
+                    lo, hi = bucket_lo[:, column], bucket_hi[:, column]
+                    if self._normalize:
+                        mean = np.mean((lo + hi) / 2)
+                        lo, hi = lo - mean, hi - mean
+                    x = np.repeat(xdata, 2)
+                    y = np.stack((lo, hi), axis = 1).reshape(-1)
+                    lo, hi = lo.min(), hi.max()
+                else:
+                    channel_data = Layout.channel(data, label)
+                    if channel_data.size == 0:
+                        break
+
+                    if self._normalize:
+                        channel_data = channel_data - np.mean(channel_data)
 
-                min_shape = np.fmin(channel_data.shape[0], 100)
-                if self._xdata is None:
-                    self._xdata = np.linspace(np.fmax(0, channel_data.shape[0]-100), channel_data.shape[0], np.fmin(channel_data.shape[0], 100), np.float32)
+                    x, y = Decimation.decimate(xdata, channel_data, points, self._decimation)
+                    if self._normalize:
+                        lo, hi = y.min(), y.max()
+                    elif captured: # not the tail of the buffer, the tracker doesn't know it
+                        lo, hi = channel_data.min(), channel_data.max()
+                    else:
+                        lo, hi = self.extrema[dataSource].range(label, data.shape[0])
 
-                if self._normalize:
-                    channel_data -= np.mean(channel_data)
+                polyline = self.polylines.get((dataSource, label))
+                if polyline is None:
+                    polyline = self.polylines[(dataSource, label)] = PolylineBuffer()
+                polygon = polyline.fill(x, y)
 
-                polygon = series_to_polyline(self._xdata, channel_data[-min_shape:])
-                
-                x_min = np.fmin(x_min, self._xdata.min())
-                x_max = np.fmax(x_max, self._xdata.max())
-                y_min = np.fmin(y_min, channel_data.min())
-                y_max = np.fmax(y_max, channel_data.max())
+                ranges = [np.fmin(ranges[0], xdata[0]), np.fmax(ranges[1], xdata[-1]), np.fmin(ranges[2], lo), np.fmax(ranges[3], hi)]
 
 
                 if serie is None:
@@ -133,7 +716,22 @@ class SimpleFOCScope(Product.Product):
                 else:
                     serie.append(polygon)
 
+            self._drawn[dataSource] = (state, ranges)
+            x_min, x_max = np.fmin(x_min, ranges[0]), np.fmax(x_max, ranges[1])
+            y_min, y_max = np.fmin(y_min, ranges[2]), np.fmax(y_max, ranges[3])
+
+        now = time.monotonic()
+        for (dataSource, stamps) in self._undrawn.items():
+            if dataSource in self._selected and stamps:
+                self.latencies.add("draw", now - np.array(stamps))
+        self._undrawn = {}
+        self.publish_latencies()
+
+        if y_min <= y_max or self._autoscale == "fixed":
+            y_min, y_max = self.y_range(float(y_min), float(y_max))
+
         self.set_xMin(self, x_min)
         self.set_xMax(self, x_max)
         self.set_yMin(self, y_min)
-        self.set_yMax(self, y_max)
\ No newline at end of file
+        self.set_yMax(self, y_max)
+        self.refreshed(start)
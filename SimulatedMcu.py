@@ -0,0 +1,116 @@
+# This Python file uses the following encoding: utf-8
+'''
+    A simulated MCU on a pseudo-terminal, to try the command channel
+    (see Commands) without hardware. It sends every struct of the headers
+    at --rate frames/s, each channel a sine wave (or a counter for
+    integers), and obeys the commands the host writes to the pty: it only
+    sends the frames the host subscribed to, downsampled, and bursts.
+
+    Set sourceType: "pty" and commandChannel: true on SimpleFOCSerialScope,
+    connect, then run this on the pty it shows (ptyName). Frames and bytes
+    sent per struct are printed every second.
+
+    usage: python SimulatedMcu.py <pty> [--headers demo.h] [--framing ascii|binary] [--batch 1]
+                                  [--rate 1000] [--include-path DIR] [--abi ilp32] [--duration 0]
+'''
+import argparse
+import os
+import select
+import sys
+import time
+import tty
+import numpy as np
+import Commands
+import FrameDecoder
+import Layout
+import SerialPortListener
+
+class SimulatedMcu(object):
+    def __init__(self, fd, dtypes, framing = "ascii", stream_ids = None, rate = 1000.0, batch = 1):
+        self.fd = fd
+        self.dtypes = {name: dtype for (name, dtype) in dtypes.items() if dtype.itemsize > 0}
+        self.encode = FrameDecoder.make_encoder(framing, dtypes, stream_ids, batch)
+        self.streams = {i: name for (i, (name, _)) in FrameDecoder.stream_ids(dtypes, stream_ids).items()}
+        self.rate = rate
+        self.decoder = Commands.CommandDecoder()
+        self.controls = {name: Commands.StreamControl() for name in self.dtypes}
+        self.produced = 0
+        self.sent = {name: [0, 0] for name in self.dtypes} # frames, bytes
+        self.start = None
+
+    def receive(self):
+        readable, _, _ = select.select([self.fd], [], [], 0)
+        if not readable:
+            return
+        for (command, stream_id, argument) in self.decoder.feed(os.read(self.fd, 4096)):
+            name = self.streams.get(stream_id)
+            if name in self.controls:
+                self.controls[name].apply(command, argument)
+
+    def frames(self, dtype, first, count):
+        array = np.zeros(count, dtype)
+        t = (first + np.arange(count)) / self.rate
+        for (i, label) in enumerate(Layout.channels(dtype)):
+            values = Layout.channel(array, label)
+            if values.dtype.kind == 'f':
+                values[:] = np.sin(2 * np.pi * t * (i + 1) + i)
+            elif values.dtype.kind in "iu":
+                values[:] = (first + np.arange(count)).astype(values.dtype) # wraps around
+        return array
+
+    def step(self):
+        '''
+            applies the commands received and sends the frames due
+        '''
+        self.receive()
+        if self.start is None:
+            self.start = time.monotonic()
+        due = int((time.monotonic() - self.start) * self.rate) - self.produced
+        if due <= 0:
+            return
+        chunks = []
+        for (name, dtype) in self.dtypes.items():
+            keep = self.controls[name].select(due)
+            if keep.any():
+                data = self.encode(name, self.frames(dtype, self.produced, due)[keep])
+                self.sent[name][0] += int(keep.sum())
+                self.sent[name][1] += len(data)
+                chunks.append(data)
+        self.produced += due
+        if chunks:
+            os.write(self.fd, b''.join(chunks))
+
+    def run(self, duration = 0.0):
+        start = last = time.monotonic()
+        while duration <= 0 or time.monotonic() - start < duration:
+            self.step()
+            time.sleep(0.001)
+            if time.monotonic() - last >= 1.0:
+                last = time.monotonic()
+                print(", ".join(f"{name}: {frames} frames {size} B" for (name, (frames, size)) in self.sent.items()), flush = True)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("device", help = "the pty to write to, e.g. ptyName")
+    parser.add_argument("--headers", nargs = "+", default = ["demo.h"])
+    parser.add_argument("--include-path", action = "append", default = [])
+    parser.add_argument("--abi", default = "ilp32", choices = list(Layout.ABIS))
+    parser.add_argument("--framing", default = "ascii", choices = list(FrameDecoder.DECODERS))
+    parser.add_argument("--batch", type = int, default = 1, help = "structs per binary frame, at most")
+    parser.add_argument("--rate", type = float, default = 1000.0, help = "frames/s of each struct")
+    parser.add_argument("--duration", type = float, default = 0.0, help = "seconds, 0: until interrupted")
+    args = parser.parse_args()
+
+    listener = SerialPortListener.SerialPortListener()
+    listener.include_paths = args.include_path
+    listener.abi = args.abi
+    listener.parseHeaders(args.headers, background = False)
+    fd = os.open(args.device, os.O_RDWR | os.O_NOCTTY)
+    tty.setraw(fd)
+    try:
+        SimulatedMcu(fd, listener.dtypes, args.framing, rate = args.rate, batch = args.batch).run(args.duration)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        os.close(fd)
+    sys.exit(0)
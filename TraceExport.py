@@ -0,0 +1,373 @@
+from PySide6.QtCore import QObject, QTimer, Slot
+import logging
+import os
+import threading
+import zipfile
+import numpy as np
+import Layout
+import Product
+from SimpleFOCScope import SimpleFOCScope
+
+try:
+    import pyarrow # optional, only needed for the "parquet" format
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+FORMATS = ["npz", "csv", "parquet"]
+
+class Cancelled(Exception):
+    pass
+
+def columns(samples, fields):
+    '''
+        flattens the selected fields of structured 'samples' into
+        [(column name, 1-D array)], one column per channel (Layout.channels),
+        e.g. "foc.current.q" or "m[1][2]"
+    '''
+    labels = Layout.channels(samples.dtype)
+    return [(label, Layout.channel(samples, label)) for label in labels
+            if any(label == field or label.startswith(field + ".") or label.startswith(field + "[") for field in fields)]
+
+def overlapping(dtype):
+    '''
+        whether 'dtype' has fields at the same offset (unions) or out of
+        order at any depth, which a .npy header can't describe
+    '''
+    if dtype.subdtype is not None:
+        return overlapping(dtype.subdtype[0])
+    if dtype.names is None:
+        return False
+    end = 0
+    for name in dtype.names:
+        field, offset = dtype.fields[name][:2]
+        if offset < end or overlapping(field):
+            return True
+        end = offset + field.itemsize
+    return False
+
+def selected_dtype(dtype, fields):
+    '''
+        packed dtype of the 'fields' of 'dtype': top level fields as they are,
+        unless they hold unions, other channel paths (e.g. "foc.current.q",
+        "foc.current" or "m[1]") and fields holding unions as one column
+        per channel (Layout.channels) named after it
+    '''
+    labels = Layout.channels(dtype)
+    selected = {}
+    for field in fields:
+        if field in dtype.names and not overlapping(dtype.fields[field][0]):
+            selected[field] = dtype.fields[field][0]
+            continue
+        matching = [label for label in labels if label == field or label.startswith(field + ".") or label.startswith(field + "[")]
+        if not matching:
+            raise RuntimeError(f"Unknown field '{field}', expected a field of {list(dtype.names)} or a channel of {list(labels)}")
+        for label in matching:
+            selected[label] = labels[label].fields[label][0]
+    return np.dtype(list(selected.items()))
+
+def select(samples, dtype):
+    '''
+        a copy of the fields and channels of 'samples' in 'dtype' (see selected_dtype())
+    '''
+    selected = np.empty(samples.shape[0], dtype)
+    for name in dtype.names:
+        selected[name] = samples[name] if name in samples.dtype.names else Layout.channel(samples, name)
+    return selected
+
+def csv_format(dtype):
+    '''
+        shortest format that gives the value back
+    '''
+    if dtype.kind == 'f':
+        return "%.9g" if dtype.itemsize <= 4 else "%.17g"
+    if dtype.kind in "biu":
+        return "%d"
+    return "%s"
+
+class NpzWriter(object):
+    '''
+        One .npy entry per data source in a zip file. The header is written
+        first (the number of samples is known), then the samples chunk by
+        chunk, so no array is ever held whole. The file is written next to
+        'path' and only renamed to it once complete.
+    '''
+    def __init__(self, path):
+        self.path = path
+        self.partial = path + ".part"
+        self.zip = zipfile.ZipFile(self.partial, 'w', zipfile.ZIP_STORED, allowZip64 = True)
+        self.entry = None
+
+    def begin(self, name, dtype, count):
+        self.entry = self.zip.open(f"{name}.npy", 'w', force_zip64 = True)
+        header = {'descr': np.lib.format.dtype_to_descr(dtype), 'fortran_order': False, 'shape': (count,)}
+        np.lib.format.write_array_header_2_0(self.entry, header)
+
+    def write(self, samples):
+        self.entry.write(np.ascontiguousarray(samples).data)
+
+    def end(self):
+        self.entry.close()
+        self.entry = None
+
+    def close(self, complete):
+        try:
+            if self.entry is not None:
+                self.entry.close()
+            self.zip.close()
+        finally:
+            if complete:
+                os.replace(self.partial, self.path)
+            else:
+                os.remove(self.partial)
+
+class DirectoryWriter(object):
+    '''
+        Base of the writers of one file per data source in a directory.
+        Each file is written as <file>.part, they are only renamed once the
+        whole export succeeded, and all removed otherwise.
+    '''
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(path, exist_ok = True)
+        self.written = [] # final paths of the .part files
+
+    def partial(self, filename):
+        path = os.path.join(self.path, filename)
+        self.written.append(path)
+        return path + ".part"
+
+    def finish(self, complete):
+        for path in self.written:
+            if complete:
+                os.replace(path + ".part", path)
+            elif os.path.exists(path + ".part"):
+                os.remove(path + ".part")
+
+class CsvWriter(DirectoryWriter):
+    '''
+        One <data source>.csv per data source in a directory.
+    '''
+    def __init__(self, path):
+        super(CsvWriter, self).__init__(path)
+        self.file = None
+
+    def begin(self, name, dtype, count):
+        self.file = open(self.partial(f"{name}.csv"), 'w')
+        self.header = False
+
+    def write(self, samples):
+        cols = columns(samples, samples.dtype.names)
+        if not self.header:
+            self.file.write(",".join(name for (name, _) in cols) + "\n")
+            self.header = True
+        formats = [csv_format(values.dtype) for (_, values) in cols]
+        exact = all(values.dtype.kind == 'f' for (_, values) in cols) # float64 holds them all
+        table = np.empty((samples.shape[0], len(cols)), np.float64 if exact else object)
+        for (i, (_, values)) in enumerate(cols):
+            table[:, i] = values
+        np.savetxt(self.file, table, delimiter = ",", fmt = formats)
+
+    def end(self):
+        self.file.close()
+        self.file = None
+
+    def close(self, complete):
+        try:
+            if self.file is not None: # an incomplete file
+                self.file.close()
+        finally:
+            self.finish(complete)
+
+class ParquetWriter(DirectoryWriter):
+    '''
+        One <data source>.parquet per data source in a directory, one row
+        group per chunk.
+    '''
+    def __init__(self, path):
+        if pyarrow is None:
+            raise RuntimeError("The parquet format requires pyarrow")
+        super(ParquetWriter, self).__init__(path)
+        self.writer = None
+        self.file = None
+
+    def begin(self, name, dtype, count):
+        self.file = self.partial(f"{name}.parquet")
+
+    def write(self, samples):
+        table = pyarrow.table({name: values for (name, values) in columns(samples, samples.dtype.names)})
+        if self.writer is None:
+            self.writer = pyarrow.parquet.ParquetWriter(self.file, table.schema)
+        self.writer.write_table(table)
+
+    def end(self):
+        if self.writer is not None:
+            self.writer.close()
+        self.writer = None
+
+    def close(self, complete):
+        try:
+            self.end() # an incomplete file, if any
+        finally:
+            self.finish(complete)
+
+WRITERS = {"npz": NpzWriter, "csv": CsvWriter, "parquet": ParquetWriter}
+
+class SimpleFOCExporter(QObject):
+    '''
+        Exports the samples retained by a SimpleFOCScope, in its buffers or
+        spilled to its history (see memoryBudget).
+        export() selects the data sources ('sources', all if empty), the
+        fields or channels ('fields', e.g. "foc" or "foc.current.q", all if
+        empty) and the range of samples [first, last]
+        in the scope's x axis unit (absolute sample index, or seconds with
+        xAxis "time", mapped with SimpleFOCScope.index_of_x(); -1: oldest
+        retained / newest at the time of the call). A worker thread then copies and
+        writes 'chunkSize' samples at a time with SimpleFOCScope.read(), so
+        ingest goes on and memory use stays at one chunk whatever the range.
+        The oldest samples are written first: if some get dropped before
+        being exported, the export fails ('error').
+        Formats:
+        - "npz": 'path' is a file, one array per data source
+        - "csv", "parquet": 'path' is a directory, one file per data source,
+          struct and array fields give one column per channel
+        Fields holding unions are exported one column per channel in every
+        format. A cancelled or failed export leaves no file behind, complete
+        or not.
+    '''
+    def __init__(self, parent = None):
+        super(SimpleFOCExporter, self).__init__(parent)
+        self._scope = None
+        self._path = "export.npz"
+        self._format = "npz"
+        self._sources = []
+        self._fields = []
+        self._first = -1.0
+        self._last = -1.0
+        self._chunkSize = 65536
+        self._exporting = False
+        self._progress = 0.0
+        self._samplesExported = 0
+        self._error = ""
+        self._thread = None
+        self._cancel = threading.Event()
+        self._done = 0 # updated by the worker thread, published by _timer
+        self._total = 0
+        self._failure = ""
+        self._timer = QTimer(self)
+        self._timer.setInterval(100)
+        self._timer.timeout.connect(self.publish)
+
+    Product.RWProperty(vars(), SimpleFOCScope, "scope")
+    Product.RWProperty(vars(), str, "path")
+    Product.RWProperty(vars(), str, "format") # one of FORMATS
+    Product.RWProperty(vars(), list, "sources")
+    Product.RWProperty(vars(), list, "fields")
+    Product.RWProperty(vars(), float, "first") # x axis units of the scope, -1: the oldest sample
+    Product.RWProperty(vars(), float, "last") # x axis units of the scope, included, -1: the newest sample
+    Product.RWProperty(vars(), int, "chunkSize") # samples
+
+    Product.ROProperty(vars(), bool, "exporting")
+    Product.ROProperty(vars(), float, "progress") # [0, 1]
+    Product.ROProperty(vars(), int, "samplesExported")
+    Product.ROProperty(vars(), str, "error") # empty if the last export succeeded
+
+    def selection(self):
+        '''
+            [(name, RingBuffer, dtype, first, count)] to export, with the
+            range clipped to what is retained now. Raises RuntimeError on
+            unknown data sources and fields.
+        '''
+        selected = []
+        for name in (self._sources or list(self._scope.buffers)):
+            buffer = self._scope.buffers.get(name)
+            if buffer is None:
+                raise RuntimeError(f"Unknown data source '{name}'")
+            dtype = selected_dtype(buffer.dtype, self._fields or buffer.dtype.names)
+            first = self._scope.oldest(name)
+            if self._first >= 0:
+                first = max(self._scope.index_of_x(name, self._first), first)
+            end = buffer.total
+            if self._last >= 0: # included
+                end = min(self._scope.index_of_x(name, np.nextafter(self._last, np.inf)), end)
+            if end > first:
+                selected.append((name, buffer, dtype, first, end - first))
+        return selected
+
+    @Slot()
+    def export(self):
+        if self._thread is not None:
+            return
+        self._done = self._total = 0
+        self._failure = ""
+        try:
+            if self._format not in WRITERS:
+                raise RuntimeError(f"Unknown export format '{self._format}', expected one of {FORMATS}")
+            if self._scope is None:
+                raise RuntimeError("No scope to export")
+            selected = self.selection()
+            writer = WRITERS[self._format](self._path)
+        except Exception as e:
+            logging.error(e, exc_info=True)
+            self.set_error(self, str(e))
+            return
+        self._total = sum(count for (_, _, _, _, count) in selected)
+        self._cancel.clear()
+        self._thread = threading.Thread(target = self.run, args = (writer, selected, max(self._chunkSize, 1)), daemon = True)
+        self.set_error(self, "")
+        self.set_exporting(self, True)
+        self._thread.start()
+        self._timer.start()
+
+    @Slot()
+    def cancel(self):
+        self._cancel.set()
+
+    def run(self, writer, selected, chunk_size):
+        complete = False
+        try:
+            for (name, buffer, dtype, first, count) in selected:
+                writer.begin(name, dtype, count)
+                for start in range(first, first + count, chunk_size):
+                    if self._cancel.is_set():
+                        raise Cancelled()
+                    n = min(chunk_size, first + count - start)
+                    samples = self.read(name, start, n)
+                    writer.write(select(samples, dtype))
+                    self._done += n
+                writer.end()
+            complete = True
+        except Cancelled:
+            self._failure = "cancelled"
+        except Exception as e:
+            logging.error(e, exc_info=True)
+            self._failure = str(e)
+        finally:
+            try:
+                writer.close(complete) # incomplete files are removed
+            except Exception as e:
+                logging.error(e, exc_info=True)
+                self._failure = self._failure or str(e)
+
+    def read(self, name, first, count):
+        '''
+            the samples from the buffers or the history, whichever holds
+            them now: they may be spilled while they are read
+        '''
+        for attempt in range(2):
+            try:
+                return self._scope.read(name, first, count)[1]
+            except IndexError:
+                pass
+        raise RuntimeError(f"{name}: samples were dropped before being exported, increase the buffer depth or memoryBudget, or export fewer samples")
+
+    @Slot()
+    def publish(self):
+        self.set_samplesExported(self, self._done)
+        self.set_progress(self, self._done / self._total if self._total > 0 else 1.0)
+        if self._thread is not None and not self._thread.is_alive():
+            self._thread.join()
+            self._thread = None
+            self._timer.stop()
+            self.set_error(self, self._failure)
+            self.set_exporting(self, False)
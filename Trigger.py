@@ -0,0 +1,166 @@
+import time
+import numpy as np
+import Layout
+import Product
+
+TYPES = ["rising", "falling", "level", "window", "pulse"]
+MODES = ["auto", "normal", "single"]
+
+def scan(kind, x, offset, level, upper = 0.0, widths = (0, np.inf), rise = None):
+    '''
+        Finds where the trigger condition is met in x[1:], x[0] being the
+        sample before (for edges). Returns the absolute indices ('offset' is
+        the index of x[0]) and the start of a pulse still going on at the end
+        of x ('rise', likewise for the previous call), only used by "pulse".
+        "level": x >= level
+        "window": x leaves [level, upper]
+        "pulse": x falls below level after being above for a number of
+        samples within 'widths'
+    '''
+    if kind == "level":
+        return np.flatnonzero(x[1:] >= level) + offset + 1, rise
+    if kind == "window":
+        inside = (x >= level) & (x <= upper)
+        return np.flatnonzero(inside[:-1] & ~inside[1:]) + offset + 1, rise
+
+    above = x >= level
+    ups = np.flatnonzero(~above[:-1] & above[1:]) + offset + 1
+    downs = np.flatnonzero(above[:-1] & ~above[1:]) + offset + 1
+    if kind == "rising":
+        return ups, rise
+    if kind == "falling":
+        return downs, rise
+
+    # pulse: each fall ends the pulse started by the last rise before it
+    starts = np.concatenate(([rise if rise is not None else -1], ups))
+    start = starts[np.searchsorted(starts, downs) - 1]
+    width = downs - start
+    hits = downs[(start >= 0) & (width >= widths[0]) & (width <= widths[1])]
+    if ups.shape[0] > 0 and (downs.shape[0] == 0 or ups[-1] > downs[-1]):
+        rise = int(ups[-1])
+    elif downs.shape[0] > 0:
+        rise = None
+    return hits, rise
+
+class SimpleFOCTrigger(Product.Product):
+    '''
+        Oscilloscope trigger on one channel (e.g. "foc.current.q") of one data source.
+        SimpleFOCScope calls process() with each ring buffer it just
+        appended to: only the new samples are scanned. Once 'postTrigger'
+        samples followed the trigger point, 'preTrigger' + 'postTrigger'
+        samples are copied out of the ring buffer into 'capture', which is
+        displayed instead of the most recent samples (ingest goes on).
+        Modes:
+        - "auto": shows the last capture, the most recent samples if nothing
+          triggered for 'autoTimeout' seconds
+        - "normal": shows the last capture, re-armed after each capture
+        - "single": disarms after one capture, set 'armed' to capture again
+        The most recent samples are shown until the first capture.
+    '''
+    def __init__(self, parent = None):
+        super(SimpleFOCTrigger, self).__init__(parent)
+        self._dataSource = ""
+        self._field = ""
+        self._type = "rising"
+        self._mode = "auto"
+        self._level = 0.0
+        self._upper = 0.0
+        self._minWidth = 0
+        self._maxWidth = 0
+        self._preTrigger = 500
+        self._postTrigger = 500
+        self._autoTimeout = 0.2
+        self._armed = True
+        self._state = "armed"
+        self._captures = 0
+        self._triggerIndex = 0.0
+        self.capture = None # (capture number, absolute index of the first sample, samples)
+        self._captured_at = 0.0
+        self._next = None # absolute index of the next sample to scan
+        self._rise = None
+        self._pending = None # absolute index of the trigger point, waiting for post-trigger samples
+
+    def cb_config(self, old_value):
+        if self._type not in TYPES:
+            raise RuntimeError(f"Unknown trigger type '{self._type}', expected one of {TYPES}")
+        if self._mode not in MODES:
+            raise RuntimeError(f"Unknown trigger mode '{self._mode}', expected one of {MODES}")
+        self._pending = self._rise = None
+        self.capture = None
+
+    Product.InputProperty(vars(), str, "dataSource", cb_config)
+    Product.InputProperty(vars(), str, "field", cb_config)
+    Product.InputProperty(vars(), str, "type", cb_config) # one of TYPES
+    Product.InputProperty(vars(), str, "mode", cb_config) # one of MODES
+    Product.InputProperty(vars(), float, "level", cb_config) # lower bound of "window"
+    Product.InputProperty(vars(), float, "upper", cb_config) # upper bound of "window"
+    Product.InputProperty(vars(), int, "minWidth", cb_config) # samples, "pulse"
+    Product.InputProperty(vars(), int, "maxWidth", cb_config) # samples, "pulse", 0: no limit
+    Product.InputProperty(vars(), int, "preTrigger") # samples displayed before the trigger point
+    Product.InputProperty(vars(), int, "postTrigger") # samples displayed after the trigger point
+    Product.InputProperty(vars(), float, "autoTimeout") # seconds
+
+    def cb_armed(self, old_value):
+        self._pending = self._rise = None
+        self._next = None
+        self.set_state(self, "armed" if self._armed else "stopped")
+        self.makeDirty()
+
+    Product.RWProperty(vars(), bool, "armed", cb_armed)
+
+    Product.ROProperty(vars(), str, "state") # "armed", "triggered" (waiting for post-trigger samples) or "stopped"
+    Product.ROProperty(vars(), int, "captures")
+    Product.ROProperty(vars(), float, "triggerIndex") # absolute sample index of the last trigger point
+
+    def values(self, samples):
+        return np.asarray(Layout.channel(samples, self._field or None), np.float64)
+
+    def process(self, buffer, new):
+        '''
+            'buffer' is the RingBuffer of 'dataSource', 'new' the number of
+            samples appended since the last call
+        '''
+        total = buffer.total
+        oldest = total - len(buffer)
+        if self._next is None:
+            self._next = total - new
+        while True:
+            if self._pending is None:
+                first = max(self._next, oldest)
+                if not self._armed or first >= total:
+                    self._next = total
+                    break
+                context = max(first - 1, oldest)
+                x = self.values(buffer.last(total - context))
+                if context == first: # no sample before, repeat the first one
+                    x = np.concatenate((x[:1], x))
+                widths = (self._minWidth, self._maxWidth if self._maxWidth > 0 else np.inf)
+                hits, self._rise = scan(self._type, x, first - 1, self._level, self._upper, widths, self._rise)
+                self._next = total
+                if hits.shape[0] == 0:
+                    break
+                self._pending = int(hits[0])
+                self.set_triggerIndex(self, self._pending)
+                self.set_state(self, "triggered")
+
+            end = self._pending + self._postTrigger
+            if total < end:
+                break
+            start = max(self._pending - self._preTrigger, oldest)
+            self.set_captures(self, self._captures + 1)
+            self.capture = (self._captures, start, buffer.last(total - start)[:end - start].copy())
+            self._captured_at = time.monotonic()
+            self._pending = self._rise = None
+            self._next = end # holdoff: triggers within a capture are ignored
+            if self._mode == "single":
+                self.armed = False
+                break
+            self.set_state(self, "armed")
+
+    def displayed(self):
+        '''
+            the capture to display, None to display the most recent samples
+        '''
+        if self._mode == "auto" and time.monotonic() - self._captured_at > self._autoTimeout:
+            return None
+        return self.capture
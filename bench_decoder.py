@@ -0,0 +1,73 @@
+# This Python file uses the following encoding: utf-8
+'''
+    Compares the frame-per-iteration decoding loop SerialPortListener.run used
+    to have with the batched AsciiFrameDecoder and BinaryFrameDecoder, on an
+    in-memory byte stream.
+
+    usage: python bench_decoder.py [frames] [chunk size]
+'''
+import io
+import sys
+import time
+import numpy as np
+import FrameDecoder
+
+def make_data(dtype, frames):
+    data = np.zeros(frames, dtype)
+    for field in dtype.names:
+        data[field] = np.arange(frames)
+    return data
+
+def per_frame(stream, dtypes, emit):
+    port = io.BytesIO(stream)
+    count = 0
+    while True:
+        header_string = port.readline().rstrip().decode("ascii")
+        if not header_string:
+            break
+        header_dtype = dtypes[header_string]
+        data = port.read(header_dtype.itemsize)
+        emit(header_string, np.frombuffer(data, header_dtype))
+        count += 1
+    return count
+
+def batched(stream, decoder, emit, chunk_size):
+    port = io.BytesIO(stream)
+    chunk = bytearray(chunk_size)
+    view = memoryview(chunk)
+    while True:
+        n = port.readinto(chunk)
+        if not n:
+            break
+        for (name, array) in decoder.feed(view[:n]).items():
+            emit(name, array)
+    return decoder.frames
+
+def measure(f, *args):
+    t = time.perf_counter()
+    frames = f(*args)
+    return frames, time.perf_counter() - t
+
+if __name__ == "__main__":
+    frames = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    chunk_size = int(sys.argv[2]) if len(sys.argv) > 2 else 4096
+    emit = lambda name, array: None
+
+    for n_fields in [2, 8, 32]:
+        dtype = np.dtype([(f"f{i}", np.float32) for i in range(n_fields)])
+        dtypes = {"Bench": dtype}
+        data = make_data(dtype, frames)
+        ascii_stream = FrameDecoder.ascii_frames("Bench", data)
+        binary_stream = FrameDecoder.binary_frames(1, data)
+        batched_stream = FrameDecoder.binary_frames(1, data, 16)
+
+        n0, t0 = measure(per_frame, ascii_stream, dtypes, emit)
+        n1, t1 = measure(batched, ascii_stream, FrameDecoder.AsciiFrameDecoder(dtypes), emit, chunk_size)
+        n2, t2 = measure(batched, binary_stream, FrameDecoder.BinaryFrameDecoder(dtypes), emit, chunk_size)
+        n3, t3 = measure(batched, batched_stream, FrameDecoder.BinaryFrameDecoder(dtypes), emit, chunk_size)
+        assert n0 == n1 == n2 == n3 == frames
+        print(f"{dtype.itemsize:4d} B/frame: per-frame {n0 / t0:10.0f} frames/s, "
+              f"batched ascii {n1 / t1:10.0f} frames/s ({t0 / t1:.1f}x), "
+              f"batched binary {n2 / t2:10.0f} frames/s ({t0 / t2:.1f}x), "
+              f"binary x16 {n3 / t3:10.0f} frames/s ({t0 / t3:.1f}x), "
+              f"wire bytes/frame ascii {len(ascii_stream) / frames:.1f}, binary {len(binary_stream) / frames:.1f}, binary x16 {len(batched_stream) / frames:.1f}")
@@ -0,0 +1,39 @@
+# This Python file uses the following encoding: utf-8
+'''
+    Measures SerialPortListener.parseHeaders() on a cold cache (full
+    pyclibrary parse) and on a cache hit, with a generated header holding
+    many structs, or with the headers given on the command line.
+
+    usage: python bench_headers.py [header.h ...]
+'''
+import os
+import sys
+import tempfile
+import time
+import SerialPortListener
+
+def make_header(directory, structs = 40, fields = 12):
+    path = os.path.join(directory, "bench_headers.h")
+    with open(path, 'w') as f:
+        f.write("#include <stdint.h>\n\n")
+        for i in range(structs):
+            f.write(f"struct Bench{i}{{\n")
+            for j in range(fields):
+                f.write(f"    {'float' if j % 2 else 'int32_t'} f{j};\n")
+            f.write("};\n\n")
+    return path
+
+def measure(listener, headers):
+    t = time.perf_counter()
+    listener.parseHeaders(headers, background = False)
+    return time.perf_counter() - t
+
+if __name__ == "__main__":
+    directory = tempfile.mkdtemp()
+    os.environ["XDG_CACHE_HOME"] = os.path.join(directory, "cache") # start cold
+    headers = sys.argv[1:] or [make_header(directory)]
+
+    listener = SerialPortListener.SerialPortListener()
+    cold = measure(listener, headers)
+    hit = min(measure(listener, headers) for _ in range(10))
+    print(f"{len(listener.dtypes)} structs: cold parse {cold * 1e3:.1f} ms, cache hit {hit * 1e3:.2f} ms ({cold / hit:.0f}x)")
@@ -0,0 +1,234 @@
+# This Python file uses the following encoding: utf-8
+'''
+    Headless throughput/latency benchmark of the ingest pipeline:
+    synthetic frames -> source -> SerialPortListener (decode) -> queued
+    signal per batch or BatchHandoff drained every GUI tick (--delivery)
+    -> SimpleFOCScope ring buffers.
+
+    Each case runs in its own process (so peak RSS is per case) and reports
+    decoded frames/s, lost frames, ingest-to-buffer latency percentiles,
+    CPU time per frame, events posted to the GUI thread and peak RSS. Results are printed as JSON, one object
+    per case, and optionally written to --output.
+
+    usage: python bench_ingest.py [--source memory|pty] [--framing ascii|binary] [--delivery signal|handoff]
+                                  [--rates 1000 10000 ...] [--fields 2 8 32 ...]
+                                  [--duration 2] [--output results.json]
+'''
+from PySide6.QtCore import QCoreApplication, QObject, QTimer, Qt, Slot
+import argparse
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import numpy as np
+import FrameSources
+import SerialPortListener
+import SimpleFOCScope
+
+def make_header(directory, fields):
+    '''
+        a 'Bench' struct: the send time followed by 'fields' floats
+    '''
+    path = os.path.join(directory, f"bench_{fields}.h")
+    with open(path, 'w') as f:
+        f.write("struct Bench{\n    double t;\n")
+        for i in range(fields):
+            f.write(f"    float f{i};\n")
+        f.write("};\n")
+    return path
+
+def synthetic_frames(dtype, count, encode):
+    array = np.zeros(count, dtype)
+    array['t'] = time.monotonic()
+    return encode("Bench", array)
+
+class SyntheticSource(FrameSources.EncodingSource):
+    '''
+        'count' frames at 'rate' frames/s, produced in memory
+    '''
+    def __init__(self, encode, dtype, rate, count):
+        super(SyntheticSource, self).__init__(encode)
+        self.dtype = dtype
+        self.rate = rate
+        self.count = count
+        self.sent = 0
+        self.start = None
+
+    def produce(self, max_bytes):
+        if self.start is None:
+            self.start = time.monotonic()
+        due = min(int((time.monotonic() - self.start) * self.rate), self.count) - self.sent
+        due = min(due, max(max_bytes // self.dtype.itemsize, 1))
+        if due <= 0:
+            time.sleep(0.0005)
+            return b''
+        self.sent += due
+        return synthetic_frames(self.dtype, due, self.encode)
+
+def pty_writer(fd, encode, dtype, rate, count):
+    '''
+        writes 'count' frames at 'rate' frames/s to a pty, as a MCU would
+    '''
+    start = time.monotonic()
+    sent = 0
+    while sent < count:
+        due = min(int((time.monotonic() - start) * rate), count) - sent
+        if due > 0:
+            os.write(fd, synthetic_frames(dtype, due, encode))
+            sent += due
+        time.sleep(0.0005)
+
+class Collector(QObject):
+    '''
+        stands for the GUI thread: stores each batch in the scope right away
+        and measures how long ago its frames were produced
+    '''
+    def __init__(self, scope):
+        super(Collector, self).__init__()
+        self.scope = scope
+        self.received = 0
+        self.latencies = []
+        self.events = 0 # posted to this (GUI) thread
+
+    @Slot(str, object)
+    def dataReceived(self, name, array):
+        self.events += 1
+        self.scope.dataReceived(name, array)
+        self.scope.update()
+        self.latencies.append(time.monotonic() - self.scope.buffers[name].last(array.shape[0])['t'])
+        self.received += array.shape[0]
+
+    @Slot()
+    def wakeUp(self):
+        self.events += 1
+
+    @Slot()
+    def tick(self):
+        '''
+            a GUI refresh, drains the handoff
+        '''
+        totals = {name: buffer.total for (name, buffer) in self.scope.buffers.items()}
+        self.scope.update()
+        for (name, buffer) in self.scope.buffers.items():
+            n = buffer.total - totals.get(name, 0)
+            if n > 0:
+                self.latencies.append(time.monotonic() - buffer.last(n)['t'])
+                self.received += n
+
+def run_case(source_kind, framing, fields, rate, duration, delivery = "signal"):
+    app = QCoreApplication.instance() or QCoreApplication([])
+    directory = tempfile.mkdtemp()
+    listener = SerialPortListener.SerialPortListener()
+    listener.parseHeaders([make_header(directory, fields)], background = False)
+    listener.set_framing(framing)
+    dtype = listener.dtypes["Bench"]
+    encode = listener.make_encoder()
+    count = int(rate * duration)
+
+    scope = SimpleFOCScope.SimpleFOCScope()
+    scope.bufferDepth = max(count, 1)
+    scope.autoRefresh = False # the collector stands for the GUI
+    collector = Collector(scope)
+    ticks = QTimer()
+    if delivery == "handoff":
+        scope.attach(listener.handoff)
+        listener.handoff.ready.connect(collector.wakeUp)
+        ticks.timeout.connect(collector.tick)
+        ticks.start(16) # 60 Hz display
+    else:
+        listener.dataReceived.connect(collector.dataReceived, Qt.QueuedConnection)
+
+    writer = None
+    if source_kind == "pty":
+        source = FrameSources.PtySource()
+        source.open()
+        writer = threading.Thread(target = pty_writer, args = (source.slave, encode, dtype, rate, count))
+    else:
+        source = SyntheticSource(encode, dtype, rate, count)
+
+    cpu = time.process_time()
+    start = time.monotonic()
+    listener.beginListneing(source)
+    if writer is not None:
+        writer.start()
+
+    deadline = start + duration * 2 + 2
+    def check():
+        if collector.received >= count or time.monotonic() > deadline:
+            app.quit()
+    timer = QTimer()
+    timer.timeout.connect(check)
+    timer.start(10)
+    app.exec()
+    elapsed = time.monotonic() - start
+    cpu = time.process_time() - cpu
+
+    listener.stop()
+    listener.wait()
+    if writer is not None:
+        writer.join()
+
+    latencies = np.concatenate(collector.latencies) if collector.latencies else np.zeros(1)
+    return {
+        "source": source_kind,
+        "framing": framing,
+        "delivery": delivery,
+        "frame_bytes": dtype.itemsize,
+        "rate": rate,
+        "frames_sent": count,
+        "frames_received": collector.received,
+        "frames_lost": count - collector.received,
+        "decoded_frames_per_s": collector.received / elapsed,
+        "latency_ms": {f"p{p}": float(np.percentile(latencies, p) * 1e3) for p in (50, 90, 99, 99.9)},
+        "latency_max_ms": float(latencies.max() * 1e3),
+        "cpu_us_per_frame": cpu / max(collector.received, 1) * 1e6,
+        "gui_events_per_s": collector.events / elapsed,
+        "frames_dropped": listener.handoff.dropped,
+        "peak_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    }
+
+def environment():
+    return {
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "machine": platform.machine(),
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+    }
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--source", default = "memory", choices = ["memory", "pty"])
+    parser.add_argument("--framing", default = "ascii", choices = ["ascii", "binary"])
+    parser.add_argument("--delivery", default = "handoff", choices = ["signal", "handoff"])
+    parser.add_argument("--rates", type = float, nargs = "+", default = [1000, 10000, 50000])
+    parser.add_argument("--fields", type = int, nargs = "+", default = [2, 8, 32])
+    parser.add_argument("--duration", type = float, default = 2.0)
+    parser.add_argument("--output")
+    parser.add_argument("--case", action = "store_true", help = "run a single case in this process (internal)")
+    args = parser.parse_args()
+
+    if args.case:
+        print(json.dumps(run_case(args.source, args.framing, args.fields[0], args.rates[0], args.duration, args.delivery)))
+        sys.exit(0)
+
+    results = []
+    for fields in args.fields:
+        for rate in args.rates:
+            command = [sys.executable, os.path.abspath(__file__), "--case", "--source", args.source, "--framing", args.framing, "--delivery", args.delivery,
+                       "--fields", str(fields), "--rates", str(rate), "--duration", str(args.duration)]
+            output = subprocess.run(command, capture_output = True, text = True, cwd = os.path.dirname(os.path.abspath(__file__)))
+            if output.returncode != 0 and not output.stdout.strip():
+                print(output.stderr, file = sys.stderr)
+                continue
+            result = json.loads(output.stdout.strip().splitlines()[-1])
+            results.append(result)
+            print(json.dumps(result))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({"environment": environment(), "results": results}, f, indent = 1)
@@ -0,0 +1,154 @@
+# This Python file uses the following encoding: utf-8
+'''
+    CPU use of the ingest against the number of ports: one SerialPortListener
+    thread per port ("threads") versus a single MultiPortListener thread for
+    all ports ("multiplexed").
+
+    Each port is a pseudo-terminal fed by a separate writer process (so its
+    CPU isn't counted) at --rate frames/s. Batches are handed off to the
+    main thread and drained every 16 ms, as they would be by the GUI. Each case
+    runs in its own process and reports the process CPU use (100% is one
+    core), CPU time per frame and the frames received. Results are
+    printed as JSON, one object per case.
+
+    usage: python bench_multiport.py [--ports 1 2 4 8 12] [--rate 2000]
+                                     [--framing binary|ascii] [--duration 3]
+'''
+from PySide6.QtCore import QCoreApplication, QObject, QTimer, Slot
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+import numpy as np
+import FrameDecoder
+import FrameSources
+import MultiPortListener
+import SerialPortListener
+
+DTYPES = {"Bench": np.dtype([('t', '<f8')] + [(f"f{i}", '<f4') for i in range(6)])}
+
+def write_frames(devices, framing, rate, duration):
+    '''
+        writer process: 'rate' frames/s to each device, in 1 ms ticks
+    '''
+    encode = FrameDecoder.make_encoder(framing, DTYPES)
+    fds = [os.open(device, os.O_WRONLY | os.O_NOCTTY) for device in devices]
+    start = time.monotonic()
+    sent = 0
+    while time.monotonic() - start < duration:
+        due = int((time.monotonic() - start) * rate) - sent
+        if due > 0:
+            data = encode("Bench", np.zeros(due, DTYPES["Bench"]))
+            for fd in fds:
+                os.write(fd, data)
+            sent += due
+        time.sleep(0.001)
+
+class Counter(QObject):
+    def __init__(self):
+        super(Counter, self).__init__()
+        self.received = 0
+        self.handoffs = []
+
+    def attach(self, handoff):
+        handoff.consumers += 1
+        self.handoffs.append(handoff)
+
+    @Slot()
+    def tick(self):
+        for handoff in self.handoffs:
+            for (name, array, t_read, t_decode) in handoff.drain():
+                self.received += array.shape[0]
+
+def run_case(mode, ports, framing, rate, duration):
+    app = QCoreApplication.instance() or QCoreApplication([])
+    counter = Counter()
+    sources = []
+    listeners = []
+    for i in range(ports):
+        listener = SerialPortListener.SerialPortListener()
+        listener.set_dtypes(DTYPES)
+        listener.set_framing(framing)
+        counter.attach(listener.handoff)
+        source = FrameSources.PtySource()
+        source.open()
+        sources.append(source)
+        listeners.append(listener)
+
+    multiplexer = None
+    if mode == "multiplexed":
+        multiplexer = MultiPortListener.MultiPortListener()
+        for (listener, source) in zip(listeners, sources):
+            multiplexer.add_port(source.name, source, listener)
+    else:
+        for (listener, source) in zip(listeners, sources):
+            listener.beginListneing(source)
+
+    ticks = QTimer()
+    ticks.timeout.connect(counter.tick)
+    ticks.start(16)
+
+    warmup = 0.5
+    writer = subprocess.Popen([sys.executable, os.path.abspath(__file__), "--write", "--framing", framing,
+                               "--rate", str(rate), "--duration", str(duration + warmup)] + [s.name for s in sources],
+                              cwd = os.path.dirname(os.path.abspath(__file__)))
+
+    measured = {}
+    def begin():
+        measured["cpu"], measured["t"], measured["received"] = time.process_time(), time.monotonic(), counter.received
+    def end():
+        measured["cpu"] = time.process_time() - measured["cpu"]
+        measured["t"] = time.monotonic() - measured["t"]
+        measured["received"] = counter.received - measured["received"]
+        app.quit()
+    QTimer.singleShot(int(warmup * 1e3), begin)
+    QTimer.singleShot(int((warmup + duration) * 1e3), end)
+    app.exec()
+    writer.wait()
+
+    for listener in listeners:
+        listener.stop()
+        listener.wait()
+    if multiplexer is not None:
+        multiplexer.shutdown()
+
+    return {
+        "mode": mode,
+        "ports": ports,
+        "framing": framing,
+        "rate_per_port": rate,
+        "cpu_percent": measured["cpu"] / measured["t"] * 100,
+        "cpu_us_per_frame": measured["cpu"] / max(measured["received"], 1) * 1e6,
+        "frames_per_s": measured["received"] / measured["t"],
+        "io_threads": 1 if multiplexer is not None else ports,
+    }
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--ports", type = int, nargs = "+", default = [1, 2, 4, 8, 12])
+    parser.add_argument("--rate", type = float, default = 2000.0, help = "frames/s per port")
+    parser.add_argument("--framing", default = "binary", choices = ["ascii", "binary"])
+    parser.add_argument("--duration", type = float, default = 3.0)
+    parser.add_argument("--mode", choices = ["threads", "multiplexed"], help = "run a single case in this process (internal)")
+    parser.add_argument("--write", action = "store_true", help = "writer process (internal)")
+    parser.add_argument("devices", nargs = "*")
+    args = parser.parse_args()
+
+    if args.write:
+        write_frames(args.devices, args.framing, args.rate, args.duration)
+        sys.exit(0)
+    if args.mode:
+        print(json.dumps(run_case(args.mode, args.ports[0], args.framing, args.rate, args.duration)))
+        sys.exit(0)
+
+    for ports in args.ports:
+        for mode in ("threads", "multiplexed"):
+            command = [sys.executable, os.path.abspath(__file__), "--mode", mode, "--ports", str(ports), "--framing", args.framing,
+                       "--rate", str(args.rate), "--duration", str(args.duration)]
+            output = subprocess.run(command, capture_output = True, text = True, cwd = os.path.dirname(os.path.abspath(__file__)))
+            if output.returncode != 0 or not output.stdout.strip():
+                print(output.stderr, file = sys.stderr)
+                continue
+            print(output.stdout.strip().splitlines()[-1])
@@ -0,0 +1,161 @@
+# This Python file uses the following encoding: utf-8
+'''
+    Frames lost while the GUI thread is saturated: SerialPortListener
+    decoding in a thread of the GUI process ("thread") versus a
+    SharedIngest.DecoderProcess ("process").
+
+    A pseudo-terminal stands for the serial port. A separate writer process
+    writes --rate frames/s to it without blocking: frames that don't fit in
+    the pty buffer are lost, as they would be in an overrun UART FIFO. The
+    main thread spends --load of its time in pure Python (holding the GIL,
+    like rendering and refresh) and drains the received frames every 16 ms.
+    Each case runs in its own process and reports frames sent, received
+    and overrun. Results are printed as JSON, one object per case.
+    The shared memory rings hold --capacity frames: the process' reader
+    drops frames if a drain comes later than half a ring of frames.
+
+    usage: python bench_outofprocess.py [--rate 20000] [--loads 0 0.5 0.9 0.99]
+                                        [--framing binary|ascii] [--duration 3] [--capacity 262144]
+'''
+from PySide6.QtCore import QCoreApplication, QObject, QTimer, Slot
+import argparse
+import errno
+import json
+import os
+import subprocess
+import sys
+import time
+import numpy as np
+import FrameDecoder
+import FrameSources
+import SerialPortListener
+import SharedIngest
+
+DTYPES = {"Bench": np.dtype([('t', '<f8')] + [(f"f{i}", '<f4') for i in range(6)])}
+
+def write_frames(device, framing, rate, duration):
+    '''
+        writer process: 'rate' frames/s in 1 ms ticks, never blocks;
+        prints the frames sent and overrun
+    '''
+    encode = FrameDecoder.make_encoder(framing, DTYPES)
+    frame = len(encode("Bench", np.zeros(1, DTYPES["Bench"])))
+    fd = os.open(device, os.O_WRONLY | os.O_NOCTTY | os.O_NONBLOCK)
+    start = time.monotonic()
+    sent = overrun = 0
+    while time.monotonic() - start < duration:
+        due = int((time.monotonic() - start) * rate) - sent - overrun
+        if due > 0:
+            data = encode("Bench", np.zeros(due, DTYPES["Bench"]))
+            try:
+                written = os.write(fd, data)
+            except OSError as e:
+                if e.errno != errno.EAGAIN:
+                    raise
+                written = 0
+            sent += written // frame
+            overrun += due - written // frame
+            if written % frame: # complete the frame, a partial one would desync the decoder
+                os.set_blocking(fd, True)
+                os.write(fd, data[written:written + frame - written % frame])
+                os.set_blocking(fd, False)
+                sent += 1
+                overrun -= 1
+        time.sleep(0.001)
+    print(json.dumps({"sent": sent, "overrun": overrun}))
+
+class Counter(QObject):
+    def __init__(self, load):
+        super(Counter, self).__init__()
+        self.load = load
+        self.received = 0
+        self.handoffs = []
+
+    def attach(self, handoff):
+        handoff.consumers += 1
+        self.handoffs.append(handoff)
+
+    @Slot()
+    def tick(self):
+        for handoff in self.handoffs:
+            for (name, array, t_read, t_decode) in handoff.drain():
+                self.received += array.shape[0]
+            handoff.release()
+        busy = time.perf_counter() + 0.016 * self.load / max(1.0 - self.load, 1e-3)
+        while time.perf_counter() < busy: # pure Python, holds the GIL
+            pass
+
+def run_case(mode, load, framing, rate, duration, capacity):
+    app = QCoreApplication.instance() or QCoreApplication([])
+    counter = Counter(load)
+    pty = FrameSources.PtySource()
+    pty.open()
+    listener = ingest = None
+    if mode == "process":
+        ingest = SharedIngest.DecoderProcess(DTYPES, capacity)
+        counter.attach(ingest.start("pty", "", 0, framing, {}, 1.0, pty.master))
+    else:
+        listener = SerialPortListener.SerialPortListener()
+        listener.set_dtypes(DTYPES)
+        listener.set_framing(framing)
+        counter.attach(listener.handoff)
+        listener.beginListneing(pty)
+
+    ticks = QTimer()
+    ticks.timeout.connect(counter.tick)
+    ticks.start(16)
+
+    writer = subprocess.Popen([sys.executable, os.path.abspath(__file__), "--write", "--framing", framing,
+                               "--rate", str(rate), "--duration", str(duration), pty.name],
+                              stdout = subprocess.PIPE, text = True, cwd = os.path.dirname(os.path.abspath(__file__)))
+    QTimer.singleShot(int((duration + 0.5) * 1e3), app.quit) # the last frames have time to arrive
+    app.exec()
+    written = json.loads(writer.communicate()[0].strip().splitlines()[-1])
+    counter.tick()
+
+    if listener is not None:
+        listener.stop()
+        listener.wait()
+    if ingest is not None:
+        ingest.stop()
+
+    return {
+        "mode": mode,
+        "load": load,
+        "framing": framing,
+        "rate": rate,
+        "capacity": capacity,
+        "sent": written["sent"],
+        "overrun": written["overrun"],
+        "received": counter.received,
+        "lost_percent": 100.0 * (1.0 - counter.received / max(written["sent"] + written["overrun"], 1)),
+    }
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rate", type = float, default = 20000.0, help = "frames/s")
+    parser.add_argument("--loads", type = float, nargs = "+", default = [0.0, 0.5, 0.9, 0.99], help = "fraction of the GUI thread's time spent busy")
+    parser.add_argument("--framing", default = "binary", choices = ["ascii", "binary"])
+    parser.add_argument("--duration", type = float, default = 3.0)
+    parser.add_argument("--capacity", type = int, default = 1 << 18, help = "frames per shared memory ring")
+    parser.add_argument("--mode", choices = ["thread", "process"], help = "run a single case in this process (internal)")
+    parser.add_argument("--write", action = "store_true", help = "writer process (internal)")
+    parser.add_argument("device", nargs = "?")
+    args = parser.parse_args()
+
+    if args.write:
+        write_frames(args.device, args.framing, args.rate, args.duration)
+        sys.exit(0)
+    if args.mode:
+        print(json.dumps(run_case(args.mode, args.loads[0], args.framing, args.rate, args.duration, args.capacity)))
+        sys.exit(0)
+
+    for load in args.loads:
+        for mode in ("thread", "process"):
+            command = [sys.executable, os.path.abspath(__file__), "--mode", mode, "--loads", str(load), "--framing", args.framing,
+                       "--rate", str(args.rate), "--duration", str(args.duration), "--capacity", str(args.capacity)]
+            output = subprocess.run(command, capture_output = True, text = True, cwd = os.path.dirname(os.path.abspath(__file__)))
+            if output.returncode != 0 or not output.stdout.strip():
+                print(output.stderr, file = sys.stderr)
+                continue
+            print(output.stdout.strip().splitlines()[-1])
@@ -0,0 +1,38 @@
+# This Python file uses the following encoding: utf-8
+'''
+    Compares building a new QPolygonF per series per refresh (what refresh
+    used to do) with filling a persistent PolylineBuffer, whose polygons
+    are only reallocated when the number of points changes.
+
+    usage: python bench_polyline.py [repeats]
+'''
+import sys
+import timeit
+import ctypes
+import shiboken6
+import numpy as np
+from PySide6.QtGui import QPolygonF
+from Polyline import PolylineBuffer
+
+def series_to_polyline(xdata, ydata):
+    size = len(xdata)
+    polyline = QPolygonF()
+    polyline.resize(size)
+    address = shiboken6.getCppPointer(polyline.data())[0]
+    buffer = (2 * size * ctypes.c_double).from_address(address)
+    memory = np.frombuffer(buffer, xdata.dtype)
+    memory[:(size-1)*2+1:2] = xdata
+    memory[1:(size-1)*2+2:2] = ydata
+    return polyline
+
+if __name__ == "__main__":
+    repeats = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    for size in [100, 1600, 10000, 100000]: # 1600: 2 points per pixel on a 800 pixels wide chart
+        xdata = np.arange(size, dtype = np.float64)
+        ydata = np.sin(xdata).astype(np.float32)
+        polyline = PolylineBuffer()
+        assert list(polyline.fill(xdata, ydata)) == list(series_to_polyline(xdata, ydata))
+
+        new = min(timeit.repeat(lambda: series_to_polyline(xdata, ydata), number = repeats, repeat = 3)) / repeats
+        reused = min(timeit.repeat(lambda: polyline.fill(xdata, ydata), number = repeats, repeat = 3)) / repeats
+        print(f"{size:7d} points: new polygon {new * 1e6:9.1f} us, reused {reused * 1e6:9.1f} us ({new / reused:.1f}x)")
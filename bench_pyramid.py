@@ -0,0 +1,35 @@
+# This Python file uses the following encoding: utf-8
+'''
+    Time to get the points of a zoomed out window: minmax decimation of
+    the samples themselves versus the buckets of a MinMaxPyramid, for
+    windows of increasing width ending at the newest sample.
+
+    usage: python bench_pyramid.py [samples] [points]
+'''
+import sys
+import timeit
+import numpy as np
+import Decimation
+from Pyramid import MinMaxPyramid
+
+if __name__ == "__main__":
+    samples = int(sys.argv[1]) if len(sys.argv) > 1 else 10000000
+    points = int(sys.argv[2]) if len(sys.argv) > 2 else 1600
+    dtype = np.dtype([('a', '<f4'), ('b', '<f4')])
+    data = np.empty(samples, dtype)
+    data['a'] = np.sin(np.arange(samples) / 1e4)
+    data['b'] = np.cos(np.arange(samples) / 1e4)
+    t = np.arange(samples, dtype = np.float64) / 1e4
+    pyramid = MinMaxPyramid(dtype)
+    build = timeit.timeit(lambda: [pyramid.append(data[i:i + 1000], t[i:i + 1000]) for i in range(0, samples, 1000)], number = 1)
+    print(f"pyramid built in {build:.2f} s ({build / samples * 1e9:.0f} ns/sample)")
+    x = np.arange(samples, dtype = np.float64)
+    width = 10000
+    while width <= samples:
+        first = samples - width
+        raw = timeit.timeit(lambda: Decimation.minmax(x[first:], data['a'][first:], points), number = 5) / 5
+        buckets = pyramid.buckets(first, samples, points // 2)
+        summary = timeit.timeit(lambda: pyramid.buckets(first, samples, points // 2), number = 5) / 5
+        used = "samples" if buckets is None else f"{buckets[0].shape[0]} buckets"
+        print(f"window {width:>10}: minmax {raw * 1e3:8.2f} ms, pyramid {summary * 1e3:6.3f} ms ({used})")
+        width *= 10
@@ -6,10 +6,21 @@ from PySide6.QtQml import qmlRegisterType, QQmlApplicationEngine
 from PySide6.QtCore import Slot
 import SerialPortListener
 import SimpleFOCScope
+import CaptureRecorder
+import FanOut
+import TraceExport
+import Trigger
+import Dsp
 
 
 qmlRegisterType(SerialPortListener.SimpleFOCSerialScope, "SimpleFOC", 1, 0, "SimpleFOCSerialScope")
 qmlRegisterType(SimpleFOCScope.SimpleFOCScope, "SimpleFOC", 1, 0, "SimpleFOCScope")
+qmlRegisterType(CaptureRecorder.SimpleFOCRecorder, "SimpleFOC", 1, 0, "SimpleFOCRecorder")
+qmlRegisterType(FanOut.SimpleFOCFanOut, "SimpleFOC", 1, 0, "SimpleFOCFanOut")
+qmlRegisterType(TraceExport.SimpleFOCExporter, "SimpleFOC", 1, 0, "SimpleFOCExporter")
+qmlRegisterType(Trigger.SimpleFOCTrigger, "SimpleFOC", 1, 0, "SimpleFOCTrigger")
+for stage in [Dsp.Align, Dsp.Filter, Dsp.MovingAverage, Dsp.MovingRms, Dsp.Decimate, Dsp.Derivative, Dsp.Spectrum]:
+    qmlRegisterType(stage, "SimpleFOC", 1, 0, stage.__name__)
 if __name__ == "__main__":
 
     app = QApplication(sys.argv) # <---
@@ -18,31 +18,69 @@ ApplicationWindow
         {
             id: ds_
             chart: chart_
+            bufferDepth: 100000 // samples kept per data source, see also bufferDuration (seconds)
+            memoryBudget: 0 // MB for the samples of all data sources, older samples are spilled to disk (0: keep bufferDepth in memory, drop the rest)
+            windowSize: 10000 // samples displayed, decimated to about pointsPerPixel points per pixel
+            decimation: "minmax" // or "lttb", "none"
+            xAxis: "index" // or "time": seconds, from timestampFields (e.g. {"Demo": "t_us"} with timestampScales {"Demo": 1e-6}) or the receive time
+            targetFps: 0 // refreshes when data changed, at most at the display refresh rate
+        }
+        recorder: SimpleFOCRecorder
+        {
+            id: recorder_
+            path: "capture"
+        }
+        fanOut: SimpleFOCFanOut
+        {
+            address: "/tmp/simplefocscope.sock" // or "host:port", see FanOutClient.py
+            serving: false // true: other processes can subscribe to the decoded frames
         }
         port: "/dev/ttyACM0"
         bauds: 115200
         headers: ['demo.h']
+        commandChannel: false // true if the firmware implements Commands.py: unticked structs aren't sent anymore
     }
 
-    Timer
+    SimpleFOCExporter
     {
-        interval: 50
-        running: true
-        repeat: true
-        onTriggered:
-        {
-            if(ds_.dirty)
-                ds_.refresh();
-        }
+        id: exporter_
+        scope: ds_
+        format: "npz" // or "csv", "parquet" (path is then a directory)
+        path: "export.npz"
     }
+
     ColumnLayout
     {
         anchors.fill: parent
         Text{text: "port: " + scope_.port}
         Text{text: "bauds: " + scope_.bauds}
         Text{text: "headers: " + scope_.headers}
+        Text
+        {
+            function stage(name) { var l = ds_.latency[name]; return l ? name + " " + l.p50.toFixed(1) + "/" + l.p99.toFixed(1) : ""; }
+            text: "latency p50/p99 (ms): " + ["decode", "delivery", "store", "draw"].map(stage).join(", ")
+                  + " | queued batches: " + scope_.signalQueueDepth + ", backlog: " + scope_.readBacklog + " B"
+                  + ", dropped frames: " + scope_.framesDropped
+                  + " | refresh: " + ds_.refreshTime.toFixed(1) + " ms, " + ds_.fps.toFixed(0) + " fps"
+        }
         Button{text: "connect"; onClicked: scope_.beginListneing()}
         RowLayout
+        {
+            Button{text: recorder_.recording ? "stop recording" : "record"; onClicked: recorder_.recording = !recorder_.recording}
+            Text{text: "frames written: " + recorder_.framesWritten + ", dropped: " + recorder_.framesDropped}
+            Button{text: exporter_.exporting ? "cancel export" : "export"; onClicked: exporter_.exporting ? exporter_.cancel() : exporter_.export()}
+            Text{text: exporter_.exporting ? (100 * exporter_.progress).toFixed(0) + " %" : exporter_.error}
+        }
+        RowLayout
+        {
+            Button{text: "<"; onClicked: ds_.pan(-0.5)}
+            Button{text: ">"; onClicked: ds_.pan(0.5)}
+            Button{text: "+"; onClicked: ds_.zoom(2, ds_.follow ? 1 : 0.5)}
+            Button{text: "-"; onClicked: ds_.zoom(0.5, ds_.follow ? 1 : 0.5)}
+            Button{text: "all"; onClicked: ds_.showAll()}
+            Button{text: "follow"; enabled: !ds_.follow; onClicked: ds_.follow = true}
+        }
+        RowLayout
         {
             Layout.fillWidth: true
             Repeater
@@ -51,7 +89,7 @@ ApplicationWindow
                 CheckBox
                 {
                     text: modelData
-                    onCheckedChanged: ds_.toggleDatasource(modelData)
+                    onCheckedChanged: { ds_.toggleDatasource(modelData); scope_.subscribe(modelData, checked) }
                     Component.onCompleted: checked = true
                 }
             }